@@ -2,18 +2,72 @@
 @file controller.py
 Implements a porportional gain controller for a DC motor with a quadrature encoder
 """
-import encoder_reader
-import motor_driver
 import utime
 
+## Largest duty cycle, in percent, which MotorDriver puts out
+DUTY_LIMIT = const(100)
+
+## A step longer than this many microseconds since the last one restarts the
+#  integral and derivative, as the loop wasn't running in between
+MAX_DT_US = const(100000)
+
+## A scheduled gain set stays in use until the error or velocity passes its
+#  limits by this factor, so that the gains don't flicker between two sets at
+#  a boundary
+HYSTERESIS = 1.25
+
+
+class GainSet:
+    """!
+    This class holds one entry of a gain schedule, see Controller.set_schedule()
+    """
+    def __init__(self, kp, ki, kd, kf=0, maxError=None, maxVelocity=None):
+        """!
+        Create a set of gains used while the error and the setpoint's velocity
+        are within limits
+        @param kp The proportional gain
+        @param ki The integral gain, per tick-second
+        @param kd The derivative gain, per tick/second
+        @param kf The velocity feedforward gain, per tick/second
+        @param maxError The largest error, in ticks, for which these gains are
+        used, or None for any error
+        @param maxVelocity The largest setpoint velocity, in ticks per second,
+        for which these gains are used, or None for any velocity
+        @returns GainSet
+        """
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.kf = kf
+        self.maxError = maxError
+        self.maxVelocity = maxVelocity
+
+    def fits(self, error, velocity, slack=1):
+        """!
+        Checks whether these gains apply
+        @param error The size of the error, in ticks
+        @param velocity The size of the setpoint's velocity, in ticks per
+        second
+        @param slack A factor by which the limits are widened
+        @returns bool
+        """
+        return ((self.maxError is None or error <= self.maxError*slack)
+                and (self.maxVelocity is None
+                     or velocity <= self.maxVelocity*slack))
+
 class Controller:
     """!
     This class implements a proportional gain controller for a DC motor with quadrature encoder
     """
-    def __init__(self, encoder, motor, setpoint, kp, ki, kd, ticks=8000, gearRatio=1):
+    def __init__(self, encoder, motor, setpoint, kp, ki, kd, ticks=8000,
+                 gearRatio=1, timed=False, dTau=0.005, kf=0, schedule=None,
+                 bumpTau=0.05, settleError=10, settleVelocity=500,
+                 settleDwellUs=30000):
         """!
         Create a DC motor controller object with proportional gain from quadrature encoder feedback
-        @param encoder The encoder object used to measure position
+        @param encoder The encoder object used to measure position; in timed
+        mode its velocity() estimate, if it has one, is used for the
+        derivative
         @param motor The motor driver used to send signals to the motor
         @param setpoint The target position for the motor to turn to
         @param kp The proportional gain coefficient for the controller to use
@@ -23,9 +77,30 @@ class Controller:
         @param gearRatio The gear speed reduction ratio, allowing for angles to be set on the output shaft (Output Gear Teeth/Motor Pinion Teeth).
         A positive ratio should be used for odd numbers of gears, and a negative ratio should be used for even numbers of gears to ensure the output
         shaft rotates in the desired direction. The ratio should be negated if the motor is mounted upside-down relative to the output shaft.
+        @param timed Time every step with ticks_us, so that ki is per
+        tick-second and kd per tick/second whatever the task's actual period;
+        the integral is limited so the output doesn't wind up past the
+        motor's +-100% and the derivative is low-pass filtered. By default ki
+        and kd are per step, as before
+        @param dTau The time constant of the derivative filter in timed mode,
+        in seconds
+        @param kf The velocity feedforward gain in timed mode, duty cycle per
+        tick/second of the setpoint's velocity, see set_setpoint()
+        @param schedule A gain schedule for timed mode, see set_schedule(), or
+        None to use the gains given
+        @param bumpTau The time constant, in seconds, over which a step in duty
+        cycle from switching between scheduled gains is faded out, or 0 to let
+        the duty cycle step
+        @param settleError The largest error, in ticks, at which the motor
+        counts as settled in timed mode
+        @param settleVelocity The largest velocity, in ticks per second, of the
+        motor and of the setpoint at which the motor counts as settled
+        @param settleDwellUs How long, in microseconds, the motor must stay
+        within both bands to be settled
         @returns Controller
         """
         self.encoder = encoder
+        self.encoderVelocity = getattr(encoder, 'velocity', None)
         self.motor = motor
         self.set_setpoint(setpoint)
         self.set_kp(kp)
@@ -33,29 +108,250 @@ class Controller:
         self.set_kd(kd)
         self.ticks = ticks
         self.gearRatio = gearRatio
+        self.timed = timed
+        self.dTau = dTau
+        self.set_kf(kf)
+        self.bumpTau = bumpTau
+        self.set_settling(settleError, settleVelocity, settleDwellUs)
+        self.reset_settle_stats()
+        self.set_schedule(schedule)
+
+    def reset(self):
+        """!
+        Forgets the integral and derivative history, for example after the
+        motor has been stopped for a while or before a new move
+        @returns None
+        """
         self.eSum = 0
         self.last = 0
-        
-    def run(self):
+        self.error = 0
+        self.dFiltered = 0
+        self.lastTime = None
+        self.lastPosition = None
+        self.bump = 0
+        self.gainIndex = None
+        self.speed = 0
+        self.settled = False
+        self.bandSince = None
+        self.moveStart = None
+
+    def set_schedule(self, schedule):
         """!
-        Runs one step of the control loop. Changes motor's pulse width and logs the current time and encoder position
+        Sets a gain schedule, which picks the gains every step in timed mode
+        from the size of the error and of the setpoint's velocity. The first
+        GainSet whose limits fit is used, so the table runs from the tightest
+        limits, such as holding on target, to a last entry with no limits. A
+        change of gains is bumpless: the step it would make in the duty cycle
+        is carried over and faded out with time constant bumpTau
+        @param schedule A sequence of GainSet, or None to keep the gains set
+        with set_kp() and the like
         @returns None
         """
+        self.schedule = schedule
+        self.reset()
+
+    def _schedule(self, error, eSum):
+        """!
+        Switches to the gains the schedule gives for this step, keeping the
+        duty cycle where it was: the integral is rescaled so the integral term
+        carries on unchanged, and the step in the other terms goes into the
+        bump, which decays. Switching to gains with no integral term clears
+        the integral, and its term goes into the bump too
+        @param error The error, in ticks
+        @param eSum The integral of the error for this step
+        @returns The integral of the error, rescaled for the new gains
+        """
+        size = abs(error)
+        velocity = abs(self.velocity)
+        index = self.gainIndex
+        for (pick, gains) in enumerate(self.schedule):
+            if gains.fits(size, velocity, HYSTERESIS if pick == index else 1):
+                break
+        if pick == index:
+            return eSum
+        if index is not None and self.bumpTau:
+            before = (self.kp*error + self.kd*self.dFiltered
+                      + self.kf*self.velocity)
+            after = (gains.kp*error + gains.kd*self.dFiltered
+                     + gains.kf*self.velocity)
+            self.bump += before - after
+            if gains.ki:
+                eSum *= self.ki/gains.ki
+            else:
+                self.bump += self.ki*eSum
+        if not gains.ki:
+            eSum = 0
+        self.gainIndex = pick
+        self.kp = gains.kp
+        self.ki = gains.ki
+        self.kd = gains.kd
+        self.kf = gains.kf
+        return eSum
+
+    def run(self, now=None):
+        """!
+        Runs one step of the control loop. Changes motor's pulse width and logs the current time and encoder position
+        @param now The step's time from utime.ticks_us(), read here if not
+        given
+        @returns The duty cycle sent to the motor
+        """
         position = self.encoder.read()
         self.error = self.setpoint - position
+        if self.timed:
+            return self._runTimed(position,
+                                  utime.ticks_us() if now is None else now)
         PWM = self.kp*self.error + self.ki*self.eSum + self.kd*(self.error - self.last)
         # self.eSum += self.error
         self.last = self.error
         self.motor.set_duty_cycle(PWM)
         return PWM
+
+    def _runTimed(self, position, now):
+        """!
+        Runs one step of the control loop using the measured time since the
+        last step
+        @param position The encoder position just read
+        @param now The step's time from utime.ticks_us()
+        @returns The duty cycle sent to the motor
+        """
+        error = self.error
+        dt = 0
+        if self.lastTime is not None:
+            dt = utime.ticks_diff(now, self.lastTime)
+        if 0 < dt <= MAX_DT_US:
+            dt /= 1000000
+            # derivative of the error from the setpoint's velocity rather than
+            # its steps, so a new setpoint doesn't kick the motor
+            if self.encoderVelocity is None:
+                self.speed = (position - self.lastPosition)/dt
+            else:
+                self.speed = self.encoderVelocity()
+            rate = self.velocity - self.speed
+            alpha = dt/(self.dTau + dt)
+            self.dFiltered += alpha*(rate - self.dFiltered)
+            eSum = self.eSum
+            if self.ki:
+                eSum += error*dt
+            self.bump *= self.bumpTau/(self.bumpTau + dt)
+        else:
+            self.dFiltered = 0
+            eSum = self.eSum
+        self.lastTime = now
+        self.lastPosition = position
+        self.last = error
+        if self.schedule:
+            eSum = self._schedule(error, eSum)
+
+        PD = (self.kp*error + self.kd*self.dFiltered + self.kf*self.velocity
+              + self.bump)
+        PWM = PD + self.ki*eSum
+        # integrate only while the output isn't saturated by it, and back off
+        # what is left over when it is
+        if self.ki and not -DUTY_LIMIT <= PWM <= DUTY_LIMIT:
+            limit = DUTY_LIMIT if PWM > 0 else -DUTY_LIMIT
+            if abs(PD) >= DUTY_LIMIT:
+                eSum = 0
+            else:
+                eSum = (limit - PD)/self.ki
+            PWM = limit
+        self.eSum = eSum
+        self.motor.set_duty_cycle(PWM)
+        self._settle(now)
+        return PWM
+
+    def _settle(self, now):
+        """!
+        Updates the settling detector: the motor is settled once the error,
+        the motor's velocity and the setpoint's velocity have all stayed
+        within their bands for settleDwellUs. The time from the start of the
+        move, which is the first step after reset() or after the motor was
+        last knocked out of its bands, is kept in settleUs
+        @param now The step's time from utime.ticks_us()
+        @returns None
+        """
+        if self.moveStart is None:
+            self.moveStart = now
+        if (abs(self.error) <= self.settleError
+                and abs(self.speed) <= self.settleVelocity
+                and abs(self.velocity) <= self.settleVelocity):
+            if self.bandSince is None:
+                self.bandSince = now
+            dwelt = utime.ticks_diff(now, self.bandSince)
+            if not self.settled and dwelt >= self.settleDwellUs:
+                self.settled = True
+                took = utime.ticks_diff(now, self.moveStart)
+                self.settleUs = took
+                self.settleCount += 1
+                self.settleTotalUs += took
+                self.settleMaxUs = max(self.settleMaxUs, took)
+        else:
+            self.bandSince = None
+            if self.settled:
+                self.settled = False
+                self.moveStart = now
+
+    def set_settling(self, settleError, settleVelocity, settleDwellUs):
+        """!
+        Allows the user to change the bands within which the motor counts as
+        settled
+        @param settleError The largest error, in ticks
+        @param settleVelocity The largest velocity of the motor and of the
+        setpoint, in ticks per second
+        @param settleDwellUs How long, in microseconds, the motor must stay
+        within both bands
+        @returns None
+        """
+        self.settleError = abs(settleError)
+        self.settleVelocity = abs(settleVelocity)
+        self.settleDwellUs = settleDwellUs
+
+    def timeToSettle(self, now=None):
+        """!
+        Predicts how long the motor will take to settle in timed mode, from
+        the time left in its dwell or, while it closes in on a still setpoint,
+        from its velocity, so that work such as imaging can start early
+        @param now The time from utime.ticks_us(), by default the time of the
+        last step
+        @returns The predicted time in microseconds, or None if it can't be
+        predicted, for example while the motor moves away from the setpoint or
+        the setpoint itself is moving
+        """
+        if self.settled:
+            return 0
+        if now is None:
+            now = self.lastTime
+        if self.bandSince is not None:
+            dwelt = utime.ticks_diff(now, self.bandSince)
+            return max(self.settleDwellUs - dwelt, 0)
+        if abs(self.velocity) > self.settleVelocity:
+            return None
+        closing = self.speed if self.error > 0 else -self.speed
+        if closing <= 0:
+            return None
+        closer = max(abs(self.error) - self.settleError, 0)
+        return int(closer/closing*1000000) + self.settleDwellUs
+
+    def reset_settle_stats(self):
+        """!
+        Clears the counts of moves settled and the times they took
+        @returns None
+        """
+        self.settleCount = 0
+        self.settleTotalUs = 0
+        self.settleMaxUs = 0
+        self.settleUs = None
     
-    def set_setpoint(self, setpoint):
+    def set_setpoint(self, setpoint, velocity=0):
         """!
         Allows the user to change the motor's target position
         @param setpoint The position for the motor to turn to
+        @param velocity How fast the setpoint is moving, in ticks per second,
+        when it follows a MotionProfile; in timed mode this is fed forward
+        with kf and the derivative acts on the difference from it
         @returns None
         """
         self.setpoint = setpoint
+        self.velocity = velocity
 
     def setAngle(self, angle):
         """!
@@ -63,7 +359,7 @@ class Controller:
         @param angle The desired output shaft angle
         @returns None
         """
-        self.setpoint = self.angleToTicks(angle)
+        self.set_setpoint(self.angleToTicks(angle))
 
     def readAngle(self):
         """!
@@ -96,6 +392,15 @@ class Controller:
         """
         self.kd = kd
 
+    def set_kf(self, kf):
+        """!
+        Allows the user to change the controller's velocity feedforward gain
+        @param kf The Kf value to set the controller's velocity feedforward
+        gain to
+        @returns None
+        """
+        self.kf = kf
+
     def angleToTicks(self, angle):
         """!
         Converts a specified angle into a encoder ticks
@@ -113,7 +418,10 @@ class Controller:
         return ticks * 360 // (self.ticks * self.gearRatio)
     
 if __name__ == "__main__":
-    
+    import pyb
+    import encoder_reader
+    import motor_driver
+
     pinC1 = pyb.Pin(pyb.Pin.board.PC1, pyb.Pin.OUT_PP)
     pinA0 = pyb.Pin(pyb.Pin.board.PA0, pyb.Pin.OUT_PP) 
     pinA1 = pyb.Pin(pyb.Pin.board.PA1, pyb.Pin.OUT_PP)
@@ -1,27 +1,50 @@
 """! 
 @file encoder_reader.py
-Reads absolute position of quadrature encoder.
+Reads absolute position of quadrature encoder, and estimates its velocity and acceleration.
 """
 import time
-import pyb
+import utime
+from array import array
+
+## Samples of the count kept for the velocity estimate
+SAMPLES = const(16)
+
+## A read this soon after the last sample, in microseconds, replaces that sample rather than adding one, so that extra
+#  reads within a control step don't flush out the history
+MIN_SAMPLE_US = const(1000)
+
+## The velocity is taken over as few samples as give at least this many counts of movement...
+MIN_COUNTS = const(4)
+
+## ...but over no more than this many microseconds
+MAX_WINDOW_US = const(200000)
 
 class Encoder:
     """! 
     This class implements a quadrature encoder.
     """    
-    def __init__ (self, in1pin, in2pin, timer):
+    def __init__ (self, in1pin, in2pin, timer, samples=SAMPLES):
         """! 
         Create an encoder driver and initalizes both it and
         a timer used in updating its position.
         @param in1pin pin corresponding to timer channel 1 pin
         @param in2pin pin corresponding to timer channel 2 pin
-        @param timer timer used for reading encoder
+        @param timer timer used for reading encoder; a 32-bit timer (TIM2 or TIM5) set up with
+               period=0x3FFFFFFF needs no overflow handling
+        @param samples how many (time, count) samples are kept for the velocity and acceleration estimates
         @returns Encoder
         """    
-        ch1 = timer.channel(1, pyb.Timer.ENC_AB, pin=in1pin)
-        ch2 = timer.channel(2, pyb.Timer.ENC_AB, pin=in2pin)
+        ch1 = timer.channel(1, timer.ENC_AB, pin=in1pin)
+        ch2 = timer.channel(2, timer.ENC_AB, pin=in2pin)
         
         self.timer = timer
+        # the counter runs from 0 to period, so it wraps modulo period + 1
+        self.modulus = timer.period() + 1
+        self.wide = self.modulus > 0x10000
+        
+        self.times = array('i', bytes(4*samples))
+        self.counts = array('i', bytes(4*samples))
+        self.speeds = array('f', bytes(4*samples))
         
         self.zero()
         
@@ -32,17 +55,76 @@ class Encoder:
         """
         new = self.timer.counter()
         
-        delta = new - self.last
-        
-        self.last = new
-        
-        if delta > 32768:
-            self.value -= 65535 - delta
-        elif delta < -32768:
-            self.value += 65535 + delta
+        if self.wide:
+            # the count starts mid-range, so it can't wrap in any plausible travel
+            self.value = new - self.origin
         else:
+            delta = new - self.last
+            
+            self.last = new
+            
+            if delta > self.modulus >> 1:
+                delta -= self.modulus
+            elif delta < -(self.modulus >> 1):
+                delta += self.modulus
             self.value += delta
+        self._sample(utime.ticks_us(), self.value)
         return self.value
+
+    def _sample(self, now, count):
+        """!
+        Adds a sample of the count to the ring buffer and updates the velocity estimate. The window reaches back to
+        the newest sample the count has moved at least MIN_COUNTS since, so the estimate responds quickly at speed and
+        still resolves slow movement; the acceleration is the change in velocity over the same window
+        @param now The time of the sample from utime.ticks_us()
+        @param count The count
+        @returns None
+        """
+        times = self.times
+        counts = self.counts
+        speeds = self.speeds
+        size = len(times)
+        head = self.head
+        if not self.filled or utime.ticks_diff(now, times[head]) >= MIN_SAMPLE_US:
+            head = (head + 1) % size
+            self.head = head
+            if self.filled < size:
+                self.filled += 1
+        # else it's too soon for a new sample, so the newest one is updated
+        times[head] = now
+        counts[head] = count
+
+        idx = head
+        for _ in range(self.filled - 1):
+            older = (idx - 1) % size
+            if utime.ticks_diff(now, times[older]) > MAX_WINDOW_US:
+                break
+            idx = older
+            if abs(count - counts[idx]) >= MIN_COUNTS:
+                break
+        speed = 0.0
+        accel = 0.0
+        if idx != head:
+            dt = utime.ticks_diff(now, times[idx])
+            speed = (count - counts[idx])*1000000/dt
+            accel = (speed - speeds[idx])*1000000/dt
+        speeds[head] = speed
+        self.speed = speed
+        self.accel = accel
+
+    def velocity(self):
+        """!
+        This method gives the encoder's velocity as of the last read().
+        @returns velocity in counts per second
+        """
+        return self.speed
+
+    def acceleration(self):
+        """!
+        This method gives the encoder's acceleration as of the last read().
+        @returns acceleration in counts per second squared
+        """
+        return self.accel
     
     def zero(self):
         """!
@@ -51,10 +133,80 @@ class Encoder:
         """
         self.value = 0
         self.last = 0
-        self.timer.counter(0)
-        
-        
+        self.origin = self.modulus >> 1 if self.wide else 0
+        self.timer.counter(self.origin)
+        self.head = 0
+        self.filled = 0
+        self.speed = 0.0
+        self.accel = 0.0
+
+
+def test_encoder():
+    """!
+    Checks that the position follows a 16-bit timer across wraps in both directions and a 32-bit one without
+    overflow handling, and that the velocity window is one sample at speed and stretches to resolve slow movement
+    @returns None
+    """
+    class FakeTimer:
+        ENC_AB = 3
+
+        def __init__(self, period):
+            self.top = period
+            self.count = 0
+
+        def channel(self, *args, **kwargs):
+            return None
+
+        def period(self):
+            return self.top
+
+        def counter(self, value=None):
+            if value is None:
+                return self.count
+            self.count = value
+
+        def move(self, counts):
+            self.count = (self.count + counts) % (self.top + 1)
+
+    for period in (0xFFFF, 0x3FFFFFFF):
+        timer = FakeTimer(period)
+        encoder = Encoder(None, None, timer)
+        position = 0
+        for counts in (30000, 30000, 30000, -20000, -30000, -30000, -30000, -30000, -30000, 5):
+            timer.move(counts)
+            position += counts
+            assert encoder.read() == position, f"{encoder.value} != {position} with period {period}"
+
+    encoder = Encoder(None, None, FakeTimer(0xFFFF))
+    # fast: 100 counts every 10 ms is enough over one sample
+    now = 0
+    for step in range(20):
+        encoder._sample(now, 100*step)
+        now += 10000
+    assert abs(encoder.velocity() - 10000) < 1e-3 and abs(encoder.acceleration()) < 1e-3
+    # slow: 1 count every 10 ms needs MIN_COUNTS samples
+    for step in range(20):
+        encoder._sample(now, 2000 + step)
+        now += 10000
+    assert abs(encoder.velocity() - 100) < 1e-3
+    # slower still: the window stops at the oldest sample kept
+    for step in range(40):
+        encoder._sample(now, 3000 + step//10)
+        now += 10000
+    assert 0 < encoder.velocity() < 20
+    # and stopped
+    for step in range(40):
+        encoder._sample(now, 3000)
+        now += 10000
+    assert encoder.velocity() == 0
+    print("Encoder OK")
+
+
 if __name__ == '__main__':
+    import pyb
+
+    test_encoder()
+
     pinC6 = pyb.Pin(pyb.Pin.board.PC6, pyb.Pin.OUT_PP) 
     pinC7 = pyb.Pin(pyb.Pin.board.PC7, pyb.Pin.OUT_PP)
 
@@ -69,5 +221,5 @@ if __name__ == '__main__':
         if count == 100:
             encoder.zero()
             count = 0
-        print(encoder.read())
+        print(encoder.read(), encoder.velocity())
         time.sleep(.1)
\ No newline at end of file
@@ -9,10 +9,14 @@ import task_share
 import utime
 from motor_driver import MotorDriver
 from encoder_reader import Encoder
-from controller import Controller
+from controller import Controller, GainSet
+from motion_profile import MotionProfile
 from servo import Servo
-from mlx_cam import MLX_Cam
+from mlx_cam import MLX_Cam, IDLE, TRACKING, CONFIRM
+from targeting import find_hotspot, Hotspot, BlobDetector
+from tracking import MultiTargetTracker
 from machine import I2C
+from array import array
 import gc
 
 def task1(shares):
@@ -43,9 +47,42 @@ def task1(shares):
     
     encoder = Encoder(pinC6, pinC7, tim8)
     
-    ctrl = Controller(encoder, motor, 0, kp=0.06, ki=0, kd=0.0002, ticks=8000, gearRatio=float(96)/float(30))
+    # Timed gains: ki is per tick-second and kd per tick/second, so they
+    # hold whatever the task's actual period. The setpoint follows a motion
+    # profile, and the gains are scheduled by how far off target the turret is
+    ctrl = Controller(encoder, motor, 0, kp=0.2, ki=0, kd=0.0015, ticks=8000,
+                      gearRatio=float(96)/float(30), timed=True, kf=0.0007)
+    # Tuned in tools/sim_motion_profile.py to overshoot no more than 0.25 deg
+    ctrl.set_schedule((
+        # holding on target
+        GainSet(kp=0.1, ki=1.0, kd=0.0015, kf=0.0007,
+                maxError=ctrl.angleToTicks(0.5),
+                maxVelocity=ctrl.angleToTicks(5)),
+        # closing in
+        GainSet(kp=0.075, ki=0.5, kd=0.0015, kf=0.0007,
+                maxError=ctrl.angleToTicks(5)),
+        # on the move, with no integral to wind up
+        GainSet(kp=0.2, ki=0, kd=0.0015, kf=0.0007),
+    ))
+    # Settled once within 0.25 deg and below 2 deg/s for 30 ms. This trades
+    # latency for a sharper image: on small moves imaging starts later than
+    # the old 3 deg rule did (about 460 ms against 260 ms for 1 deg in
+    # tools/sim_settling.py), but the old rule started it with the turret
+    # still 0.6 deg off and moving. From 10 deg up the two start together.
+    ctrl.set_settling(ctrl.angleToTicks(0.25), ctrl.angleToTicks(2), 30000)
+    # Pan limits: 540 deg/s, 1000 deg/s^2 and 5000 deg/s^3
+    profile = MotionProfile(ctrl.angleToTicks(540), ctrl.angleToTicks(1000),
+                            ctrl.angleToTicks(5000))
+    target = 0
     
     closeEnough = const(3)
+    # Imaging starts this many us before the turret is predicted to settle
+    imageLead = const(20000)
+    # A turret which stops within closeEnough but outside the settling bands
+    # counts as settled after this many ms
+    settleTimeout = const(500)
+    # When the turret was last seen stopped within closeEnough, or None
+    nearSince = None
 
     yield
 
@@ -54,16 +91,22 @@ def task1(shares):
         if state == 0:
             # Waiting for start
             if start.get():
-                ctrl.set_kp(0.06)
-                ctrl.set_kd(0.0002)
                 hAngle.put(-180)
-                ctrl.setAngle(hAngle.get())
+                target = hAngle.get()
+                profile.reset(encoder.read())
+                profile.set_target(ctrl.angleToTicks(target))
+                ctrl.reset()
+                nearSince = None
                 state = 2
             yield
         elif state == 1:
             # Idle
             if abs(hAngle.get() - ctrl.readAngle()) > closeEnough:      
-                ctrl.setAngle(hAngle.get())
+                target = hAngle.get()
+                profile.reset(encoder.read())
+                profile.set_target(ctrl.angleToTicks(target))
+                ctrl.reset()
+                nearSince = None
                 readyForImage.put(0)
                 state = 2
             elif not start.get():
@@ -72,18 +115,38 @@ def task1(shares):
             yield
         elif state == 2:
             # Panning
+            if hAngle.get() != target:
+                # the tracker moved the target; the profile carries on from
+                # where it is
+                target = hAngle.get()
+                profile.set_target(ctrl.angleToTicks(target))
+                nearSince = None
+                readyForImage.put(0)
+            ctrl.set_setpoint(profile.update(), profile.velocity)
             ctrl.run()
-            if abs(hAngle.get() - ctrl.readAngle()) <= closeEnough: # May need to change this
-                for i in range(3):
-                    ctrl.run()
+            if (not profile.done()
+                    or abs(target - ctrl.readAngle()) > closeEnough):
+                nearSince = None
+            elif nearSince is None:
+                nearSince = utime.ticks_ms()
+            if ctrl.settled or (
+                    nearSince is not None
+                    and utime.ticks_diff(utime.ticks_ms(), nearSince)
+                    >= settleTimeout):
                 ctrl.motor.set_duty_cycle(0)
-                ctrl.set_kp(0.2)
-                ctrl.set_kd(0.01)
                 if start.get():
                     readyForImage.put(1)
-                    state = 1
+                state = 1
+            elif start.get() and profile.done():
+                # start imaging just before the turret settles rather than
+                # after, and stop again if it is knocked out of the settling
+                # bands before it does
+                left = ctrl.timeToSettle()
+                if (ctrl.bandSince is not None and left is not None
+                        and left <= imageLead):
+                    readyForImage.put(1)
                 else:
-                    state = 1
+                    readyForImage.put(0)
             yield
         else:
             raise ValueError(f"Invalid Task 1 State: {state}")
@@ -175,53 +238,183 @@ def task4(shares):
     pinB8 = pyb.Pin(pyb.Pin.board.PB8, pyb.Pin.ALT, alt=4)
     pinB9 = pyb.Pin(pyb.Pin.board.PB9, pyb.Pin.ALT, alt=4)
     i2c = I2C(1)
-    camera = MLX_Cam(i2c)
-    image = None
-    arrayImage = []
-    vMax = 0
-    hMax = 0
+    camera = MLX_Cam(i2c, frames=2, watch_every=8)
+    camera.set_profile(IDLE)
+    subpages = camera.stream()
+    frame = None
+    readySince = None
+    # the first half of a frame with the other half interpolated
+    halfImage = array('h', bytes(2*32*24))
+    hotspot = Hotspot()
+    detector = BlobDetector(max_blobs=3, min_area=2)
+    tracker = MultiTargetTracker()
     
     hOffset = const(-10)
     vOffset = const(-16)
     hScale = const(0.95)
     vScale = const(1)
+    # Time from task4 deciding to fire to the trigger servo hitting, in ms
+    triggerDelay = const(250)
+    # A first cut from half a frame further than this many degrees from
+    # where the turret points turns it without waiting for the whole frame
+    coarseSlew = const(10)
+    # Rows either side of the tracked target read with a region of interest
+    roiMargin = const(3)
+    # task1 only turns for aims further than this many degrees (its
+    # closeEnough), and takes up a new aim within this many ms
+    aimBand = const(3)
+    aimWait = const(100)
+    # When task4 last put an aim task1 will turn for, until task1 is seen
+    # to have dropped readyForImage for it; None otherwise
+    aimedAt = None
+
+    def toAngles(hNow, row, col):
+        return (hNow + hScale*(row + hOffset),
+                vScale*(max(col, 16) + vOffset) + 43)
 
     yield
 
     while True:
+        # Frames are acquired in the background whenever the turret is on,
+        # but only ones started after the turret settled are used. After a
+        # new aim, readyForImage still holds from the last one until task1
+        # drops it, so it isn't trusted again until it has been dropped
+        ready = readyForImage.get()
+        if aimedAt is not None:
+            waited = utime.ticks_diff(utime.ticks_ms(), aimedAt)
+            if not ready or waited > aimWait:
+                aimedAt = None
+            ready = False
+        if ready:
+            if readySince is None:
+                readySince = utime.ticks_ms()
+        else:
+            readySince = None
+        if start.get():
+            next(subpages)
+
         if state == 0:
             # Waiting for start
             if start.get():
                 state = 1
+            else:
+                tracker.reset()
+                camera.clear_roi()
+                camera.set_profile(IDLE)
             yield
         elif state == 1:
             # Normal Operation
-            if readyForImage.get():
-                while not image:
-                    image = camera.get_image_nonblocking()
-                    yield
-                for line in camera.get_csv(image):
-                    arrayImage.append(line.split(","))
+            if readySince is not None:
+                # Search the first half of a frame as soon as it arrives; if
+                # the target is far off, turn to it rather than waiting for
+                # the whole frame. Give up if task1 withdraws readyForImage
+                # meanwhile, as the turret has been knocked off target
+                coarse = True
+                abandoned = False
+                while not frame:
+                    frame = camera.lease_frame(readySince)
+                    if frame and frame.flags:
+                        # its halves may not line up; wait for the next one
+                        camera.release_frame(frame)
+                        frame = None
+                    if frame:
+                        break
                     yield
-                for (hIdx, line) in enumerate(arrayImage):
-                    if hIdx < 4:
+                    item = next(subpages)
+                    if not readyForImage.get():
+                        abandoned = True
+                        break
+                    if not (item and coarse):
                         continue
-                    for (vIdx, pixel) in enumerate(line):
-                        try:
-                            if float(pixel) > float(arrayImage[hMax][vMax]):
-                                vMax = vIdx
-                                hMax = hIdx
-                        except:
-                            raise ValueError("Camera returned non-number data")
+                    (subpage, half) = item
+                    if (half.halves == 0x3
+                            or utime.ticks_diff(half.started, readySince) < 0):
+                        continue
+                    coarse = False
+                    half.interpolate(subpage, halfImage)
+                    camera.bad_pixels.patch(halfImage)
+                    roi = half.roi and half.roi.mirrored()
+                    for _ in detector.steps(halfImage, roi):
+                        yield
+                        next(subpages)
+                        if not readyForImage.get():
+                            abandoned = True
+                            break
+                    if abandoned:
+                        break
+                    if detector.count:
+                        hNow = hAngle.get()
+                        blob = detector.blobs[0]
+                        (hCoarse, vCoarse) = toAngles(hNow, blob.row, blob.col)
+                        if abs(hCoarse - hNow) > coarseSlew:
+                            print("Turning to first cut:")
+                            print(hCoarse)
+                            hAngle.put(int(hCoarse))
+                            vAngle.put(int(vCoarse))
+                            aimedAt = utime.ticks_ms()
+                            abandoned = True
+                            break
+                if abandoned:
+                    if frame:
+                        camera.release_frame(frame)
+                        frame = None
+                    readySince = None
+                    state = 0
                     yield
-                
-                hNew = int(hAngle.get() + hScale*(hMax + hOffset))
-                vNew = int(vScale*(max(vMax, 16) + vOffset) + 43)
+                    continue
+
+                captured = frame.timestamp
+                # the next frame is acquired while this one is searched
+                roi = frame.roi and frame.roi.mirrored()
+                for _ in detector.steps(frame, roi):
+                    yield
+                    next(subpages)
+                # angles of the targets in view, from the blobs' sub-pixel
+                # centres, or from the hottest pixel if no blob stands out
+                hNow = hAngle.get()
+                detections = [
+                    toAngles(hNow, blob.row, blob.col) + (blob.area,)
+                    for blob in detector.blobs[:detector.count]
+                ]
+                if not detections:
+                    find_hotspot(frame, roi, out=hotspot)
+                    detections.append(
+                        toAngles(hNow, hotspot.row, hotspot.col) + (1,))
+                # a frame read with a window of rows only covers their pan
+                # angles
+                if frame.roi is None:
+                    panRange = None
+                else:
+                    last = frame.roi.row + frame.roi.rows - 1
+                    panRange = (hNow + hScale*(frame.roi.row + hOffset),
+                                hNow + hScale*(last + hOffset))
+                camera.release_frame(frame)
+                frame = None
+                tracker.update(detections, captured, panRange)
+                track = tracker.select(hNow, vAngle.get())
+                if track is None:
+                    # every detection was new and the track table is full
+                    camera.set_profile(IDLE)
+                    state = 0
+                    yield
+                    continue
+
+                # Fire if the target will be in the sights when the shot
+                # lands, otherwise aim where it will be at the next chance
+                # to fire, one image later
+                latency = (utime.ticks_diff(utime.ticks_ms(), captured)
+                           + triggerDelay)
+                (hFire, vFire) = track.lead(latency)
+                (hLead, vLead) = track.lead(latency + track.interval)
+                hNew = int(hLead)
+                vNew = int(vLead)
                 
                 print("-------Next--------")
-                print("Maximum Heat Signature:")
-                print(hMax)
-                print(vMax)
+                print("Targets in view:")
+                print(len(detections))
+                print("Engaging:")
+                print(track.pan)
+                print(track.tilt)
                 print("Pointing at:")
                 print(hAngle.get())
                 print(vAngle.get())
@@ -229,16 +422,41 @@ def task4(shares):
                 print(hNew)
                 print(vNew)
                 
-                if abs(hNew - hAngle.get()) <= 1 and abs(vNew - vAngle.get()) <= 1:
-                    fire.put(1)
-                    print("Fire!")
+                # The camera scans slowly until a target is tracked, follows
+                # it with fast images, and takes a slower, less noisy image
+                # to confirm the aim before firing
+                if (track.updates > 1 and abs(hFire - hAngle.get()) <= 1
+                        and abs(vFire - vAngle.get()) <= 1):
+                    if camera.profile is CONFIRM:
+                        fire.put(1)
+                        print("Fire!")
+                    else:
+                        camera.set_profile(CONFIRM)
+                        # wait for a frame taken with the new settings; the
+                        # last aim has been taken up by task1, as this frame
+                        # was only leased once it had
+                        if aimedAt is None:
+                            readySince = utime.ticks_ms()
+                        print("Confirming")
                 else:
+                    camera.set_profile(TRACKING)
+                    if abs(hNew - hAngle.get()) > aimBand:
+                        aimedAt = utime.ticks_ms()
                     hAngle.put(hNew)
                     vAngle.put(vNew)
-                image = None
-                arrayImage = []
-                vMax = 0
-                hMax = 0
+                    # wait for frames taken after this move
+                    readySince = None
+
+                # Once the target is tracked, read only the band of rows it
+                # should be in next (the pan axis runs along the camera's
+                # rows), wider the faster it moves
+                if track.updates > 2:
+                    row = (hLead - hAngle.get())/hScale - hOffset
+                    margin = (roiMargin
+                              + abs(track.pan_rate)*track.interval/1000/hScale)
+                    camera.set_roi(int(row - margin), 0, int(2*margin) + 1, 32)
+                else:
+                    camera.clear_roi()
                 state = 0
                 
             yield
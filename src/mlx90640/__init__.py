@@ -3,22 +3,27 @@
 #  camera.
 #
 #  RAW VERSION
-#  This version is a stripped down MLX90640 driver which produces only raw
-#  data, not calibrated data, in order to save memory.
+#  This version is a stripped down MLX90640 driver which by default produces
+#  only raw data, not calibrated data, in order to save memory. Calibrated
+#  processing can be switched on with setup(calibrated=True).
 
-from gc import collect, mem_free
-from ucollections import namedtuple
+from gc import collect
+from mlx90640.utils import namedtuple
 from mlx90640.regmap import (
     REGISTER_MAP,
     EEPROM_MAP,
     RegisterMap,
     CameraInterface,
+    MemoryInterface,
+    read_eeprom,
+    CACHED_REGISTERS,
     REG_SIZE,
     EEPROM_ADDRESS,
     EEPROM_SIZE,
 )
-# from mlx90640.calibration import CameraCalibration, TEMP_K
-from mlx90640.image import RawImage, Subpage, get_pattern_by_id
+from mlx90640.calibration import TEMP_K
+from mlx90640.image import RawImage, ProcessedImage, Subpage, get_pattern_by_id
+from mlx90640.badpix import BadPixelMap
 
 
 class CameraDetectError(Exception):
@@ -65,27 +70,102 @@ class DataNotAvailableError(Exception):
     pass
 
 
+## Default location of the calibration cache in the board's filesystem
+CALIB_CACHE_PATH = '/mlx_calib.bin'
+
+
 class MLX90640:
 
-    def __init__(self, i2c, addr):
+    ## @param   cache_registers Shadow the configuration registers so that
+    #           reading them, or changing one of their fields, doesn't need
+    #           an extra I2C read
+    #  @param   eeprom_dump Read the whole EEPROM once, in a few bulk
+    #           transfers, and decode calibration parameters from that copy
+    #           rather than reading each one over I2C
+    def __init__(self, i2c, addr, *, cache_registers=True, eeprom_dump=True):
         self.iface = CameraInterface(i2c, addr)
-        self.registers = RegisterMap(self.iface, REGISTER_MAP)
-        self.eeprom = RegisterMap(self.iface, EEPROM_MAP, readonly=True)
+        cached = CACHED_REGISTERS if cache_registers else ()
+        self.registers = RegisterMap(self.iface, REGISTER_MAP, cached=cached)
+
+        if eeprom_dump:
+            self.eeprom_data = read_eeprom(self.iface)
+            self.eeprom_iface = MemoryInterface(self.eeprom_data, EEPROM_ADDRESS)
+        else:
+            self.eeprom_data = None
+            self.eeprom_iface = self.iface
+        self.eeprom = RegisterMap(self.eeprom_iface, EEPROM_MAP, readonly=True)
         self.calib = None
         self.raw = None
-#         self.image = None
+        self.image = None
         self.last_read = None
-
-
-    def setup(self, *, calib=None, raw=None, image=None):
+        ## The RawImage the last subpage was read into
+        self.last_raw = None
+        self._hold = False
+        ## The BadPixelMap of the pixels flagged in the EEPROM, made by setup()
+        self.bad_pixels = None
+
+
+    ## Allocate the image buffers, and in calibrated mode the calibration.
+    #  @param   calibrated Also produce compensated data from which real
+    #           temperatures can be computed (see ProcessedImage for the
+    #           memory this takes); by default only raw counts are produced
+    #  @param   calib_cache The calibration cache file used in calibrated
+    #           mode, or @c None to always build the calibration
+    def setup(self, *, calib=None, raw=None, image=None, calibrated=False,
+              calib_cache=CALIB_CACHE_PATH):
         # We've been having some memory allocation errors which usually happen
         # as this method runs. As a workaround, run gc.collect() to keep memory
         # cleaned up, as when the process is finished, there is more free
         # memory available. Also running from frozen bytecode helps a lot
-#         self.calib = calib or CameraCalibration(self.iface, self.eeprom)
         self.raw = raw or RawImage()
         collect()
-#         self.image = image or ProcessedImage(self.calib)
+        if calibrated or calib or image:
+            if calib:
+                self.calib = calib
+            elif self.calib is None:
+                self.load_calibration(calib_cache)
+            collect()
+            self.image = image or ProcessedImage(self.calib)
+            collect()
+        if self.bad_pixels is None:
+            if self.calib is not None:
+                self.bad_pixels = BadPixelMap(self.calib.failed
+                                              + self.calib.outliers)
+            else:
+                self.bad_pixels = BadPixelMap.from_eeprom(self.eeprom_iface)
+
+
+    ## Build the camera's calibration, loading it instead from a cache file
+    #  made on an earlier boot when the cache matches this camera's EEPROM.
+    #  A freshly built calibration is saved to the cache for next time.
+    #  @param   cache_path The cache file, or @c None to always build
+    #  @returns The CameraCalibration, which is also kept as @c self.calib
+    def load_calibration(self, cache_path=CALIB_CACHE_PATH, *, emissivity=1,
+                         use_tgc=False):
+        # imported here so that the raw driver doesn't pay for them
+        from mlx90640.calibration import CameraCalibration
+        from mlx90640.calib_cache import eeprom_checksum, load_cache, save_cache
+
+        calib = None
+        if cache_path:
+            key = eeprom_checksum(self.eeprom_data or read_eeprom(self.iface))
+            collect()
+            calib = load_cache(cache_path, key, emissivity=emissivity,
+                               use_tgc=use_tgc)
+
+        if calib is None:
+            calib = CameraCalibration(self.eeprom_iface, self.eeprom,
+                                      emissivity=emissivity, use_tgc=use_tgc)
+            if cache_path:
+                try:
+                    save_cache(calib, cache_path, key)
+                except OSError:
+                    # a read-only filesystem just means no cache next boot
+                    pass
+
+        self.calib = calib
+        collect()
+        return calib
 
 
     @property
@@ -97,6 +177,48 @@ class MLX90640:
         self.registers['refresh_rate'] = RefreshRate.from_freq(freq)
 
 
+    ## The ADC resolution in bits, 16 to 19. More bits give less noise in
+    #  the raw counts but take longer to convert.
+    @property
+    def adc_resolution(self):
+        return self.registers['adc_resolution'] + 16
+
+    @adc_resolution.setter
+    def adc_resolution(self, bits):
+        self.registers['adc_resolution'] = min(max(bits, 16), 19) - 16
+
+
+    ## Set the refresh rate, ADC resolution and FM+ (1 MHz I2C) mode
+    #  together, writing each register at most once. Settings left as
+    #  @c None aren't changed.
+    #  @returns The number of registers written
+    def configure(self, *, refresh_rate=None, adc_resolution=None,
+                  fmplus=None):
+        fields = {}
+        if refresh_rate is not None:
+            fields['refresh_rate'] = RefreshRate.from_freq(refresh_rate)
+        if adc_resolution is not None:
+            fields['adc_resolution'] = min(max(adc_resolution, 16), 19) - 16
+        if fmplus is not None:
+            fields['fmplus_enable'] = int(fmplus)
+        return self.registers.update(fields)
+
+
+    ## Whether the camera holds a subpage in RAM until it has been read.
+    #  Normally each subpage measured replaces the last one, even while it
+    #  is being read; with data_hold on, read_image() lets the camera move
+    #  the next subpage into RAM only as it acknowledges the data, so a
+    #  burst read can't be overwritten halfway. Data read late is older.
+    @property
+    def data_hold(self):
+        return bool(self.registers['data_hold'])
+
+    @data_hold.setter
+    def data_hold(self, hold):
+        self.registers['data_hold'] = int(hold)
+        self._hold = bool(hold)
+
+
     def get_pattern(self):
         return get_pattern_by_id(self.registers['read_pattern'])
 
@@ -105,47 +227,39 @@ class MLX90640:
         self.registers['read_pattern'] = pat.pattern_id
 
 
-    ## Turned off to save memory for raw driver version.
+    ## The read_* measurements below need the calibration, so they are only
+    #  available after setup(calibrated=True) or load_calibration().
+
     def read_vdd(self):
         # supply voltage calculation (delta Vdd)
         # type: (self) -> float
         vdd_pix = self.registers['vdd_pix'] * self._adc_res_corr()
-#         return float(vdd_pix - self.calib.vdd_25)/self.calib.k_vdd
-        return float(vdd_pix)
+        return float(vdd_pix - self.calib.vdd_25)/self.calib.k_vdd
 
 
-    ## Turned off to save memory for raw driver version.
     def _adc_res_corr(self):
         # type: (self) -> float
-#         res_exp = self.calib.res_ee - self.registers['adc_resolution']
-#         return 1 << res_exp
-        return 0
+        res_exp = self.calib.res_ee - self.registers['adc_resolution']
+        return 2.0**res_exp
 
 
-    ## Turned off to save memory for raw driver version.
-    def read_ta(self):
+    def read_ta(self, vdd=None):
         # ambient temperature calculation (delta Ta in degC)
         # type: (self) -> float
+        if vdd is None:
+            vdd = self.read_vdd()
         v_ptat = self.registers['ta_ptat']
         v_be = self.registers['ta_vbe']
-#         v_ptat_art = v_ptat/(v_ptat*self.calib.alpha_ptat + v_be) * 262144
-# 
-#         v_ta = v_ptat_art/(1.0 + self.calib.kv_ptat*self.read_vdd() - self.calib.ptat_25)
+        v_ptat_art = v_ptat/(v_ptat*self.calib.alpha_ptat + v_be) * 262144
 
-        # print('v_ptat: ', v_ptat)
-        # print('v_be:', v_be)
-        # print('v_ptat_art: ', v_ptat_art)
+        v_ta = v_ptat_art/(1.0 + self.calib.kv_ptat*vdd) - self.calib.ptat_25
+        return v_ta/self.calib.kt_ptat
 
-#         return v_ta/self.calib.kt_ptat
-        return 0.0
 
-
-    ## Turned off to save memory for raw driver version.
     def read_gain(self):
         # gain calculation
         # type: (self) -> float
-#         return self.calib.gain / self.registers['gain']
-        return float(self.registers['gain'])
+        return self.calib.gain / self.registers['gain']
 
 
     # tr - temperature of reflected environment
@@ -156,19 +270,20 @@ class MLX90640:
         cp_sp_0 = gain * self.registers['cp_sp_0']
         cp_sp_1 = gain * self.registers['cp_sp_1']
 
-        ta = self.read_ta()
+        vdd = self.read_vdd()
+        ta = self.read_ta(vdd)
 
         ta_abs = ta + 25
-#         if self.calib.emissivity == 1:
-        ta_r = (ta_abs + TEMP_K)**4
-#         else:
-#             tr = tr if tr is not None else ta_abs - 8
-#             ta_k4 = (ta_abs + TEMP_K)**4
-#             tr_k4 = (tr + TEMP_K)**4
-#             ta_r = tr_k4 - (tr_k4 - ta_k4)/self.calib.emissivity
+        if self.calib.emissivity == 1:
+            ta_r = (ta_abs + TEMP_K)**4
+        else:
+            tr = tr if tr is not None else ta_abs - 8
+            ta_k4 = (ta_abs + TEMP_K)**4
+            tr_k4 = (tr + TEMP_K)**4
+            ta_r = tr_k4 - (tr_k4 - ta_k4)/self.calib.emissivity
 
         return CameraState(
-            vdd = self.read_vdd(),
+            vdd = vdd,
             ta = ta,
             ta_r = ta_r,
             gain = gain,
@@ -176,6 +291,12 @@ class MLX90640:
         )
 
 
+    ## Read the (volatile) status register once, so that data_available and
+    #  last_subpage can both be checked from a single I2C read.
+    def read_status(self):
+        return self.registers.snapshot('data_available')
+
+
     ## Report whether there's data available from the camera.
     @property
     def has_data(self):
@@ -187,37 +308,84 @@ class MLX90640:
         return self.registers['last_subpage']
 
 
-    def read_image(self, sp_id = None):
-        if not self.has_data:
+    ## Read the subpage which is available from the camera.
+    #  @param   sp_id The subpage to read, default the last one measured
+    #  @param   status A status snapshot just taken with read_status(), to
+    #           save reading the status register again
+    #  @param   raw The RawImage to read into, such as a slot of a FrameRing;
+    #           default @c self.raw, which is left alone otherwise
+    #  @param   roi A Roi to read only the pixels inside of, in row bursts;
+    #           default the whole subpage
+    #  @returns The RawImage read into, also kept as @c last_raw
+    def read_image(self, sp_id = None, status = None, raw = None, roi = None):
+        status = status or self.read_status()
+        if not status['data_available']:
             raise DataNotAvailableError
 
         if sp_id is None:
-            sp_id = self.last_subpage
+            sp_id = status['last_subpage']
 
-        subpage = Subpage(self.get_pattern(), sp_id)
+        subpage = self.get_pattern().subpage(sp_id)
         self.last_read = subpage
+        if raw is None:
+            raw = self.raw
+        self.last_raw = raw
 
         # print(f"read SP {subpage.id}")
-        self.raw.read(self.iface, subpage.sp_range())
-        self.registers['data_available'] = 0
-        return self.raw
-
-
-#     def process_image(self, sp_id = None, state = None):
-#         """!
-#         """
-#         if self.last_read is None:
-#             raise DataNotAvailableError
-# 
-#         subpage = self.last_read
-#         if sp_id is not None:
-#             subpage.id = sp_id
-# 
-#         state = state or self.read_state()
-# 
-#         # print(f"process SP {subpage.id}")
-#         raw_data = ((idx, self.raw[idx]) for idx in subpage.sp_range())
-#         self.image.update(raw_data, subpage, state)
-#         return self.image
+        if roi is None:
+            raw.read(self.iface, subpage.sp_range(), subpage.sp_spans())
+        else:
+            pattern = subpage.pattern
+            raw.read(self.iface, roi.sp_table(pattern, sp_id),
+                     roi.sp_spans(pattern, sp_id))
+        # acknowledge by writing back the status we already hold
+        status['data_available'] = 0
+        if self._hold:
+            # let the camera move the next subpage into RAM
+            status['overwrite_enable'] = 1
+        self.registers.commit(status)
+        return raw
+
+
+    ## Compensate the subpage most recently read into temperature-ready
+    #  data in @c self.image; only that subpage's pixels are updated.
+    #  @param   state The CameraState to compensate with, default a fresh one
+    def process_image(self, sp_id = None, state = None):
+        if self.last_read is None:
+            raise DataNotAvailableError
+
+        subpage = self.last_read
+        if sp_id is not None:
+            subpage = subpage.pattern.subpage(sp_id)
+
+        state = state or self.read_state()
 
+        # print(f"process SP {subpage.id}")
+        self.image.update(self.last_raw, subpage, state)
+        return self.image
+
+
+    ## Make a TemperatureWindow for this camera; needs the calibration.
+    #  @param   t_min The lowest temperature to detect in degC, or @c None
+    #  @param   t_max The highest temperature to detect in degC, or @c None
+    def temperature_window(self, t_min=None, t_max=None):
+        # imported here so that the raw driver doesn't pay for it
+        from mlx90640.detect import TemperatureWindow
+        if self.calib is None:
+            self.load_calibration()
+        return TemperatureWindow(self.calib, t_min, t_max)
+
+
+    ## Find the pixels of the subpage most recently read whose temperature
+    #  is inside a window, without converting the image to temperatures.
+    #  @param   window A TemperatureWindow from temperature_window()
+    #  @param   state The CameraState to use, default a fresh one
+    #  @returns The number of pixels in the window, which are marked in
+    #           @c window.mask
+    def detect_window(self, window, state = None):
+        if self.last_read is None:
+            raise DataNotAvailableError
 
+        subpage = self.last_read
+        window.update(subpage.pattern, state or self.read_state(), subpage.id)
+        return window.classify(self.last_raw, subpage.sp_range())
@@ -0,0 +1,211 @@
+## @file badpix.py
+#  This file contains a map of the camera's bad pixels, which replaces each
+#  one by the mean of its good neighbours, so that a dead or stuck-hot pixel
+#  doesn't win a search for the hottest spot.
+#
+#  The pixels flagged in the EEPROM (failed or outlier) are known at boot.
+#  Pixels which go bad later can be found from frame statistics with
+#  observe(). The neighbours of every bad pixel are worked out once, when
+#  the map changes, so patching a frame costs a few additions per bad pixel.
+
+from mlx90640.utils import const, array_filled
+from mlx90640.regmap import REG_SIZE, MemoryInterface
+from mlx90640.calibration import (
+    NUM_ROWS,
+    NUM_COLS,
+    IMAGE_SIZE,
+    PIX_CALIB_ADDRESS,
+    PIX_CALIB_PROTO,
+)
+
+## A pixel whose raw count is the same this many observations running is
+#  taken to be stuck
+STUCK_OBSERVATIONS = const(16)
+## A pixel this many counts hotter or colder than both its neighbours in the
+#  row is out of line...
+HOT_COUNTS = const(2000)
+## ...and if it is out of line this many observations running, it is bad
+HOT_OBSERVATIONS = const(32)
+## At most this many pixels are added to the map by observe()
+MAX_FOUND = const(8)
+
+
+class BadPixelMap:
+    ## @param   pixels The indices of the bad pixels
+    #  @param   max_found The most pixels observe() may add
+    def __init__(self, pixels=(), max_found=MAX_FOUND):
+        ## The indices of the bad pixels
+        self.pixels = []
+        ## 1 for each bad pixel, for searches which skip them
+        self.mask = bytearray(IMAGE_SIZE)
+        ## Pixels added by observe()
+        self.found = []
+        self.max_found = max_found
+        # for each bad pixel, the tuple of its good neighbours
+        self._neighbours = ()
+        # observe() statistics, allocated on its first call
+        self._last = None
+        self._still = None
+        self._hot = None
+        for idx in pixels:
+            self._mark(idx)
+        self._build()
+
+    ## Make the map of the pixels flagged in the camera's EEPROM: those
+    #  whose calibration failed (an all-zero word) and the outliers.
+    #  @param   iface The EEPROM's interface, preferably a MemoryInterface
+    @classmethod
+    def from_eeprom(cls, iface, max_found=MAX_FOUND):
+        size = IMAGE_SIZE * REG_SIZE
+        if isinstance(iface, MemoryInterface):
+            data = iface.view(PIX_CALIB_ADDRESS, size)
+        else:
+            data = bytearray(size)
+            iface.read_block(PIX_CALIB_ADDRESS, data)
+
+        shift, mask, _ = PIX_CALIB_PROTO.fields['outlier']
+        outlier = mask << shift
+        pixels = []
+        for idx in range(IMAGE_SIZE):
+            word = data[idx*REG_SIZE] << 8 | data[idx*REG_SIZE + 1]
+            if not word or word & outlier:
+                pixels.append(idx)
+        return cls(pixels, max_found)
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def __contains__(self, idx):
+        return bool(self.mask[idx])
+
+    def _mark(self, idx):
+        if not self.mask[idx]:
+            self.mask[idx] = 1
+            self.pixels.append(idx)
+
+    # work out the good neighbours of every bad pixel, within the image
+    def _build(self):
+        mask = self.mask
+        neighbours = []
+        for idx in self.pixels:
+            row = idx // NUM_COLS
+            col = idx - row*NUM_COLS
+            good = []
+            for n_row in range(max(row - 1, 0), min(row + 2, NUM_ROWS)):
+                for n_col in range(max(col - 1, 0), min(col + 2, NUM_COLS)):
+                    n_idx = n_row*NUM_COLS + n_col
+                    if not mask[n_idx]:
+                        good.append(n_idx)
+            neighbours.append(tuple(good))
+        self._neighbours = tuple(neighbours)
+
+    ## Add a pixel to the map.
+    def add(self, idx):
+        if not self.mask[idx]:
+            self._mark(idx)
+            self._build()
+
+    ## Replace each bad pixel by the mean of its good neighbours.
+    #  @param   values An array of the whole image: raw counts in an
+    #           @c array('h'), or e.g. ProcessedImage.buf in an @c array('f')
+    #  @returns @c values
+    def patch(self, values):
+        if not self.pixels:
+            return values
+        integer = isinstance(values[0], int)
+        for (idx, good) in zip(self.pixels, self._neighbours):
+            if not good:
+                continue
+            total = 0
+            for n_idx in good:
+                total += values[n_idx]
+            values[idx] = total // len(good) if integer else total / len(good)
+        return values
+
+    ## Look for pixels which have gone bad, from the raw counts of a whole
+    #  frame. A pixel is added to the map once its count hasn't changed for
+    #  STUCK_OBSERVATIONS calls, or once it has been more than HOT_COUNTS
+    #  away from both its neighbours in the row for HOT_OBSERVATIONS calls.
+    #  This walks the whole frame, so call it now and then, e.g. every few
+    #  frames, and before patch().
+    #  @param   pix The raw counts, an @c array('h')
+    #  @returns The number of pixels added
+    def observe(self, pix):
+        if self._last is None:
+            self._last = array_filled('h', IMAGE_SIZE)
+            self._still = bytearray(IMAGE_SIZE)
+            self._hot = bytearray(IMAGE_SIZE)
+        last = self._last
+        still = self._still
+        hot = self._hot
+        mask = self.mask
+        added = 0
+        for idx in range(IMAGE_SIZE):
+            value = pix[idx]
+            if value == last[idx]:
+                if still[idx] < 255:
+                    still[idx] += 1
+            else:
+                still[idx] = 0
+                last[idx] = value
+
+            col = idx % NUM_COLS
+            left = pix[idx - 1] if col else pix[idx + 1]
+            right = pix[idx + 1] if col < NUM_COLS - 1 else pix[idx - 1]
+            if ((value - left > HOT_COUNTS and value - right > HOT_COUNTS)
+                    or (left - value > HOT_COUNTS and right - value > HOT_COUNTS)):
+                if hot[idx] < 255:
+                    hot[idx] += 1
+            else:
+                hot[idx] = 0
+
+            if (not mask[idx] and len(self.found) < self.max_found
+                    and (still[idx] >= STUCK_OBSERVATIONS
+                         or hot[idx] >= HOT_OBSERVATIONS)):
+                self._mark(idx)
+                self.found.append(idx)
+                added += 1
+        if added:
+            self._build()
+        return added
+
+
+## Check that bad pixels are patched from their good neighbours, at the
+#  edges too, and that a stuck pixel is found by observe().
+def test_bad_pixel_map():
+    from array import array
+    pix = array('h', range(IMAGE_SIZE))
+    corner = 0
+    pair = (5*NUM_COLS + 7, 5*NUM_COLS + 8)
+    bad = BadPixelMap((corner,) + pair)
+    assert bad._neighbours[0] == (1, NUM_COLS, NUM_COLS + 1)
+    bad.patch(pix)
+    assert pix[corner] == (1 + NUM_COLS + NUM_COLS + 1)//3
+    # neighbours of a pixel in a linear ramp average to the pixel itself,
+    # except for the bad one left out
+    for idx in pair:
+        other = pair[1] if idx == pair[0] else pair[0]
+        good = [n for n in (idx - NUM_COLS - 1, idx - NUM_COLS, idx - NUM_COLS + 1,
+                            idx - 1, idx + 1,
+                            idx + NUM_COLS - 1, idx + NUM_COLS, idx + NUM_COLS + 1)
+                if n != other]
+        assert pix[idx] == sum(good)//len(good)
+
+    values = array('f', (float(idx) for idx in range(IMAGE_SIZE)))
+    bad.patch(values)
+    assert abs(values[pair[0]] - 5*NUM_COLS - 7 + 1/7) < 1e-3
+
+    # a stuck pixel in a noisy image
+    watch = BadPixelMap()
+    frame = array('h', bytes(2*IMAGE_SIZE))
+    for step in range(STUCK_OBSERVATIONS + 2):
+        for idx in range(IMAGE_SIZE):
+            frame[idx] = (idx*7 + step*13) % 50
+        frame[300] = 1234
+        watch.observe(frame)
+    assert watch.found == [300], watch.found
+    print("BadPixelMap OK")
+
+
+if __name__ == "__main__":
+    test_bad_pixel_map()
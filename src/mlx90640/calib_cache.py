@@ -0,0 +1,234 @@
+## @file calib_cache.py
+#  This file contains a compact binary cache of the derived calibration data
+#  of one MLX90640 camera, so that the per-pixel coefficients don't have to
+#  be rebuilt from the EEPROM at every boot.
+#
+#  The cache is keyed by a checksum of the whole EEPROM, so a file made for
+#  one camera is never applied to another. It can be made on the board the
+#  first time a calibration is built, or on a PC from a raw EEPROM dump with
+#  @c tools/build_calib_cache.py.
+#
+#  File layout, all little-endian:
+#  @code
+#  header    magic, version, flags, pixel count, EEPROM checksum,
+#            outlier/failed counts
+#  int32     _INT_SCALARS
+#  float32   _FLOAT_SCALARS, the flattened _FLOAT_TUPLES, then kv_avg
+#  int16     pix_os_ref[IMAGE_SIZE]
+#  uint8     pix_kta_class[IMAGE_SIZE]
+#  float32   pix_alpha[IMAGE_SIZE]
+#  uint16    outliers[], failed[]
+#  @endcode
+
+import struct
+from mlx90640.utils import const, array_filled
+from mlx90640.regmap import REG_SIZE
+from mlx90640.calibration import CameraCalibration, IMAGE_SIZE, KTA_CLASSES
+
+
+CACHE_MAGIC = b'MLXC'
+CACHE_VERSION = const(3)
+
+_HEADER_FMT = '<4sBBHIHH'
+_FLAG_TGC = const(0x01)
+
+# calibration attributes stored as integers, because they are used as such
+_INT_SCALARS = (
+    'k_vdd', 'vdd_25', 'res_ee', 'ptat_25', 'gain',
+    'kta_scale_1', 'kta_scale_2', 'kv_scale', 'ksto_scale',
+)
+_FLOAT_SCALARS = (
+    'kv_ptat', 'kt_ptat', 'alpha_ptat', 'ksta',
+    'il_chess_c1', 'il_chess_c2', 'il_chess_c3', 'drift',
+)
+_TGC_SCALARS = ('tgc', 'kta_cp', 'kv_cp')
+
+# (name, length) of the tuple attributes, stored flattened
+_FLOAT_TUPLES = (
+    ('kta_table', KTA_CLASSES), ('ksto', 4), ('ct', 4), ('alpha_ext', 4),
+)
+_TGC_TUPLES = (('pix_os_cp', 2), ('pix_alpha_cp', 2))
+
+
+## Compute the Fletcher-32 checksum of an EEPROM image, used as the cache key.
+#  @param   buf The EEPROM's big-endian words, as from regmap.read_eeprom()
+def eeprom_checksum(buf):
+    sum1 = 0xFFFF
+    sum2 = 0xFFFF
+    for offset in range(0, len(buf), REG_SIZE):
+        sum1 = (sum1 + (buf[offset] << 8 | buf[offset + 1])) % 0xFFFF
+        sum2 = (sum2 + sum1) % 0xFFFF
+    return sum2 << 16 | sum1
+
+
+def _float_names(use_tgc):
+    names = _FLOAT_SCALARS + (_TGC_SCALARS if use_tgc else ())
+    tuples = _FLOAT_TUPLES + (_TGC_TUPLES if use_tgc else ())
+    return names, tuples
+
+
+## Write the derived data of a calibration to a cache file.
+#  @param   calib The CameraCalibration to store
+#  @param   path Where to write the cache
+#  @param   key The EEPROM checksum of the camera the calibration belongs to
+def save_cache(calib, path, key):
+    names, tuples = _float_names(calib.use_tgc)
+
+    ints = array_filled('i', len(_INT_SCALARS))
+    for i, name in enumerate(_INT_SCALARS):
+        ints[i] = getattr(calib, name)
+
+    floats = [getattr(calib, name) for name in names]
+    for name, _ in tuples:
+        floats.extend(getattr(calib, name))
+    # kv_avg is indexed by [row % 2][col % 2]
+    for kv_row in calib.kv_avg:
+        floats.extend(kv_row)
+    floats = _to_array('f', floats)
+
+    flags = _FLAG_TGC if calib.use_tgc else 0
+    with open(path, 'wb') as f:
+        f.write(struct.pack(_HEADER_FMT, CACHE_MAGIC, CACHE_VERSION, flags,
+                            len(calib.pix_os_ref), key, len(calib.outliers),
+                            len(calib.failed)))
+        f.write(ints)
+        f.write(floats)
+        f.write(calib.pix_os_ref)
+        f.write(calib.pix_kta_class)
+        f.write(calib.pix_alpha)
+        f.write(_to_array('H', calib.outliers))
+        f.write(_to_array('H', calib.failed))
+
+
+def _to_array(typecode, values):
+    arr = array_filled(typecode, len(values))
+    for i, value in enumerate(values):
+        arr[i] = value
+    return arr
+
+
+## Load a calibration from a cache file.
+#  @param   path The cache file to read
+#  @param   key The EEPROM checksum of the attached camera
+#  @param   emissivity The emissivity to use with the loaded calibration
+#  @param   use_tgc Whether the calibration must include the thermal
+#           gradient compensation data
+#  @returns A CameraCalibration, or @c None if there is no usable cache for
+#           this camera and these options, or the file doesn't hold exactly
+#           one image's worth of pixel data
+def load_cache(path, key, *, emissivity=1, use_tgc=False):
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+
+    with f:
+        header = f.read(struct.calcsize(_HEADER_FMT))
+        if len(header) != struct.calcsize(_HEADER_FMT):
+            return None
+        magic, version, flags, n_pixels, cache_key, n_outliers, n_failed = \
+            struct.unpack(_HEADER_FMT, header)
+        if (magic != CACHE_MAGIC or version != CACHE_VERSION
+                or cache_key != key or bool(flags & _FLAG_TGC) != use_tgc
+                or n_pixels != IMAGE_SIZE):
+            return None
+
+        names, tuples = _float_names(use_tgc)
+        n_floats = len(names) + sum(n for _, n in tuples) + 4
+
+        # preallocate everything, then fill straight from the file
+        ints = array_filled('i', len(_INT_SCALARS))
+        floats = array_filled('f', n_floats)
+        pix_os_ref = array_filled('h', IMAGE_SIZE)
+        pix_kta_class = array_filled('B', IMAGE_SIZE)
+        pix_alpha = array_filled('f', IMAGE_SIZE)
+        outliers = array_filled('H', n_outliers)
+        failed = array_filled('H', n_failed)
+        # (array, item size) pairs, as array.itemsize is missing on MicroPython
+        for arr, size in ((ints, 4), (floats, 4), (pix_os_ref, 2),
+                          (pix_kta_class, 1), (pix_alpha, 4),
+                          (outliers, 2), (failed, 2)):
+            if f.readinto(arr) != len(arr) * size:
+                return None
+        # nor any more than that
+        if f.read(1):
+            return None
+
+    values = {}
+    for i, name in enumerate(_INT_SCALARS):
+        values[name] = ints[i]
+    pos = 0
+    for name in names:
+        values[name] = floats[pos]
+        pos += 1
+    for name, length in tuples:
+        values[name] = tuple(floats[pos:pos + length])
+        pos += length
+    values['kv_avg'] = (tuple(floats[pos:pos + 2]),
+                        tuple(floats[pos + 2:pos + 4]))
+
+    try:
+        return CameraCalibration.from_cache(
+            values, pix_os_ref, pix_alpha, pix_kta_class, outliers, failed,
+            emissivity=emissivity, use_tgc=use_tgc)
+    except ValueError:
+        return None
+
+
+
+## Save the calibration of a made-up EEPROM and load it back, then check
+#  that a cache for another EEPROM, or with the wrong amount of pixel data,
+#  is turned down.
+def test_calib_cache(path='test_calib.bin'):
+    import os
+    from mlx90640.calibration import sample_eeprom
+    from mlx90640.regmap import MemoryInterface, RegisterMap, EEPROM_MAP
+
+    buf = sample_eeprom()
+    iface = MemoryInterface(buf)
+    calib = CameraCalibration(iface, RegisterMap(iface, EEPROM_MAP,
+                                                 readonly=True))
+    key = eeprom_checksum(buf)
+    assert key != eeprom_checksum(sample_eeprom(seed=2))
+    try:
+        save_cache(calib, path, key)
+        loaded = load_cache(path, key)
+        assert loaded is not None
+        assert list(loaded.pix_os_ref) == list(calib.pix_os_ref)
+        assert list(loaded.pix_kta_class) == list(calib.pix_kta_class)
+        for (a, b) in zip(loaded.pix_alpha, calib.pix_alpha):
+            assert abs(a - b) <= abs(b)*1e-6, (a, b)
+        for (a, b) in zip(loaded.kta_table, calib.kta_table):
+            assert abs(a - b) <= abs(b)*1e-6, (a, b)
+        assert loaded.outliers == calib.outliers
+        assert loaded.failed == calib.failed
+        assert load_cache(path, key ^ 1) is None
+        assert load_cache(path, key, use_tgc=True) is None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        size = struct.calcsize(_HEADER_FMT)
+        header = list(struct.unpack(_HEADER_FMT, data[:size]))
+        # the key matches, but the pixel count doesn't
+        header[3] = IMAGE_SIZE - 1
+        for wrong in (struct.pack(_HEADER_FMT, *header) + data[size:],
+                      data[:-2], data + bytes(2)):
+            with open(path, 'wb') as f:
+                f.write(wrong)
+            assert load_cache(path, key) is None, len(wrong)
+    finally:
+        os.remove(path)
+
+    try:
+        CameraCalibration.from_cache({}, calib.pix_os_ref[1:], calib.pix_alpha,
+                                     calib.pix_kta_class, (), ())
+    except ValueError:
+        pass
+    else:
+        assert False, "short pixel array accepted"
+    print("calibration cache OK")
+
+
+if __name__ == "__main__":
+
+    test_calib_cache()
@@ -1,10 +1,19 @@
 from array import array
 from mlx90640.utils import (
-    Struct, 
+    const,
+    Struct,
     StructProto,
     field_desc,
+    array_filled,
+    words_from_be,
+)
+from mlx90640.regmap import (
+    REG_SIZE,
+    EEPROM_ADDRESS,
+    EEPROM_SIZE,
+    MemoryInterface,
+    read_eeprom,
 )
-from mlx90640.regmap import REG_SIZE
 
 NUM_ROWS = const(24)
 NUM_COLS = const(32)
@@ -16,33 +25,28 @@ OCC_COLS_ADDRESS = const(0x2418)
 ACC_ROWS_ADDRESS = const(0x2422)
 ACC_COLS_ADDRESS = const(0x2428)
 
-CC_PROTO = StructProto((
-    field_desc('0', 4,  0, signed=True),
-    field_desc('1', 4,  4, signed=True),
-    field_desc('2', 4,  8, signed=True),
-    field_desc('3', 4, 12, signed=True),
-))
-
-def _read_cc_iter(iface, base, size):
-    buf = bytearray(REG_SIZE)
-    struct = Struct(buf, CC_PROTO)
-    for addr_off in range(size // 4):
-        cc_addr = base + addr_off
-        iface.read_into(cc_addr, buf)
-        yield struct['0']
-        yield struct['1']
-        yield struct['2']
-        yield struct['3']
-
+## Decode the 4 bit signed row or column corrections packed four to a word,
+#  least significant first, from an array of EEPROM words.
+def cc_values(words, address, count):
+    values = []
+    for k in range(count):
+        value = (words[address - EEPROM_ADDRESS + k//4] >> 4*(k % 4)) & 0xF
+        if value & 0x8:
+            value -= 0x10
+        values.append(value)
+    return values
+
+## The row and column corrections, decoded with cc_values() from the EEPROM
+#  words, see eeprom_words(); build_pixels() applies them itself.
 def read_occ_rows(iface):
-    return _read_cc_iter(iface, OCC_ROWS_ADDRESS, NUM_ROWS)
+    return iter(cc_values(eeprom_words(iface), OCC_ROWS_ADDRESS, NUM_ROWS))
 def read_occ_cols(iface):
-    return _read_cc_iter(iface, OCC_COLS_ADDRESS, NUM_COLS)
+    return iter(cc_values(eeprom_words(iface), OCC_COLS_ADDRESS, NUM_COLS))
 
 def read_acc_rows(iface):
-    return _read_cc_iter(iface, ACC_ROWS_ADDRESS, NUM_ROWS)
+    return iter(cc_values(eeprom_words(iface), ACC_ROWS_ADDRESS, NUM_ROWS))
 def read_acc_cols(iface):
-    return _read_cc_iter(iface, ACC_COLS_ADDRESS, NUM_COLS)
+    return iter(cc_values(eeprom_words(iface), ACC_COLS_ADDRESS, NUM_COLS))
 
 PIX_CALIB_PROTO = StructProto((
     field_desc('offset',  6, 10, signed=True),
@@ -54,21 +58,22 @@ PIX_CALIB_PROTO = StructProto((
 PIX_CALIB_ADDRESS = const(0x2440)
 
 
+## The per-pixel calibration words, one Struct of PIX_CALIB_PROTO per pixel.
+#  @details Kept for code written against it; CameraCalibration decodes
+#           every pixel at once with build_pixels() instead. Given a
+#           MemoryInterface the words are viewed in place, otherwise they
+#           are fetched with one read_block().
 class PixelCalibrationData:
     def __init__(self, iface):
-        pix_count = NUM_ROWS * NUM_COLS
-        self._data = bytearray(pix_count * REG_SIZE)
-
-        failed = []
-        buf = bytearray(REG_SIZE)
-        for idx in range(pix_count):
-            offset = idx * REG_SIZE
-            iface.read_into(PIX_CALIB_ADDRESS + offset, buf)
-            if buf != bytes(REG_SIZE):
-                self._data[offset:offset+REG_SIZE] = buf
-            else:
-                failed.append(idx)
-        self.failed = tuple(failed)
+        size = IMAGE_SIZE * REG_SIZE
+        if isinstance(iface, MemoryInterface):
+            self._data = iface.view(PIX_CALIB_ADDRESS, size)
+        else:
+            self._data = bytearray(size)
+            iface.read_block(PIX_CALIB_ADDRESS, self._data)
+        # an all-zero word marks a pixel which failed calibration
+        words = words_from_be(self._data)
+        self.failed = tuple(idx for idx in range(IMAGE_SIZE) if not words[idx])
 
     def __len__(self):
         return len(self._data)//REG_SIZE
@@ -79,10 +84,111 @@ class PixelCalibrationData:
         for idx in range(len(self)):
             yield self[idx]
 
+
 TEMP_K = 273.15
 
+# the 3-bit signed per-pixel kta field, times the 4 row/column parities
+KTA_EE_VALUES = const(8)
+KTA_CLASSES = const(4*8)
+
+## The whole EEPROM as an array of word values, taken from the memory of a
+#  MemoryInterface or else read from the camera.
+def eeprom_words(iface):
+    size = EEPROM_SIZE * REG_SIZE
+    if isinstance(iface, MemoryInterface):
+        return words_from_be(iface.view(EEPROM_ADDRESS, size))
+    return words_from_be(read_eeprom(iface))
+
+## The scales of the per-pixel offset and sensitivity terms:
+#  (offset_avg, occ_scale_row, occ_scale_col, occ_scale_rem,
+#   alpha_ref, alpha_scale, acc_scale_row, acc_scale_col, acc_scale_rem)
+def pixel_scales(eeprom):
+    return (
+        eeprom['pix_os_average'],
+        1 << eeprom['scale_occ_row'],
+        1 << eeprom['scale_occ_col'],
+        1 << eeprom['scale_occ_rem'],
+        eeprom['pix_sensitivity_average'],
+        1 << (eeprom['alpha_scale'] + 30),
+        1 << eeprom['scale_acc_row'],
+        1 << eeprom['scale_acc_col'],
+        1 << eeprom['scale_acc_rem'],
+    )
+
+## Build every per-pixel coefficient in one pass over the pixel words.
+#  @details The 6/6/3/1 bit fields of each pixel word are decoded with the
+#           masks compiled in PIX_CALIB_PROTO, and the row and column
+#           corrections, scaled once per row and column, are added in.
+#  @param   words The EEPROM as an array of word values, see eeprom_words()
+#  @param   eeprom A RegisterMap of the EEPROM
+#  @returns (pix_os_ref, pix_alpha, pix_kta_class, outliers, failed)
+def build_pixels(words, eeprom):
+    (offset_avg, occ_scale_row, occ_scale_col, occ_scale_rem,
+     alpha_ref, alpha_scale, acc_scale_row, acc_scale_col,
+     acc_scale_rem) = pixel_scales(eeprom)
+
+    os_rows = [offset_avg + occ*occ_scale_row
+               for occ in cc_values(words, OCC_ROWS_ADDRESS, NUM_ROWS)]
+    os_cols = [occ*occ_scale_col
+               for occ in cc_values(words, OCC_COLS_ADDRESS, NUM_COLS)]
+    alpha_rows = [alpha_ref + acc*acc_scale_row
+                  for acc in cc_values(words, ACC_ROWS_ADDRESS, NUM_ROWS)]
+    alpha_cols = [acc*acc_scale_col
+                  for acc in cc_values(words, ACC_COLS_ADDRESS, NUM_COLS)]
+
+    fields = PIX_CALIB_PROTO.fields
+    os_shift, os_mask, os_sign = fields['offset']
+    alpha_shift, alpha_mask, alpha_sign = fields['alpha']
+    kta_shift, kta_mask, kta_sign = fields['kta']
+    outlier_mask = fields['outlier'][1] << fields['outlier'][0]
+
+    pix_os_ref = array_filled('h', IMAGE_SIZE)
+    pix_alpha = array_filled('f', IMAGE_SIZE)
+    pix_kta_class = array_filled('B', IMAGE_SIZE)
+    outliers = []
+    failed = []
+    base = PIX_CALIB_ADDRESS - EEPROM_ADDRESS
+    idx = 0
+    for row in range(NUM_ROWS):
+        os_row = os_rows[row]
+        alpha_row = alpha_rows[row]
+        parity_row = (row % 2) << 1
+        for col in range(NUM_COLS):
+            word = words[base + idx]
+            if not word:
+                # an all-zero word marks a pixel which failed calibration
+                failed.append(idx)
+            if word & outlier_mask:
+                outliers.append(idx)
+
+            offset = (word >> os_shift) & os_mask
+            if offset & os_sign:
+                offset -= os_sign << 1
+            alpha = (word >> alpha_shift) & alpha_mask
+            if alpha & alpha_sign:
+                alpha -= alpha_sign << 1
+            kta = (word >> kta_shift) & kta_mask
+            if kta & kta_sign:
+                kta -= kta_sign << 1
+
+            pix_os_ref[idx] = os_row + os_cols[col] + offset*occ_scale_rem
+            pix_alpha[idx] = ((alpha_row + alpha_cols[col] + alpha*acc_scale_rem)
+                              / alpha_scale)
+            pix_kta_class[idx] = ((parity_row | col % 2)*KTA_EE_VALUES
+                                  + kta + KTA_EE_VALUES//2)
+            idx += 1
+
+    return pix_os_ref, pix_alpha, pix_kta_class, tuple(outliers), tuple(failed)
+
+
 class CameraCalibration:
-    def __init__(self, iface, eeprom, *, emissivity=1, use_tgc=False):
+    ## @param   words The EEPROM as an array of word values, default read
+    #           through @c iface
+    #  @param   pixel_builder The function which builds the per-pixel
+    #           coefficients, build_pixels() or one with the same results
+    #           such as calibration_np.build_pixels()
+    def __init__(self, iface, eeprom, *, emissivity=1, use_tgc=False,
+                 words=None, pixel_builder=build_pixels):
         self.emissivity = emissivity
 
         # restore VDD sensor parameters
@@ -101,15 +207,18 @@ class CameraCalibration:
         # gain
         self.gain = eeprom['gain']
 
-        # pixel calibration data
-        self.pix_data = PixelCalibrationData(iface)
-        self.pix_os_ref = array('h', self._calc_pix_os_ref(iface, eeprom))
-        self.outliers = tuple(idx for idx, data in enumerate(self.pix_data) if data['outlier'])
+        # pixel calibration data: offsets, sensitivities and kta classes
+        if words is None:
+            words = eeprom_words(iface)
+        (self.pix_os_ref, self.pix_alpha, self.pix_kta_class,
+         self.outliers, self.failed) = pixel_builder(words, eeprom)
 
         # IR data compensation
         self.kta_scale_1 = 1 << (eeprom['kta_scale_1'] + 8)
         self.kta_scale_2 = 1 << eeprom['kta_scale_2']
-        self.pix_kta = array('f', self._calc_pix_kta(eeprom))
+        # kta takes at most KTA_CLASSES distinct values, so each pixel stores
+        # the index of its value in kta_table rather than a float
+        self.kta_table = tuple(self._calc_kta_table(eeprom))
 
         self.kv_scale = 1 << eeprom['kv_scale']
         self.kv_avg = (
@@ -134,7 +243,6 @@ class CameraCalibration:
             self.kv_cp = eeprom['kv_cp'] / self.kv_scale
 
         # sensitivity normalization
-        self.pix_alpha = array('f', self._calc_pix_alpha_ref(iface, eeprom))
         self.ksta = eeprom['ksta'] / 8192.0
 
         if use_tgc:
@@ -148,7 +256,7 @@ class CameraCalibration:
         self.il_chess_c1 = eeprom['il_chess_c1'] / 16.0
         self.il_chess_c2 = eeprom['il_chess_c2'] / 2.0
         self.il_chess_c3 = eeprom['il_chess_c3'] / 8.0
-        self.il_offset = array('f', self._calc_il_offset())
+        self._il_offset = None
 
         # temperature calculation
         self.drift = 0  # temperature drift correction
@@ -173,58 +281,62 @@ class CameraCalibration:
         alpha_4 = alpha_3*(1.0 + ksto3*(ct4 - ct3))
         self.alpha_ext = (alpha_1, alpha_2, alpha_3, alpha_4)
 
-    def _calc_pix_os_ref(self, iface, eeprom):
-        offset_avg = eeprom['pix_os_average']
-        occ_scale_row = 1 << eeprom['scale_occ_row']
-        occ_scale_col = 1 << eeprom['scale_occ_col']
-        occ_scale_rem = 1 << eeprom['scale_occ_rem']
-
-        occ_rows = tuple(read_occ_rows(iface))
-        occ_cols = tuple(read_occ_cols(iface))
-
-        for row in range(NUM_ROWS):
-            for col in range(NUM_COLS):
-                idx = row * NUM_COLS + col
-                yield (
-                    offset_avg
-                    + occ_rows[row] * occ_scale_row
-                    + occ_cols[col] * occ_scale_col
-                    + self.pix_data[idx]['offset'] * occ_scale_rem
-                )
-
-    def _calc_pix_alpha_ref(self, iface, eeprom):
-        alpha_ref = eeprom['pix_sensitivity_average']
-        alpha_scale = 1 << (eeprom['alpha_scale'] + 30)
-        acc_scale_row = 1 << eeprom['scale_acc_row']
-        acc_scale_col = 1 << eeprom['scale_acc_col']
-        acc_scale_rem = 1 << eeprom['scale_acc_rem']
-
-        acc_rows = tuple(read_acc_rows(iface))
-        acc_cols = tuple(read_acc_cols(iface))
-
-        for row in range(NUM_ROWS):
-            for col in range(NUM_COLS):
-                idx = row * NUM_COLS + col
-                yield (
-                    alpha_ref
-                    + acc_rows[row] * acc_scale_row
-                    + acc_cols[col] * acc_scale_col
-                    + self.pix_data[idx]['alpha'] * acc_scale_rem
-                ) / alpha_scale
-
-    def _calc_pix_kta(self, eeprom):
+    ## Make a calibration from derived data saved earlier, as calib_cache
+    #  does, without reading the EEPROM.
+    #  @param   values A dict of { attribute name : value } of the scalar and
+    #           tuple coefficients
+    #  @param   pix_os_ref, pix_alpha, pix_kta_class The per-pixel arrays,
+    #           IMAGE_SIZE long
+    #  @param   outliers, failed The indices of the flagged pixels
+    #  @returns The CameraCalibration; ValueError is raised if the pixel data
+    #           doesn't fit the image
+    @classmethod
+    def from_cache(cls, values, pix_os_ref, pix_alpha, pix_kta_class,
+                   outliers, failed, *, emissivity=1, use_tgc=False):
+        for pixels in (pix_os_ref, pix_alpha, pix_kta_class):
+            if len(pixels) != IMAGE_SIZE:
+                raise ValueError(f"{len(pixels)} pixels, not {IMAGE_SIZE}")
+        for idx in tuple(outliers) + tuple(failed):
+            if not 0 <= idx < IMAGE_SIZE:
+                raise ValueError(f"no pixel {idx}")
+
+        calib = object.__new__(cls)
+        calib.emissivity = emissivity
+        calib.use_tgc = use_tgc
+        for name, value in values.items():
+            setattr(calib, name, value)
+        calib.pix_os_ref = pix_os_ref
+        calib.pix_alpha = pix_alpha
+        calib.pix_kta_class = pix_kta_class
+        calib.outliers = tuple(outliers)
+        calib.failed = tuple(failed)
+        calib._il_offset = None
+        return calib
+
+    ## Per-pixel offsets for the interleaved read pattern, built on first use
+    #  as the chess pattern (the default) never needs them.
+    @property
+    def il_offset(self):
+        if self._il_offset is None:
+            self._il_offset = array('f', self._calc_il_offset())
+        return self._il_offset
+
+    ## Get the kta coefficient of one pixel.
+    def kta(self, idx):
+        return self.kta_table[self.pix_kta_class[idx]]
+
+    def _calc_kta_table(self, eeprom):
         # index by [row % 2][col % 2]
         kta_avg = (
             (eeprom['kta_avg_re_ce'], eeprom['kta_avg_re_co']),
             (eeprom['kta_avg_ro_ce'], eeprom['kta_avg_ro_co']),
         )
 
-        for row in range(NUM_ROWS):
-            for col in range(NUM_COLS):
-                idx = row * NUM_COLS + col
-                kta_ee = self.pix_data[idx]['kta']
-                kta_rc = kta_avg[row % 2][col % 2]
-                yield (kta_rc + kta_ee * self.kta_scale_2)/self.kta_scale_1
+        for kta_cls in range(KTA_CLASSES):
+            parity, kta_ee = divmod(kta_cls, KTA_EE_VALUES)
+            kta_rc = kta_avg[parity >> 1][parity & 1]
+            kta_ee -= KTA_EE_VALUES//2
+            yield (kta_rc + kta_ee * self.kta_scale_2)/self.kta_scale_1
 
     def _calc_il_offset(self):
         for idx in range(NUM_ROWS*NUM_COLS):
@@ -237,3 +349,76 @@ class CameraCalibration:
                 self.il_chess_c3*(2*il_pattern - 1) 
                 - self.il_chess_c2*conv_pattern
             )
+
+
+# the calibration words of sample_eeprom(), from the datasheet's example
+# where it gives one; the rest are zero
+_SAMPLE_WORDS = {
+    0x2410: 0x4222, 0x2411: 0xFFC0, 0x2420: 0x7423, 0x2421: 0x3000,
+    0x2430: 0x1800, 0x2431: 0x2FF1, 0x2432: 0x5952, 0x2433: 0x9D68,
+    0x2434: 0x2222, 0x2436: 0x5354, 0x2437: 0x5354, 0x2438: 0x2363,
+    0x2439: 0x1A33, 0x243A: 0xF020, 0x243B: 0x2F44, 0x243C: 0xF020,
+    0x243D: 0x9D9D, 0x243E: 0x9D9D, 0x243F: 0x2949,
+}
+
+## Make up an EEPROM image with plausible calibration values, for tests
+#  which need a CameraCalibration without a camera. The pixel words are
+#  pseudo-random and none of them is flagged.
+#  @param   seed Picks the pixel words
+#  @returns A bytearray of big-endian words, for a MemoryInterface
+def sample_eeprom(seed=1):
+    buf = bytearray(EEPROM_SIZE * REG_SIZE)
+    for address, word in _SAMPLE_WORDS.items():
+        offset = (address - EEPROM_ADDRESS) * REG_SIZE
+        buf[offset] = word >> 8
+        buf[offset + 1] = word & 0xFF
+    state = seed
+    for idx in range(IMAGE_SIZE):
+        state = (state*1103515245 + 12345) & 0x7FFFFFFF
+        # any offset, alpha and kta, but the outlier bit clear
+        word = (state >> 8) & 0xFFFE | 0x0400
+        offset = (PIX_CALIB_ADDRESS - EEPROM_ADDRESS + idx) * REG_SIZE
+        buf[offset] = word >> 8
+        buf[offset + 1] = word & 0xFF
+    return buf
+
+
+## Check that PixelCalibrationData and the read_occ_*() readers agree with
+#  the coefficients build_pixels() makes, over a bus and from memory.
+def test_pixel_calibration_data():
+    from mlx90640.regmap import CameraInterface, RegisterMap, EEPROM_MAP
+    from mlx90640.fakebus import FakeCameraBus
+
+    buf = sample_eeprom()
+    # one pixel failed and one an outlier
+    for (idx, word) in ((5, 0x0000), (70, 0x1235)):
+        offset = (PIX_CALIB_ADDRESS - EEPROM_ADDRESS + idx) * REG_SIZE
+        buf[offset] = word >> 8
+        buf[offset + 1] = word & 0xFF
+    iface = MemoryInterface(buf)
+    eeprom = RegisterMap(iface, EEPROM_MAP, readonly=True)
+    (pix_os_ref, _, _, outliers, failed) = build_pixels(eeprom_words(iface),
+                                                        eeprom)
+    bus = FakeCameraBus()
+    bus.eeprom = buf
+
+    offset_avg, scale_row, scale_col, scale_rem = pixel_scales(eeprom)[:4]
+    rows = list(read_occ_rows(iface))
+    cols = list(read_occ_cols(iface))
+    for source in (iface, CameraInterface(bus, 0x33)):
+        pixels = PixelCalibrationData(source)
+        assert len(pixels) == IMAGE_SIZE
+        assert pixels.failed == failed == (5,), pixels.failed
+        assert tuple(idx for (idx, pix) in enumerate(pixels)
+                     if pix['outlier']) == outliers == (70,)
+        for idx in range(IMAGE_SIZE):
+            (row, col) = divmod(idx, NUM_COLS)
+            assert pix_os_ref[idx] == (offset_avg + rows[row]*scale_row
+                                       + cols[col]*scale_col
+                                       + pixels[idx]['offset']*scale_rem)
+    print("PixelCalibrationData OK")
+
+
+if __name__ == "__main__":
+
+    test_pixel_calibration_data()
@@ -0,0 +1,85 @@
+## @file calibration_np.py
+#  This file contains a NumPy version of calibration.build_pixels(), for host
+#  tools on CPython which process many EEPROM dumps. It gives the same
+#  arrays as build_pixels(), so calibration caches made with it are the same.
+#  It isn't needed, or usable, on the board.
+#
+#  @code
+#  from mlx90640.calibration import CameraCalibration
+#  from mlx90640 import calibration_np
+#  calib = CameraCalibration(iface, eeprom,
+#                            pixel_builder=calibration_np.build_pixels)
+#  @endcode
+
+from array import array
+import numpy as np
+from mlx90640.regmap import EEPROM_ADDRESS
+from mlx90640.calibration import (
+    NUM_ROWS,
+    NUM_COLS,
+    IMAGE_SIZE,
+    OCC_ROWS_ADDRESS,
+    OCC_COLS_ADDRESS,
+    ACC_ROWS_ADDRESS,
+    ACC_COLS_ADDRESS,
+    PIX_CALIB_ADDRESS,
+    PIX_CALIB_PROTO,
+    KTA_EE_VALUES,
+    cc_values,
+    pixel_scales,
+)
+
+
+def _field(pix, name):
+    shift, mask, sign = PIX_CALIB_PROTO.fields[name]
+    values = (pix >> shift) & mask
+    if sign:
+        values -= (values & sign) << 1
+    return values.reshape(NUM_ROWS, NUM_COLS)
+
+
+def _cc(words, address, count):
+    return np.array(cc_values(words, address, count), dtype=np.int64)
+
+
+## Build every per-pixel coefficient with whole-array operations; the row
+#  and column corrections are broadcast across the image.
+#  @param   words The EEPROM as an array of word values, see
+#           calibration.eeprom_words()
+#  @param   eeprom A RegisterMap of the EEPROM
+#  @returns (pix_os_ref, pix_alpha, pix_kta_class, outliers, failed), typed
+#           as calibration.build_pixels() gives them
+def build_pixels(words, eeprom):
+    (offset_avg, occ_scale_row, occ_scale_col, occ_scale_rem,
+     alpha_ref, alpha_scale, acc_scale_row, acc_scale_col,
+     acc_scale_rem) = pixel_scales(eeprom)
+
+    base = PIX_CALIB_ADDRESS - EEPROM_ADDRESS
+    pix = np.asarray(words, dtype=np.int64)[base:base + IMAGE_SIZE]
+
+    os_ref = (offset_avg
+              + _cc(words, OCC_ROWS_ADDRESS, NUM_ROWS)[:, None]*occ_scale_row
+              + _cc(words, OCC_COLS_ADDRESS, NUM_COLS)[None, :]*occ_scale_col
+              + _field(pix, 'offset')*occ_scale_rem)
+
+    alpha = (alpha_ref
+             + _cc(words, ACC_ROWS_ADDRESS, NUM_ROWS)[:, None]*acc_scale_row
+             + _cc(words, ACC_COLS_ADDRESS, NUM_COLS)[None, :]*acc_scale_col
+             + _field(pix, 'alpha')*acc_scale_rem) / alpha_scale
+
+    parity = ((np.arange(NUM_ROWS) % 2)[:, None] << 1
+              | (np.arange(NUM_COLS) % 2)[None, :])
+    kta_class = (parity*KTA_EE_VALUES + _field(pix, 'kta')
+                 + KTA_EE_VALUES//2)
+
+    shift, mask, _ = PIX_CALIB_PROTO.fields['outlier']
+    outliers = np.flatnonzero((pix >> shift) & mask)
+    failed = np.flatnonzero(pix == 0)
+
+    return (
+        array('h', os_ref.astype(np.int16).tobytes()),
+        array('f', alpha.astype(np.float32).tobytes()),
+        array('B', kta_class.astype(np.uint8).tobytes()),
+        tuple(outliers.tolist()),
+        tuple(failed.tolist()),
+    )
@@ -0,0 +1,207 @@
+## @file detect.py
+#  This file contains temperature window detection which works on raw pixel
+#  counts, so that a frame can be searched for e.g. people without converting
+#  every pixel to degrees.
+#
+#  Object temperature rises monotonically with a pixel's compensated signal,
+#  which in turn is a linear function of its raw count. So as each subpage is
+#  read, the temperature window is turned into a window of raw counts for each
+#  of its pixels, and classifying the subpage is then a pair of integer
+#  comparisons per pixel.
+#  Exact temperatures are worked out only for the pixels which are found.
+
+import math
+from mlx90640.utils import const, array_filled
+from mlx90640.calibration import IMAGE_SIZE, TEMP_K
+from mlx90640.image import Compensation, InterleavedPattern
+
+RAW_MIN = const(-32768)
+RAW_MAX = const(32767)
+
+# Newton iterations used to invert the object temperature equation; it is
+# nearly linear, so this converges far below a count
+INVERT_ITERATIONS = const(3)
+
+
+## A temperature window and the raw count thresholds it works out to.
+#  @details Holds two @c array('h') of thresholds (3 kB) and a one byte per
+#           pixel mask of the last classification.
+class TemperatureWindow(Compensation):
+
+    ## @param   calib The camera's CameraCalibration
+    #  @param   t_min The lowest temperature in the window in degC, or
+    #           @c None for no lower limit
+    #  @param   t_max The highest temperature in the window in degC, or
+    #           @c None for no upper limit
+    def __init__(self, calib, t_min=None, t_max=None):
+        super().__init__(calib)
+        self.t_min = t_min
+        self.t_max = t_max
+        self.lo = array_filled('h', IMAGE_SIZE, RAW_MIN)
+        self.hi = array_filled('h', IMAGE_SIZE, RAW_MAX)
+        self.mask = bytearray(IMAGE_SIZE)
+        self.count = 0
+        # what the thresholds were last worked out for: the pattern and the
+        # CameraState of each subpage, to convert candidates
+        self._pattern = None
+        self._states = [None, None]
+        # the subpage whose factors _prepare() last worked out
+        self._prepared = None
+
+    ## Change the temperature window; thresholds are redone on next update().
+    def set_window(self, t_min=None, t_max=None):
+        self.t_min = t_min
+        self.t_max = t_max
+
+    ## Work out the raw thresholds of a subpage's pixels for a camera state.
+    #  The state drifts from one subpage to the next, so this is done every
+    #  time a subpage is read, for that subpage only; both subpages are done
+    #  when the read pattern changes.
+    #  @param   pattern The read pattern the frame was read with
+    #  @param   state The CameraState the subpage was read at
+    #  @param   sp_id The subpage just read, or @c None for both
+    def update(self, pattern, state, sp_id=None):
+        if sp_id is None or pattern is not self._pattern:
+            sp_ids = (0, 1)
+        else:
+            sp_ids = (sp_id,)
+
+        calib = self.calib
+        y_lo = self._invert_to(self.t_min, state.ta_r) if self.t_min is not None else None
+        y_hi = self._invert_to(self.t_max, state.ta_r) if self.t_max is not None else None
+
+        os_ref = calib.pix_os_ref
+        kta_cls = calib.pix_kta_class
+        pix_alpha = calib.pix_alpha
+        os_fac = self._os_fac
+        lo = self.lo
+        hi = self.hi
+        em_gain = calib.emissivity/state.gain
+        il_offset = calib.il_offset if pattern is InterleavedPattern else None
+
+        for sp_id in sp_ids:
+            subpage = pattern.subpage(sp_id)
+            self._prepare(subpage, state)
+            self._prepared = sp_id
+            self._states[sp_id] = state
+            v_ir_cp = self._v_ir_cp
+            alpha_cp = self._alpha_cp
+            alpha_fac = self._alpha_fac
+
+            for idx in subpage.sp_range():
+                # raw = base + y*scale inverts ProcessedImage.update()
+                offset = os_ref[idx]*os_fac[kta_cls[idx]]
+                if il_offset is not None:
+                    offset -= il_offset[idx]
+                base = v_ir_cp*em_gain + offset/state.gain
+                scale = (pix_alpha[idx] - alpha_cp)*alpha_fac*em_gain
+
+                if y_lo is not None:
+                    lo[idx] = _clamp(math.ceil(base + y_lo*scale))
+                if y_hi is not None:
+                    hi[idx] = _clamp(math.floor(base + y_hi*scale))
+
+        self._pattern = pattern
+
+    ## Find the value of v_ir/alpha at which a pixel reads a temperature.
+    def _invert_to(self, t, ta_r):
+        ksto = self.calib.ksto[1]
+        diff = (t - self.calib.drift + TEMP_K)**4 - ta_r
+        # solve v_norm = diff*(1 - TEMP_K*ksto + ksto*(v_norm + ta_r)**0.25)
+        v_norm = diff
+        for _ in range(INVERT_ITERATIONS):
+            root = math.sqrt(math.sqrt(max(v_norm + ta_r, 1.0)))
+            err = v_norm - diff*(1 - TEMP_K*ksto + ksto*root)
+            slope = 1 - diff*ksto*0.25*root/(v_norm + ta_r)
+            v_norm -= err/slope
+        return v_norm
+
+    ## Mark the pixels whose raw counts fall inside the window.
+    #  @param   raw The RawImage to classify
+    #  @param   update_idx The pixels to classify, default all of them; the
+    #           rest of @c mask keeps its last value
+    #  @returns The number of pixels now marked in @c mask
+    def classify(self, raw, update_idx=None):
+        pix = raw.pix
+        lo = self.lo
+        hi = self.hi
+        mask = self.mask
+        count = self.count
+        for idx in update_idx or range(IMAGE_SIZE):
+            value = pix[idx]
+            inside = 1 if lo[idx] <= value <= hi[idx] else 0
+            count += inside - mask[idx]
+            mask[idx] = inside
+        self.count = count
+        return count
+
+    ## Iterate over the indices of the pixels marked in the last classify().
+    def candidates(self):
+        mask = self.mask
+        return (idx for idx in range(IMAGE_SIZE) if mask[idx])
+
+    ## Exact object temperature of one pixel, for the state of the thresholds.
+    #  @param   raw The RawImage holding the pixel
+    #  @param   idx The pixel's index
+    def temperature(self, raw, idx):
+        pattern = self._pattern
+        if pattern is None:
+            raise ValueError("no thresholds yet: call update() first")
+        sp_id = pattern.get_sp(idx)
+        state = self._states[sp_id]
+        if sp_id != self._prepared:
+            self._prepare(pattern.subpage(sp_id), state)
+            self._prepared = sp_id
+        il_offset = self.calib.il_offset if pattern is InterleavedPattern else None
+        v_norm = self._normalize(raw.pix[idx], idx, state.gain, il_offset)
+        return self._calc_to(v_norm, state.ta_r)
+
+
+def _clamp(value):
+    return RAW_MIN if value < RAW_MIN else RAW_MAX if value > RAW_MAX else value
+
+
+## Check that pixels inside the window are marked, and that the exact
+#  temperatures of pixels on both subpages, read at different states, match
+#  ProcessedImage.
+def test_temperature_window():
+    from mlx90640 import CameraState
+    from mlx90640.calibration import CameraCalibration, sample_eeprom
+    from mlx90640.regmap import MemoryInterface, RegisterMap, EEPROM_MAP
+    from mlx90640.image import RawImage, ProcessedImage, ChessPattern
+
+    iface = MemoryInterface(sample_eeprom())
+    calib = CameraCalibration(iface, RegisterMap(iface, EEPROM_MAP, readonly=True))
+    raw = RawImage(burst=False)
+    for idx in range(IMAGE_SIZE):
+        raw.pix[idx] = calib.pix_os_ref[idx] + 300 + idx % 50
+    states = (
+        CameraState(vdd=0.05, ta=10.0, ta_r=(35 + TEMP_K)**4, gain=1.02,
+                    gain_cp=(0.0, 0.0)),
+        CameraState(vdd=-0.1, ta=12.0, ta_r=(37 + TEMP_K)**4, gain=0.98,
+                    gain_cp=(0.0, 0.0)),
+    )
+    image = ProcessedImage(calib)
+    window = TemperatureWindow(calib, 60, 70)
+    try:
+        window.temperature(raw, 0)
+    except ValueError:
+        pass
+    else:
+        assert False, "temperature() before update() should fail"
+    for sp_id in (0, 1):
+        image.update(raw, ChessPattern.subpage(sp_id), states[sp_id])
+        window.update(ChessPattern, states[sp_id], sp_id)
+        window.classify(raw, ChessPattern.sp_range(sp_id))
+
+    # the first pixels are on alternate subpages
+    for idx in (0, 1, 32, 33, 400, 401):
+        expected = image.calc_temperature(idx, states[ChessPattern.get_sp(idx)])
+        found = window.temperature(raw, idx)
+        assert abs(found - expected) < 1e-3, (idx, found, expected)
+        assert window.mask[idx] == (60 <= expected <= 70), (idx, expected)
+    print("TemperatureWindow OK")
+
+
+if __name__ == "__main__":
+    test_temperature_window()
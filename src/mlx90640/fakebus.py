@@ -0,0 +1,98 @@
+## @file fakebus.py
+#  This file contains a stand-in for an MLX90640 on the I2C bus, for the
+#  tests which run without a camera. It serves the EEPROM made up by
+#  calibration.sample_eeprom(), keeps the camera's RAM and registers in
+#  memory, and counts the transactions made with it.
+
+from array import array
+from mlx90640.utils import const
+from mlx90640.regmap import REG_SIZE, EEPROM_ADDRESS, EEPROM_SIZE
+from mlx90640.calibration import sample_eeprom, IMAGE_SIZE
+
+RAM_ADDRESS = const(0x0400)
+RAM_SIZE = const(0x400)
+STATUS_ADDRESS = const(0x8000)
+# bit 3 of the status register is data_available
+DATA_READY = const(0x0008)
+
+
+class FakeCameraBus:
+
+    ## @param   address The camera's I2C address
+    #  @param   seed Picks the EEPROM's pixel words, see sample_eeprom()
+    def __init__(self, address=0x33, seed=1):
+        self.address = address
+        self.eeprom = sample_eeprom(seed)
+        self.ram = array('h', bytes(RAM_SIZE*REG_SIZE))
+        # the gain register matches the EEPROM's gain, for a gain of 1
+        self.ram[0x070A - RAM_ADDRESS] = 0x1800
+        # the status, control and I2C registers, with their reset values
+        self.registers = {
+            STATUS_ADDRESS: 0x0000,
+            0x800D: 0x1901,
+            0x800F: 0x0000,
+            0x8010: 0xBE00 | address,
+        }
+        ## The id of the subpage last measured
+        self.subpage = 1
+        ## Writes still to come which fail with OSError, as a NAK would
+        self.fail_writes = 0
+        self.reset_counts()
+
+    ## Zero the transaction counters.
+    def reset_counts(self):
+        ## Read transactions, and reads of each register address
+        self.reads = 0
+        self.reads_at = {}
+        ## Write transactions, and the (address, word) of each
+        self.writes = 0
+        self.written = []
+
+    def scan(self):
+        return [self.address]
+
+    ## Measure the next subpage: every pixel of it reads @c value and the
+    #  status register says data is ready.
+    #  @param   value The raw count all the subpage's pixels take
+    def measure(self, value=0):
+        self.subpage ^= 1
+        ram = self.ram
+        for idx in range(IMAGE_SIZE):
+            if (idx // 32 + idx) % 2 == self.subpage:
+                ram[idx] = value
+        self.registers[STATUS_ADDRESS] = (
+            self.registers[STATUS_ADDRESS] & ~0x0007 | DATA_READY | self.subpage)
+
+    def _word(self, mem_addr):
+        offset = mem_addr - EEPROM_ADDRESS
+        if 0 <= offset < EEPROM_SIZE:
+            return self.eeprom[2*offset] << 8 | self.eeprom[2*offset + 1]
+        offset = mem_addr - RAM_ADDRESS
+        if 0 <= offset < RAM_SIZE:
+            return self.ram[offset] & 0xFFFF
+        return self.registers.get(mem_addr, 0)
+
+    def readfrom_mem_into(self, addr, mem_addr, buf, addrsize=16):
+        self.reads += 1
+        self.reads_at[mem_addr] = self.reads_at.get(mem_addr, 0) + 1
+        for offset in range(0, len(buf), REG_SIZE):
+            word = self._word(mem_addr + offset//REG_SIZE)
+            buf[offset] = word >> 8
+            buf[offset + 1] = word & 0xFF
+
+    def readfrom_mem(self, addr, mem_addr, nbytes, addrsize=16):
+        buf = bytearray(nbytes)
+        self.readfrom_mem_into(addr, mem_addr, buf, addrsize)
+        return bytes(buf)
+
+    def writeto_mem(self, addr, mem_addr, buf, addrsize=16):
+        self.writes += 1
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise OSError(5)
+        for offset in range(0, len(buf), REG_SIZE):
+            address = mem_addr + offset//REG_SIZE
+            word = buf[offset] << 8 | buf[offset + 1]
+            self.written.append((address, word))
+            if address in self.registers:
+                self.registers[address] = word
@@ -3,30 +3,84 @@
 #  driver.
 #
 #  RAW VERSION
-#  This version is a stripped down MLX90640 driver which produces only raw data,
-#  not calibrated data, in order to save memory.
+#  This version is a stripped down MLX90640 driver which by default produces
+#  only raw data, in order to save memory. ProcessedImage provides calibrated
+#  data within a fixed memory budget when it is switched on.
 
 import math
 import struct
 from array import array
-from ucollections import namedtuple
-from mlx90640.utils import (Struct, StructProto, field_desc, array_filled)
+from mlx90640.utils import (const, namedtuple, Struct, StructProto,
+                            field_desc, array_filled)
 
 from mlx90640.regmap import REG_SIZE
-from mlx90640.calibration import NUM_COLS, IMAGE_SIZE, TEMP_K
+from mlx90640.calibration import (
+    NUM_ROWS,
+    NUM_COLS,
+    IMAGE_SIZE,
+    TEMP_K,
+    KTA_CLASSES,
+    KTA_EE_VALUES,
+)
+from mlx90640.badpix import BadPixelMap
 
 
 PIX_STRUCT_FMT = '>h'
 PIX_DATA_ADDRESS = const(0x0400)
 
 
+# Frame.flags bits: the halves of the frame weren't measured one right after
+# the other, so a moving scene may not line up between them
+FRAME_TORN = const(1)
+# a half waited in the camera longer than a refresh period before being read
+FRAME_STALE = const(2)
+
+
+# Gaps of up to this many words between the pixels of a subpage are read
+# through rather than starting a new I2C transaction
+SPAN_MERGE_GAP = const(8)
+
+
 class _BasePattern:
+    # per-pattern lookup tables, built on first use by _build_tables()
+    _tables = None
+    _spans = None
+    _subpages = None
+
     @classmethod
     def sp_range(cls, sp_id):
-        return (
-            idx for idx, sp in enumerate(cls.iter_sp()) 
-            if sp == sp_id
-        )
+        return cls.sp_table(sp_id)
+
+    ## Get the pixel indices belonging to a subpage.
+    #  @returns An @c array('H') of the subpage's pixel indices, in order
+    @classmethod
+    def sp_table(cls, sp_id):
+        if cls._tables is None:
+            cls._build_tables()
+        return cls._tables[sp_id]
+
+    ## Get the contiguous runs of RAM words which cover a subpage.
+    #  @returns A tuple of (first index, word count) pairs
+    @classmethod
+    def sp_spans(cls, sp_id):
+        if cls._spans is None:
+            cls._build_tables()
+        return cls._spans[sp_id]
+
+    ## Get the (shared) Subpage object for a subpage of this pattern.
+    @classmethod
+    def subpage(cls, sp_id):
+        if cls._subpages is None:
+            cls._subpages = (Subpage(cls, 0), Subpage(cls, 1))
+        return cls._subpages[sp_id]
+
+    @classmethod
+    def _build_tables(cls):
+        tables = (array('H'), array('H'))
+        for idx, sp in enumerate(cls.iter_sp()):
+            tables[sp].append(idx)
+        cls._tables = tables
+        cls._spans = tuple(_merge_spans(table) for table in tables)
 
     @classmethod
     def iter_sp(cls):
@@ -35,6 +89,18 @@ class _BasePattern:
         )
 
 
+def _merge_spans(table):
+    spans = []
+    start = last = table[0]
+    for idx in table:
+        if idx - last > SPAN_MERGE_GAP:
+            spans.append((start, last - start + 1))
+            start = idx
+        last = idx
+    spans.append((start, last - start + 1))
+    return tuple(spans)
+
+
 class ChessPattern(_BasePattern):
     pattern_id = 0x1
 
@@ -66,154 +132,493 @@ class Subpage:
         self.id = sp_id
 
     def sp_range(self):
-        return self.pattern.sp_range(self.id)
+        return self.pattern.sp_table(self.id)
+
+    def sp_spans(self):
+        return self.pattern.sp_spans(self.id)
+
+
+## A rectangular region of interest in the image, in the camera's own row
+#  and column order, with the pixel indices and RAM spans covering it in
+#  each subpage.
+class Roi:
+    def __init__(self, row, col, rows, cols):
+        row_1 = min(row + rows, NUM_ROWS)
+        col_1 = min(col + cols, NUM_COLS)
+        self.row = max(row, 0)
+        self.col = max(col, 0)
+        self.rows = max(row_1 - self.row, 0)
+        self.cols = max(col_1 - self.col, 0)
+        # (pattern, sp_id) -> (table, spans), built on first use
+        self._tables = {}
+
+    def __eq__(self, other):
+        return (other is not None and self.row == other.row and self.col == other.col
+                and self.rows == other.rows and self.cols == other.cols)
+
+    def __hash__(self):
+        return hash((self.row, self.col, self.rows, self.cols))
+
+    ## The same region with its columns mirrored, as MLX_Cam.get_csv()
+    #  prints them.
+    #  @returns (row, col, rows, cols)
+    def mirrored(self):
+        return (self.row, NUM_COLS - self.col - self.cols, self.rows, self.cols)
+
+    ## Get the indices of a subpage's pixels inside the region.
+    def sp_table(self, pattern, sp_id):
+        return self._get_tables(pattern, sp_id)[0]
+
+    ## Get the runs of RAM words covering a subpage's pixels inside the
+    #  region; a narrow region gives one burst per row.
+    def sp_spans(self, pattern, sp_id):
+        return self._get_tables(pattern, sp_id)[1]
+
+    def _get_tables(self, pattern, sp_id):
+        key = (pattern, sp_id)
+        tables = self._tables.get(key)
+        if tables is None:
+            table = array('H')
+            for row in range(self.row, self.row + self.rows):
+                for idx in range(row*NUM_COLS + self.col, row*NUM_COLS + self.col + self.cols):
+                    if pattern.get_sp(idx) == sp_id:
+                        table.append(idx)
+            spans = _merge_spans(table) if len(table) else ()
+            tables = (table, spans)
+            self._tables[key] = tables
+        return tables
 
 
 ## Image Buffers
 
 class RawImage:
-    def __init__(self):
+    ## @param   burst Read the whole RAM pixel block in a few large I2C
+    #           transactions (default) instead of one transaction per pixel
+    #  @param   scratch A staging buffer for burst reads to share with other
+    #           images, default a buffer of this image's own
+    def __init__(self, burst=True, scratch=None):
         self.pix = array_filled('h', IMAGE_SIZE)
+        # staging area for burst reads, holding the RAM block as big-endian
+        # words exactly as they come off the bus
+        if burst:
+            self._buf = scratch or bytearray(IMAGE_SIZE * REG_SIZE)
+        else:
+            self._buf = None
 
     def __getitem__(self, idx):
         return self.pix[idx]
 
-    def read(self, iface, update_idx = None):
+    ## Read pixel data from the camera's RAM.
+    #  @param   update_idx The pixel indices to update, default all of them
+    #  @param   spans The (first index, word count) runs of RAM to fetch in
+    #           burst mode, which must cover @c update_idx; default the
+    #           whole pixel block
+    def read(self, iface, update_idx = None, spans = None):
+        if update_idx is None:
+            update_idx = range(IMAGE_SIZE)
+        if self._buf is None:
+            self._read_words(iface, update_idx)
+            return
+
+        buf = self._buf
+        pix = self.pix
+        if spans is None:
+            iface.read_block(PIX_DATA_ADDRESS, buf)
+        else:
+            view = memoryview(buf)
+            for start, count in spans:
+                iface.read_block(PIX_DATA_ADDRESS + start,
+                                 view[start*REG_SIZE:(start + count)*REG_SIZE])
+        # decode in place; no per-pixel allocation
+        for idx in update_idx:
+            offset = idx * REG_SIZE
+            value = buf[offset] << 8 | buf[offset + 1]
+            pix[idx] = value - 0x10000 if value & 0x8000 else value
+
+    ## Estimate the pixels of the other subpage from those of one subpage,
+    #  each as the mean of its neighbours in the subpage: left, right, above
+    #  and below in the chess pattern, above and below in the interleaved
+    #  pattern.
+    #  @param   subpage The Subpage whose pixels are valid
+    #  @param   out An @c array('h') to write the whole image into; default
+    #           this image's own pixels, overwriting the other subpage
+    #  @returns @c out
+    def interpolate(self, subpage, out = None):
+        pix = self.pix
+        if out is None:
+            out = pix
+        else:
+            for idx in subpage.sp_range():
+                out[idx] = pix[idx]
+
+        horizontal = subpage.pattern is not InterleavedPattern
+        for idx in subpage.pattern.sp_table(1 - subpage.id):
+            row = idx // NUM_COLS
+            col = idx - row*NUM_COLS
+            total = 0
+            count = 0
+            if row > 0:
+                total += pix[idx - NUM_COLS]
+                count += 1
+            if row < NUM_ROWS - 1:
+                total += pix[idx + NUM_COLS]
+                count += 1
+            if horizontal:
+                if col > 0:
+                    total += pix[idx - 1]
+                    count += 1
+                if col < NUM_COLS - 1:
+                    total += pix[idx + 1]
+                    count += 1
+            out[idx] = total // count
+        return out
+
+    def _read_words(self, iface, update_idx):
         buf = bytearray(REG_SIZE)
-        update_idx = update_idx or range(IMAGE_SIZE)
         for offset in update_idx:
             iface.read_into(PIX_DATA_ADDRESS + offset, buf)
             self.pix[offset] = struct.unpack(PIX_STRUCT_FMT, buf)[0]
 
 
+## A RawImage in a FrameRing, with the sequence number and capture times
+#  of the frame it holds.
+class Frame(RawImage):
+    def __init__(self, burst=True, scratch=None):
+        super().__init__(burst, scratch)
+        # 0 while empty or being filled
+        self.seq = 0
+        # bit (1 << subpage id) set for each subpage read into the frame
+        self.halves = 0
+        # the Roi the frame was read with, or None for the whole image;
+        # pixels outside it are left over from an older frame
+        self.roi = None
+        # ticks_ms() when the first and last subpages were read
+        self.started = 0
+        self.timestamp = 0
+        self.leases = 0
+        # FRAME_TORN and FRAME_STALE bits; a consumer can drop such frames
+        self.flags = 0
+
+
+## A ring of frame buffers, so that one frame can be acquired while
+#  consumers still work on earlier ones.
+#  @details Acquisition fills one slot at a time with writer() and
+#           publish(). Consumers lease() the newest complete frame, which
+#           stays untouched until it is release()d. Three slots keep the
+#           newest frame available while another is leased. The slots share
+#           one burst staging buffer, so each slot beyond the first costs
+#           only its 1.5 kB of pixels.
+class FrameRing:
+    def __init__(self, slots=2, burst=True):
+        scratch = bytearray(IMAGE_SIZE * REG_SIZE) if burst else None
+        # other images read between frames can stage their reads here too
+        self.scratch = scratch
+        self.frames = tuple(Frame(burst, scratch) for _ in range(slots))
+        self.seq = 0
+        self._filling = None
+        # whether data has been read into the frame being filled
+        self._begun = False
+
+    ## Get the frame to acquire into, picking a new slot if none is being
+    #  filled: the oldest one which isn't leased. The slot keeps its old
+    #  frame, which can still be leased, until begin() is called as data
+    #  for the new one arrives; a slot leased before then is given up and
+    #  another picked.
+    #  @returns A Frame, or @c None if every slot is leased
+    def writer(self):
+        filling = self._filling
+        if filling is not None and (self._begun or not filling.leases):
+            return filling
+
+        best = None
+        for frame in self.frames:
+            if frame.leases:
+                continue
+            if best is None or frame.seq < best.seq:
+                best = frame
+        self._filling = best
+        self._begun = False
+        return best
+
+    ## Start filling the frame from writer(), clearing the frame it held,
+    #  once the first subpage is about to be read into it.
+    def begin(self):
+        if not self._begun:
+            frame = self._filling
+            frame.seq = 0
+            frame.halves = 0
+            frame.flags = 0
+            self._begun = True
+
+    ## Mark the frame being filled as complete.
+    #  @param   timestamp When its last subpage was read
+    def publish(self, timestamp):
+        frame = self._filling
+        self.seq += 1
+        frame.seq = self.seq
+        frame.timestamp = timestamp
+        self._filling = None
+        self._begun = False
+        return frame
+
+    ## Lease the newest complete frame, which won't be overwritten until it
+    #  is released.
+    #  @param   after_seq Only lease a frame newer than this sequence number
+    #  @returns A Frame, or @c None if there's no newer complete frame
+    def lease(self, after_seq=0):
+        newest = None
+        for frame in self.frames:
+            if frame.seq > after_seq and (newest is None or frame.seq > newest.seq):
+                newest = frame
+        if newest is not None:
+            newest.leases += 1
+        return newest
+
+    def release(self, frame):
+        frame.leases -= 1
+
+
 ImageLimits = namedtuple('ScaleLimits', ('min_h', 'max_h', 'min_idx', 'max_idx'))
 
 
-_INTERP_NEIGHBOURS = tuple(
-    row * NUM_COLS + col
-    for row in (-1, 0, 1)
-    for col in (-1, 0, 1)
-    if row != 0 or col != 0
-)
+## Per-frame compensation terms shared by everything which turns raw
+#  counts into temperatures.
+#  @details The per-pixel offset factor (1 + kta*ta)*(1 + kv*vdd) takes one
+#           of only KTA_CLASSES values, which are computed once per subpage
+#           rather than once per pixel.
+class Compensation:
+    def __init__(self, calib):
+        self.calib = calib
+        # per-subpage factors by kta class, filled by _prepare()
+        self._os_fac = array_filled('f', KTA_CLASSES, 1.0)
+        self._alpha_fac = 1.0
+        self._v_ir_cp = 0.0
+        self._alpha_cp = 0.0
+
+    # compute everything which is the same for all pixels of a subpage
+    def _prepare(self, subpage, state):
+        calib = self.calib
+        ta = state.ta
+        vdd = state.vdd
+
+        kv_fac = tuple(1 + kv*vdd for kv_row in calib.kv_avg for kv in kv_row)
+        for kta_cls in range(KTA_CLASSES):
+            parity = kta_cls // KTA_EE_VALUES
+            self._os_fac[kta_cls] = (1 + calib.kta_table[kta_cls]*ta)*kv_fac[parity]
+
+        self._alpha_fac = 1 + calib.ksta*ta
+        if calib.use_tgc:
+            self._v_ir_cp = calib.tgc*self._calc_os_cp(subpage, state)
+            self._alpha_cp = calib.tgc*calib.pix_alpha_cp[subpage.id]
+        else:
+            self._v_ir_cp = 0.0
+            self._alpha_cp = 0.0
+
+    def _calc_os_cp(self, subpage, state):
+        pix_os_cp = self.calib.pix_os_cp[subpage.id]
+        if subpage.pattern is InterleavedPattern:
+            pix_os_cp += self.calib.il_chess_c1
+        return state.gain_cp[subpage.id] - pix_os_cp*(1 + self.calib.kta_cp*state.ta)*(1 + self.calib.kv_cp*state.vdd)
+
+    ## Object temperature for a value of v_ir/alpha.
+    def _calc_to(self, v_norm, ta_r):
+        ksto = self.calib.ksto[1]
+        s_x = ksto*math.sqrt(math.sqrt(v_norm + ta_r))
+
+        to = v_norm/(1 - TEMP_K*ksto + s_x) + ta_r
+        to = math.sqrt(math.sqrt(to)) - TEMP_K
+        return to + self.calib.drift
+
+    ## v_ir/alpha of one pixel, with the factors of its subpage prepared.
+    def _normalize(self, value, idx, gain, il_offset=None):
+        calib = self.calib
+        v_os = value*gain - calib.pix_os_ref[idx]*self._os_fac[calib.pix_kta_class[idx]]
+        if il_offset is not None:
+            v_os += il_offset[idx]
+        v_ir = v_os/calib.emissivity - self._v_ir_cp
+        return v_ir/((calib.pix_alpha[idx] - self._alpha_cp)*self._alpha_fac)
+
+
+## Compensated image data from which object temperatures can be computed.
+#  @details To fit a fixed memory budget only one float per pixel is kept:
+#           the compensated IR signal divided by the pixel's sensitivity,
+#           v_ir/alpha. Object temperature is a function of that value and
+#           the frame's reflected temperature alone, so it is computed only
+#           for the pixels that are asked for.
+#
+#           Together with the CameraCalibration this takes about 8.3 kB
+#           (3 kB here; 1.5 kB pix_os_ref, 0.75 kB kta classes and 3 kB
+#           pix_alpha there), plus 3 kB of il_offset for the interleaved
+#           pattern.
+class ProcessedImage(Compensation):
+    def __init__(self, calib):
+        super().__init__(calib)
+        # v_ir/alpha for each pixel
+        self.buf = array_filled('f', IMAGE_SIZE, 0.0)
+
+    def __getitem__(self, idx):
+        return self.buf[idx]
+
+    ## Compensate the pixels of one subpage.
+    #  @param   raw The RawImage holding the subpage's data
+    #  @param   subpage The Subpage which was read
+    #  @param   state The CameraState at the time the subpage was read
+    def update(self, raw, subpage, state):
+        calib = self.calib
+        self._prepare(subpage, state)
+
+        pix = raw.pix
+        buf = self.buf
+        os_ref = calib.pix_os_ref
+        kta_cls = calib.pix_kta_class
+        pix_alpha = calib.pix_alpha
+        os_fac = self._os_fac
+        gain = state.gain
+        inv_em = 1.0/calib.emissivity
+        v_ir_cp = self._v_ir_cp
+        alpha_cp = self._alpha_cp
+        alpha_fac = self._alpha_fac
+        il_offset = calib.il_offset if subpage.pattern is InterleavedPattern else None
+
+        for idx in subpage.sp_range():
+            ## IR data compensation - offset, Vdd, and Ta
+            v_os = pix[idx]*gain - os_ref[idx]*os_fac[kta_cls[idx]]
+            if il_offset is not None:
+                v_os += il_offset[idx]
+
+            ## IR data gradient compensation
+            v_ir = v_os*inv_em - v_ir_cp
+
+            ## sensitivity normalization
+            buf[idx] = v_ir/((pix_alpha[idx] - alpha_cp)*alpha_fac)
+
+    def calc_temperature(self, idx, state):
+        return self._calc_to(self.buf[idx], state.ta_r)
+
+    def calc_temperature_ext(self, idx, state):
+        v_norm = self.buf[idx]
+        to = self._calc_to(v_norm, state.ta_r)
+
+        band = self._get_range_band(to)
+        if band < 0:
+            return self.calib.ct[0]
+
+        alpha_ext = self.calib.alpha_ext[band]
+        ksto_ext = self.calib.ksto[band]
+        ct = self.calib.ct[band]
+        to_ext = v_norm/(alpha_ext*(1 + ksto_ext*(to - ct))) + state.ta_r
+        to_ext = math.sqrt(math.sqrt(to_ext)) - TEMP_K
+        return to_ext  + self.calib.drift
+
+    def _get_range_band(self, t):
+        return sum(1 for ct in self.calib.ct if t >= ct) - 1
+
+    def calc_limits(self, *, exclude_idx=()):
+        # find min/max in place to keep mem usage down
+        min_h, min_idx = None, None
+        max_h, max_idx = None, None
+        for idx, h in enumerate(self.buf):
+            if idx in exclude_idx:
+                continue
+            if min_h is None or h < min_h:
+                min_h, min_idx = h, idx
+            if max_h is None or h > max_h:
+                max_h, max_idx = h, idx
+        return ImageLimits(min_h, max_h, min_idx, max_idx)
+
+    ## Replace each bad pixel by the mean of its good neighbours.
+    #  @param   bad_pixels A BadPixelMap, or a sequence of pixel indices
+    def interpolate_bad_pixels(self, bad_pixels):
+        if not isinstance(bad_pixels, BadPixelMap):
+            bad_pixels = BadPixelMap(bad_pixels)
+        bad_pixels.patch(self.buf)
+
+
+## Check the precomputed subpage tables of both read patterns against
+#  @c get_sp(), and that each pattern's spans cover its subpages.
+def test_sp_tables():
+    for pattern in (ChessPattern, InterleavedPattern):
+        for sp_id in (0, 1):
+            expected = [idx for idx in range(IMAGE_SIZE)
+                        if pattern.get_sp(idx) == sp_id]
+            assert list(pattern.sp_table(sp_id)) == expected, \
+                f"{pattern.__name__} subpage {sp_id} table mismatch"
+
+            covered = set()
+            for start, count in pattern.sp_spans(sp_id):
+                covered.update(range(start, start + count))
+            assert covered.issuperset(expected), \
+                f"{pattern.__name__} subpage {sp_id} spans miss pixels"
+    print("Subpage tables OK")
+
+
+## Check the order in which a FrameRing hands out frames: writer() never
+#  gives a leased frame, lease() gives the newest complete one, and
+#  begin() clears a slot only once it is being refilled.
+def test_frame_ring():
+    ring = FrameRing(3, burst=False)
+    assert ring.lease() is None
+
+    def fill(timestamp):
+        frame = ring.writer()
+        ring.begin()
+        frame.halves = 0x3
+        return ring.publish(timestamp)
+
+    first = fill(10)
+    second = fill(20)
+    assert (first.seq, second.seq) == (1, 2) and first is not second
+    assert first.timestamp == 10 and second.timestamp == 20
+
+    # the newest frame is leased, and only frames newer than after_seq
+    leased = ring.lease()
+    assert leased is second and second.leases == 1
+    assert ring.lease(after_seq=2) is None
+
+    # the empty slot is filled next, then the oldest frame not leased
+    third = fill(30)
+    assert third is not first and third is not second
+    assert ring.lease(after_seq=2) is third
+    writer = ring.writer()
+    # until begin() the slot still holds its old frame
+    assert writer is first and first.seq == 1 and first.halves == 0x3
+    ring.begin()
+    assert first.seq == 0 and first.halves == 0
+    ring.publish(40)
+    assert first.seq == 4
+
+    # with every slot leased there's nothing to write to
+    assert ring.lease(after_seq=3) is first
+    assert ring.writer() is None
+    ring.release(second)
+    assert ring.writer() is second
+    ring.release(first)
+    ring.release(third)
+    assert first.leases == second.leases == third.leases == 0
+    assert ring.lease(after_seq=4) is None
+    print("FrameRing OK")
+
+
+## Check Roi clipping, equality, hashing and mirroring.
+def test_roi():
+    roi = Roi(2, 3, 4, 5)
+    assert roi.mirrored() == (2, NUM_COLS - 8, 4, 5)
+    # clipped to the image
+    edge = Roi(-1, NUM_COLS - 2, 4, 5)
+    assert (edge.row, edge.col, edge.rows, edge.cols) == (0, NUM_COLS - 2, 3, 2)
+    assert edge.mirrored() == (0, 0, 3, 2)
+    assert Roi(0, 0, NUM_ROWS, NUM_COLS).mirrored() == (0, 0, NUM_ROWS, NUM_COLS)
+
+    same = Roi(2, 3, 4, 5)
+    assert roi == same and hash(roi) == hash(same)
+    assert Roi(0, NUM_COLS - 2, 3, 9) == edge
+    assert roi != edge and roi != None
+    assert len({roi, same, edge}) == 2
+    assert {roi: 1}[same] == 1
+    print("Roi OK")
 
 
-# class ProcessedImage:
-#     def __init__(self, calib):
-#         # pix_data should be a sequence of ints
-#         self.calib = calib
-#         self.v_ir = array_filled('f', IMAGE_SIZE, 0.0)
-#         self.alpha = array_filled('f', IMAGE_SIZE, 1.0)
-#         self.buf = array_filled('f', IMAGE_SIZE, 1.0)
-# 
-#     def update(self, pix_data, subpage, state):
-#         if self.calib.use_tgc:
-#             pix_os_cp = self._calc_os_cp(subpage, state)
-#             pix_alpha_cp = self.calib.pix_alpha_cp[subpage.id]
-# 
-#         for idx, raw in pix_data:
-#             ## IR data compensation - offset, Vdd, and Ta
-#             kta = self.calib.pix_kta[idx]
-# 
-#             row, col = divmod(idx, NUM_COLS)
-#             kv = self.calib.kv_avg[row % 2][col % 2]
-#             
-#             offset = self.calib.pix_os_ref[idx]
-#             offset *= (1 + kta*state.ta)*(1 + kv*state.vdd)
-# 
-#             v_os = raw*state.gain - offset
-#             if subpage.pattern is InterleavedPattern:
-#                 v_os += self.calib.il_offset[idx]
-#             v_ir = v_os / self.calib.emissivity
-# 
-#             ## IR data gradient compensation
-#             if self.calib.use_tgc:
-#                 v_ir -= self.calib.tgc*pix_os_cp
-# 
-#             # preserve v_ir for temperature calculations
-#             self.v_ir[idx] = v_ir
-# 
-#             alpha = self._calc_alpha(idx, state.ta)
-#             self.buf[idx] = v_ir/alpha
-# 
-#     def _calc_os_cp(self, subpage, state):
-#         pix_os_cp = self.calib.pix_os_cp[subpage.id]
-#         if subpage.pattern is InterleavedPattern:
-#             pix_os_cp += self.calib.il_chess_c1
-#         return state.gain_cp[subpage.id] - pix_os_cp*(1 + self.calib.kta_cp*state.ta)*(1 + self.calib.kv_cp*state.vdd)
-# 
-#     def _calc_os_cp2(self, pattern, state):
-#         pix_os_cp = list(self.calib.pix_os_cp)
-#         if pattern is InterleavedPattern:
-#             for i in range(len(pix_os_cp)):
-#                 pix_os_cp[i] += self.calib.il_chess_c1
-# 
-#         k = (1 + self.calib.kta_cp*state.ta)*(1 + self.calib.kv_cp*state.vdd)
-#         return [
-#             gain_cp_sp - pix_os_cp_sp*k
-#             for pix_os_cp_sp, gain_cp_sp in zip(pix_os_cp, state.gain_cp)
-#         ]
-# 
-#     def _calc_alpha(self, idx, ta):
-#         alpha = self.calib.pix_alpha[idx]
-#         if self.calib.use_tgc:
-#             alpha -= self.calib.tgc*pix_alpha_cp
-#         alpha *= (1 + self.calib.ksta*ta)
-#         return alpha
-# 
-#     def _calc_to(self, idx, alpha, ta_r):
-#         v_ir = self.v_ir[idx]
-# 
-#         s_x = v_ir*(alpha**3) + ta_r*(alpha**4)
-#         s_x = math.sqrt(math.sqrt(s_x))*self.calib.ksto[1]
-# 
-#         to = v_ir/(alpha*(1 - TEMP_K*self.calib.ksto[1]) + s_x) + ta_r
-#         to = math.sqrt(math.sqrt(to)) - TEMP_K
-#         return to + self.calib.drift
-# 
-#     def calc_temperature(self, idx, state):
-#         alpha = self._calc_alpha(idx, state.ta)
-#         return self._calc_to(idx, alpha, state.ta_r)
-# 
-#     def calc_temperature_ext(self, idx, state):
-#         v_ir = self.v_ir[idx]
-#         alpha = self._calc_alpha(idx, state.ta)
-#         to = self._calc_to(idx, alpha, state.ta_r)
-# 
-#         band = self._get_range_band(to)
-#         if band < 0:
-#             return self.calib.ct[0]
-# 
-#         alpha_ext = self.calib.alpha_ext[band]
-#         ksto_ext = self.calib.ksto[band]
-#         ct = self.calib.ct[band]
-#         to_ext = v_ir/(alpha*alpha_ext*(1 + ksto_ext*(to - ct))) + state.ta_r
-#         to_ext = math.sqrt(math.sqrt(to_ext)) - TEMP_K
-#         return to_ext  + self.calib.drift
-# 
-#     def _get_range_band(self, t):
-#         return sum(1 for ct in self.calib.ct if t >= ct) - 1
-# 
-#     def calc_limits(self, *, exclude_idx=()):
-#         # find min/max in place to keep mem usage down
-#         min_h, min_idx = None, None
-#         max_h, max_idx = None, None
-#         for idx, h in enumerate(self.buf):
-#             if idx in exclude_idx:
-#                 continue
-#             if min_h is None or h < min_h:
-#                 min_h, min_idx = h, idx
-#             if max_h is None or h > max_h:
-#                 max_h, max_idx = h, idx
-#         return ImageLimits(min_h, max_h, min_idx, max_idx)
-# 
-#     def interpolate_bad_pixels(self, bad_pixels):
-#         for bad_idx in bad_pixels:
-#             count = 0
-#             total = 0
-#             for offset in _INTERP_NEIGHBOURS:
-#                 idx = bad_idx + offset
-#                 if idx in range(IMAGE_SIZE) and idx not in bad_pixels:
-#                     count += 1
-#                     total += self.buf[idx]
-#             if count > 0:
-#                 self.buf[bad_idx] = total/count
+if __name__ == "__main__":
+    test_sp_tables()
+    test_frame_ring()
+    test_roi()
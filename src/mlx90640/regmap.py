@@ -1,6 +1,7 @@
 ## MLX90640 register mapping
 
 from mlx90640.utils import (
+    const,
     field_desc,
     FieldDesc,
     FD_BYTE,
@@ -39,7 +40,7 @@ REGISTER_MAP = {
     ),
 
     # I2C Address
-    0x8010 : field_desc('i2c_address',  FD_BYTE, 1),
+    0x8010 : field_desc('i2c_address',  FD_BYTE, 0),
     0x0700 : field_desc('ta_vbe',       FD_WORD, signed=True),
     0x0708 : field_desc('cp_sp_0',      FD_WORD, signed=True),
     0x070A : field_desc('gain',         FD_WORD, signed=True),
@@ -135,11 +136,15 @@ EEPROM_MAP = {
     ),
 }
 
+# Largest number of words moved by a single I2C transaction in read_block()
+BURST_WORDS = const(128)
+
 import time
 class CameraInterface:
-    def __init__(self, i2c, addr):
+    def __init__(self, i2c, addr, burst_words=BURST_WORDS):
         self.i2c = i2c   # HW interface
         self.addr = addr # device address
+        self.burst_words = burst_words
 
     ## raw register read/write
 
@@ -150,16 +155,110 @@ class CameraInterface:
     def write(self, mem_addr, buf):
         self.i2c.writeto_mem(self.addr, mem_addr, buf, addrsize=16)
 
+    ## bulk register read
+
+    # fill buf from consecutive registers starting at mem_addr, using as few
+    # transactions as the burst size allows
+    def read_block(self, mem_addr, buf):
+        view = memoryview(buf)
+        step = self.burst_words * REG_SIZE
+        for offset in range(0, len(buf), step):
+            self.i2c.readfrom_mem_into(self.addr, mem_addr + offset//REG_SIZE,
+                                       view[offset:offset+step], addrsize=16)
+
 
 class ReadOnlyError(Exception): pass
 
+
+## Serves register reads from a block of memory instead of the I2C bus: the
+#  EEPROM read in one go by read_eeprom(), or a dump of it loaded from a file
+#  (which also lets the calibration code run on a PC).
+class MemoryInterface:
+    ## @param   buf The big-endian register words
+    #  @param   base_address The register address of the first word in @c buf
+    def __init__(self, buf, base_address=EEPROM_ADDRESS):
+        self.buf = buf
+        self.base = base_address
+
+    ## Load a dump file, e.g. one written from read_eeprom().
+    @classmethod
+    def from_file(cls, path, base_address=EEPROM_ADDRESS):
+        with open(path, 'rb') as f:
+            return cls(bytearray(f.read()), base_address)
+
+    def _offset(self, mem_addr, nbytes):
+        offset = (mem_addr - self.base) * REG_SIZE
+        if offset < 0 or offset + nbytes > len(self.buf):
+            raise ValueError(f"address {mem_addr:#06x} is outside the memory block")
+        return offset
+
+    ## A view of @c nbytes of the block starting at register @c mem_addr,
+    #  which shares the memory rather than copying it.
+    def view(self, mem_addr, nbytes):
+        offset = self._offset(mem_addr, nbytes)
+        return memoryview(self.buf)[offset:offset + nbytes]
+
+    def read(self, mem_addr):
+        return bytes(self.view(mem_addr, REG_SIZE))
+    def read_into(self, mem_addr, buf):
+        buf[:] = self.view(mem_addr, len(buf))
+    def read_block(self, mem_addr, buf):
+        buf[:] = self.view(mem_addr, len(buf))
+    def write(self, mem_addr, buf):
+        raise ReadOnlyError(f"can't write to {mem_addr:#06x}: memory is read-only")
+
+
+## Read the whole EEPROM from the camera in a few bulk transfers.
+#  @returns A bytearray of the EEPROM's big-endian words
+def read_eeprom(iface):
+    buf = bytearray(EEPROM_SIZE * REG_SIZE)
+    iface.read_block(EEPROM_ADDRESS, buf)
+    return buf
+
+
+# Configuration registers which only change when the driver writes them, so
+# they can be shadowed by a write-through cache
+CACHED_REGISTERS = (0x800D, 0x800F, 0x8010)
+
+# Registers the camera changes by itself; these must always be read from the
+# bus and are never cached
+VOLATILE_REGISTERS = (0x8000,)
+
+
+## The contents of one register as read at a single moment, from which any
+#  number of its fields can be decoded without going back to the bus. A
+#  modified snapshot can be written back with RegisterMap.commit().
+class Snapshot(Struct):
+    def __init__(self, address, buf, proto):
+        super().__init__(buf, proto)
+        self.address = address
+        self.buf = buf
+
+
 class RegisterMap:
-    def __init__(self, iface, register_map, readonly=False):
+    def __init__(self, iface, register_map, readonly=False, cached=()):
         # register_map should be a dict of { I2C address : FieldDesc(s) }
+        # cached should be a sequence of addresses to shadow, which must not
+        # include any of the VOLATILE_REGISTERS
         self.iface = iface
         self.readonly = readonly
         self._fields = self._build_lookup(register_map)
 
+        # { address : Snapshot or None until first read }
+        self._shadow = {}
+        for address in cached:
+            if address in VOLATILE_REGISTERS:
+                raise ValueError(f"can't cache volatile register {address:#06x}")
+            self._shadow[address] = None
+
+        # per-register counts of reads served from the cache (hits) and reads
+        # which went out on the bus (misses)
+        self.hits = {}
+        self.misses = {}
+        for address, _ in self._fields.values():
+            self.hits[address] = 0
+            self.misses[address] = 0
+
     @staticmethod
     def _build_lookup(register_map):
         lookup = {}
@@ -183,20 +282,196 @@ class RegisterMap:
         return name in self._fields
 
     def __getitem__(self, name):
-        address, proto = self._fields[name]
-
-        buf = self.iface.read(address)
-        struct = Struct(buf, proto)
-        return struct[name]
+        return self.snapshot(name)[name]
 
     def __setitem__(self, name, value):
         if self.readonly:
             raise ReadOnlyError(f"can't write to '{name}': not permitted")
 
+        # for a cached register this modifies the shadow copy, so no read
+        # is needed before the write
+        snapshot = self.snapshot(name)
+        snapshot[name] = value
+        self.commit(snapshot)
+
+    ## Read the register holding a field once, so that several of its fields
+    #  can be decoded from that one read. Cached registers are served from
+    #  their shadow copy; the returned snapshot of a cached register is that
+    #  shadow copy, so it should only be modified in order to commit() it.
+    #  @param   name The name of any field in the register
+    #  @param   fresh Bypass the cache and read the register from the bus
+    def snapshot(self, name, fresh=False):
         address, proto = self._fields[name]
 
+        shadow = self._shadow.get(address)
+        if shadow is not None and not fresh:
+            self.hits[address] += 1
+            return shadow
+
+        self.misses[address] += 1
+        if address in self._shadow:
+            # refill the shadow copy in place
+            if shadow is None:
+                shadow = Snapshot(address, bytearray(REG_SIZE), proto)
+                self._shadow[address] = shadow
+            self.iface.read_into(address, shadow.buf)
+            return shadow
+
         buf = bytearray(REG_SIZE)
         self.iface.read_into(address, buf)
-        struct = Struct(buf, proto)
-        struct[name] = value
-        self.iface.write(address, buf)
+        return Snapshot(address, buf, proto)
+
+    ## Write a (modified) snapshot back to its register, keeping the cache
+    #  coherent.
+    def commit(self, snapshot):
+        if self.readonly:
+            raise ReadOnlyError(f"can't write to {snapshot.address:#06x}: not permitted")
+
+        address = snapshot.address
+        shadow = self._shadow.get(address)
+        if shadow is not None and shadow is not snapshot:
+            shadow.buf[:] = snapshot.buf
+        try:
+            self.iface.write(address, snapshot.buf)
+        except OSError:
+            # the device may or may not have taken the write
+            self.invalidate(address)
+            raise
+
+    ## Change several fields at once, with one write per register they are
+    #  in rather than one per field. Registers whose contents don't change
+    #  aren't written at all.
+    #  @param   fields A dict of { field name : value }
+    #  @returns The number of registers written
+    def update(self, fields):
+        if self.readonly:
+            raise ReadOnlyError("can't write to registers: not permitted")
+
+        # { address : (snapshot, contents before the update) }
+        changes = {}
+        for name, value in fields.items():
+            address, _ = self._fields[name]
+            change = changes.get(address)
+            if change is None:
+                snapshot = self.snapshot(name)
+                change = (snapshot, bytes(snapshot.buf))
+                changes[address] = change
+            change[0][name] = value
+
+        writes = 0
+        for snapshot, before in changes.values():
+            if snapshot.buf != before:
+                self.commit(snapshot)
+                writes += 1
+        return writes
+
+    ## Drop the shadow copy of one cached register, or of all of them, so the
+    #  next access reads the camera again.
+    def invalidate(self, address=None):
+        for cached in self._shadow:
+            if address is None or cached == address:
+                self._shadow[cached] = None
+
+
+## Check the fields of the control, I2C config and I2C address registers,
+#  and an EEPROM word of two FD_BYTE fields, against known words. An FD_BYTE
+#  field's position counts bytes from the least significant end, so
+#  @c i2c_address is byte 0 and @c k_vdd, the high byte of 0x2433, byte 1.
+def test_fields():
+    known = (
+        # the reset value: subpages on, 2 Hz, 18 bits, chess pattern
+        (REGISTER_MAP, 0x800D, 0x1901, dict(
+            subpage_enable=1, data_hold=0, subpage_repeat=0, repeat_select=0,
+            refresh_rate=2, adc_resolution=2, read_pattern=1)),
+        (REGISTER_MAP, 0x800F, 0x0005, dict(
+            fmplus_enable=1, i2c_levels=0, sda_current_limit=1)),
+        (REGISTER_MAP, 0x8010, 0xBE33, dict(i2c_address=0x33)),
+        # the datasheet's example: Kvdd = -99 * 32 and VDD25 from 0x68
+        (EEPROM_MAP, 0x2433, 0x9D68, dict(k_vdd=-99, vdd_25=0x68)),
+    )
+    for (register_map, address, word, values) in known:
+        fields = register_map[address]
+        if isinstance(fields, FieldDesc):
+            fields = (fields,)
+        proto = StructProto(fields)
+        assert set(values) == set(fld.name for fld in fields), address
+        for (name, value) in values.items():
+            assert proto.decode(word, name) == value, (name, value)
+            # encoding a field's own value gives the word back, and a new
+            # value changes only that field
+            assert proto.encode(word, name, value) == word, name
+            other = proto.encode(word, name, value ^ 1)
+            assert proto.decode(other, name) == value ^ 1, name
+            for fld in fields:
+                if fld.name != name:
+                    assert proto.decode(other, fld.name) == values[fld.name]
+    proto = StructProto((REGISTER_MAP[0x8010],))
+    assert proto.encode(0xBE33, 'i2c_address', 0x32) == 0xBE32
+    print("fields OK")
+
+
+## Count the bus transactions a RegisterMap makes: cached registers are
+#  read once, update() writes each register it changes once, and a write
+#  which fails drops the shadow copy so the camera is read again.
+def test_register_map():
+    from mlx90640.fakebus import FakeCameraBus, STATUS_ADDRESS
+
+    bus = FakeCameraBus()
+    regs = RegisterMap(CameraInterface(bus, bus.address), REGISTER_MAP,
+                       cached=(0x800D, 0x800F, 0x8010))
+    try:
+        RegisterMap(CameraInterface(bus, bus.address), REGISTER_MAP,
+                    cached=(STATUS_ADDRESS,))
+    except ValueError:
+        pass
+    else:
+        assert False, "volatile register cached"
+
+    # a miss, then hits for any field of the same register
+    assert regs['refresh_rate'] == 2 and bus.reads == 1
+    assert regs['adc_resolution'] == 2 and regs['read_pattern'] == 1
+    assert bus.reads == 1
+    assert (regs.misses[0x800D], regs.hits[0x800D]) == (1, 2)
+    # the status register is read every time
+    regs['last_subpage']
+    regs['data_available']
+    assert bus.reads_at[STATUS_ADDRESS] == 2 and regs.hits[STATUS_ADDRESS] == 0
+    assert regs.snapshot('refresh_rate', fresh=True)['refresh_rate'] == 2
+    assert regs.misses[0x800D] == 2
+
+    # several fields of one register take one write, and no read
+    bus.reset_counts()
+    assert regs.update(dict(refresh_rate=3, adc_resolution=3,
+                            subpage_enable=1)) == 1
+    assert (bus.reads, bus.writes) == (0, 1)
+    assert bus.written == [(0x800D, 0x1D81)] and bus.registers[0x800D] == 0x1D81
+    # nothing changed, nothing written
+    assert regs.update(dict(refresh_rate=3, subpage_enable=1)) == 0
+    # one write per register changed
+    assert regs.update(dict(refresh_rate=4, fmplus_enable=1)) == 2
+    assert (bus.reads, bus.writes) == (1, 3)
+
+    # the camera may or may not have taken a failed write, so it's read again
+    bus.reset_counts()
+    bus.fail_writes = 1
+    try:
+        regs['refresh_rate'] = 5
+    except OSError:
+        pass
+    else:
+        assert False, "failed write not raised"
+    assert bus.reads == 0
+    assert regs['refresh_rate'] == 4 and bus.reads_at == {0x800D: 1}
+    assert regs['refresh_rate'] == 4 and bus.reads == 1
+    # the other cached registers keep their shadow copies
+    assert regs['fmplus_enable'] == 1 and bus.reads == 1
+
+    regs['refresh_rate'] = 5
+    assert bus.registers[0x800D] >> 7 & 0x7 == 5 and bus.reads == 1
+    print("RegisterMap OK")
+
+
+if __name__ == "__main__":
+
+    test_fields()
+    test_register_map()
@@ -1,70 +1,92 @@
 ## Buffer carving utilties.
 
 from array import array
-from ucollections import namedtuple
-from uctypes import (
-    INT8, UINT8,
-    INT16, UINT16,
-    BFUINT16,
-    BF_POS,
-    BF_LEN,
-    BIG_ENDIAN,
-    addressof,
-    struct as uc_struct,
-)
+try:
+    from micropython import const
+    from ucollections import namedtuple
+except ImportError:
+    # CPython, for the host tools
+    from collections import namedtuple
+    def const(value):
+        return value
 
 def array_filled(typecode, length, fill=0):
     return array(typecode, (fill for i in range(length)))
 
-def twos_complement(bits, value):
-    if value < 0:
-        return value + (1 << bits)
-    if value >= (1 << (bits - 1)):
-        return value - (1 << bits)
-    return value
-
 FD_BYTE = object()
 FD_WORD = object()
 
-FieldDesc = namedtuple('FieldDesc', ('name', 'layout', 'signed_bits'))
+## A field of a 16 bit register: @c bits bits starting @c shift bits from
+#  the least significant end
+FieldDesc = namedtuple('FieldDesc', ('name', 'shift', 'bits', 'signed'))
 def field_desc(name, bits, pos=0, signed=False):
     if bits is FD_WORD:
-        layout = 0 | (INT16 if signed else UINT16)
-        return FieldDesc(name, layout, None)
-    
+        return FieldDesc(name, 0, 16, signed)
+
     if bits is FD_BYTE:
-        layout = pos | (INT8 if signed else UINT8)
-        return FieldDesc(name, layout, None)
+        # pos counts bytes from the least significant end, like bit positions
+        # do
+        return FieldDesc(name, 8*pos, 8, signed)
 
-    layout = 0 | BFUINT16 | pos << BF_POS | bits << BF_LEN
-    return FieldDesc(name, layout, bits if signed else None)
+    return FieldDesc(name, pos, bits, signed)
 
 
+## Decodes the fields of a register word with precomputed shifts and masks.
+#  @details Each field compiles to a (shift, mask, sign bit) tuple once, so
+#           decoding is a shift, an AND and, for signed fields, one compare,
+#           with no allocation.
 class StructProto:
     # data needed to create a Struct
     # can be instantiated once and reused between Struct instances
     def __init__(self, fields):
-        self.layout = {}
-        self.signed = {}
+        self.fields = {}
         for fld in fields:
-            self.layout[fld.name] = fld.layout
-            if fld.signed_bits is not None:
-                self.signed[fld.name] = fld.signed_bits
+            sign = 1 << (fld.bits - 1) if fld.signed else 0
+            self.fields[fld.name] = (fld.shift, (1 << fld.bits) - 1, sign)
+
+    ## Get one field's value from a register word.
+    def decode(self, word, name):
+        shift, mask, sign = self.fields[name]
+        value = (word >> shift) & mask
+        if value & sign:
+            value -= sign << 1
+        return value
+
+    ## Put one field's value into a register word.
+    #  @returns The new word
+    def encode(self, word, name, value):
+        shift, mask, _ = self.fields[name]
+        return (word & ~(mask << shift) & 0xFFFF) | (value & mask) << shift
+
+
+## Convert a buffer of big-endian register words, as they come off the bus,
+#  to an @c array('H') of their values.
+def words_from_be(buf):
+    words = array('H', bytes(len(buf)))
+    for idx in range(len(words)):
+        words[idx] = buf[2*idx] << 8 | buf[2*idx + 1]
+    return words
+
 
+## The fields of one register word held in a 2 byte big-endian buffer,
+#  decoded on each access so they follow changes to the buffer.
 class Struct:
     def __init__(self, buf, proto):
-        self._signed = proto.signed
-        self._struct = uc_struct(addressof(buf), proto.layout, BIG_ENDIAN)
+        self._buf = buf
+        self._fields = proto.fields
 
     def __getitem__(self, name):
-        value = getattr(self._struct, name)
-        signed = self._signed.get(name)
-        if signed is not None:
-            return twos_complement(signed, value)
+        shift, mask, sign = self._fields[name]
+        buf = self._buf
+        value = ((buf[0] << 8 | buf[1]) >> shift) & mask
+        if value & sign:
+            value -= sign << 1
         return value
 
     def __setitem__(self, name, value):
-        signed = self._signed.get(name)
-        if signed is not None:
-            value = twos_complement(signed, value)
-        setattr(self._struct, name, value)
+        shift, mask, _ = self._fields[name]
+        buf = self._buf
+        word = buf[0] << 8 | buf[1]
+        word = (word & ~(mask << shift)) | (value & mask) << shift
+        buf[0] = (word >> 8) & 0xFF
+        buf[1] = word & 0xFF
@@ -2,7 +2,8 @@
 # 
 #  RAW VERSION
 #  This version uses a stripped down MLX90640 driver which produces only raw
-#  data, not calibrated data, in order to save memory.
+#  data, not calibrated data, in order to save memory. Calibrated data can be
+#  switched on with @c MLX_Cam(..., calibrated=True) if memory allows.
 # 
 #  This file contains a wrapper that facilitates the use of a Melexis MLX90640
 #  thermal infrared camera for general use. The wrapper contains a class MLX_Cam
@@ -26,7 +27,248 @@ import utime as time
 from machine import Pin, I2C
 from mlx90640 import MLX90640
 from mlx90640.calibration import NUM_ROWS, NUM_COLS, IMAGE_SIZE, TEMP_K
-from mlx90640.image import ChessPattern, InterleavedPattern
+from mlx90640.image import (ChessPattern, InterleavedPattern, FrameRing, Roi,
+                            RawImage, FRAME_TORN, FRAME_STALE)
+
+## Polls start this long, in ms, before the next subpage is expected
+GUARD_MS = const(20)
+## Polls near the expected time are at least this far apart, in ms
+FINE_MS = const(5)
+
+
+## @brief   A set of camera settings for one kind of work, applied with
+#           MLX_Cam.set_profile().
+#  @details Faster refresh gives fresher images of a moving target but more
+#           noise per image; more ADC bits give less quantization noise but
+#           slower conversions. FM+ lets the camera's I2C run at up to
+#           1 MHz; the bus speed itself is chosen when the I2C object is
+#           made.
+class CameraProfile:
+
+    ## @param   name A name to print
+    #  @param   refresh_rate Subpages per second, a power of 2 from 0.5 to 64
+    #  @param   adc_resolution ADC bits, 16 to 19
+    #  @param   fmplus Whether the camera's I2C FM+ mode is on
+    def __init__(self, name, refresh_rate, adc_resolution, fmplus=True):
+        self.name = name
+        self.refresh_rate = refresh_rate
+        self.adc_resolution = adc_resolution
+        self.fmplus = fmplus
+
+
+## Scanning for targets while nothing is tracked: the camera's power-on
+#  settings
+IDLE = CameraProfile("idle", 2.0, 18)
+## Following a tracked target: fresh images at the cost of some noise
+TRACKING = CameraProfile("tracking", 8.0, 17)
+## A last careful look before firing: less noise, slower images
+CONFIRM = CameraProfile("confirm", 4.0, 19)
+
+
+## @brief   Predicts when the camera will next have a subpage ready, so that
+#           the status register isn't read over the bus when it can't be.
+#  @details The camera measures a subpage every refresh period. Once one has
+#           arrived, due() says not to poll until shortly (the guard time)
+#           before the next one is expected, and after that to poll at most
+#           every @c fine_ms. Each poll's result is passed to polled(). If
+#           the data turns out to have been ready at the first poll, it may
+#           have arrived earlier, so the guard time is doubled; polls wasted
+#           in the window shrink it again. The arrival times are estimated
+#           from the polls, or taken from an interrupt, see attach().
+#
+#      @b Example:
+#      @code
+#      if ready.due():
+#          status = camera.read_status()
+#          ready.polled(status['data_available'])
+#      @endcode
+class DataReadyPredictor:
+
+    ## @brief   Set up a predictor.
+    #  @param   period_ms The camera's refresh period, whole ms per subpage
+    #  @param   guard_ms How long before the expected time polls start
+    #  @param   fine_ms The least time between polls near the expected time
+    def __init__(self, period_ms, guard_ms=GUARD_MS, fine_ms=FINE_MS):
+
+        ## Time between subpages, ms
+        self.period_ms = period_ms
+        ## Polls start this long before the next subpage is expected, ms
+        self.guard_ms = guard_ms
+        ## The guard time is never less than this, ms
+        self._min_guard_ms = guard_ms
+        ## The least time between polls near the expected time, ms
+        self.fine_ms = fine_ms
+        ## ticks_ms() time the next subpage is expected, or None if unknown
+        self.expected = None
+        ## ticks_ms() time of the last poll, or None
+        self._last_poll = None
+        ## Polls since the last subpage which found no data
+        self._misses = 0
+        ## The pin whose interrupt signals data ready, or None
+        self._pin = None
+        ## Set by the interrupt when data is ready
+        self._irq_ready = False
+        ## ticks_ms() time of the last interrupt
+        self._irq_time = 0
+        self.reset_counters()
+
+
+    ## @brief   Zero the counters.
+    def reset_counters(self):
+
+        ## Status reads made over the bus
+        self.polls = 0
+        ## Status reads which found no data
+        self.wasted = 0
+        ## Calls to due() which saved a status read
+        self.skipped = 0
+        ## Subpages found ready whose arrival time is known, over which the
+        #  latency is measured
+        self.arrivals = 0
+        ## Latency from data ready to its poll, ms: the last, the most and
+        #  the total, for the mean
+        self.latency_ms = 0
+        self.latency_max_ms = 0
+        self.latency_total_ms = 0
+
+
+    ## @brief   Change the refresh period, for example with the refresh rate.
+    #  @details The prediction is dropped, so the next due() polls at once.
+    def set_period(self, period_ms):
+
+        self.period_ms = period_ms
+        self.expected = None
+        self._misses = 0
+
+
+    ## @brief   Take data ready from an interrupt instead of from predictions.
+    #  @details The MLX90640 itself has no data ready output, but a board
+    #           which signals it (for example from another sensor triggered
+    #           with the camera) can be attached here. due() then says to
+    #           read only once the interrupt has come, or if it is a whole
+    #           period late, in case an edge was missed.
+    #  @param   pin A @c machine.Pin set up as an input
+    #  @param   trigger The edge which means data ready, default rising
+    def attach(self, pin, trigger=None):
+
+        if trigger is None:
+            trigger = pin.IRQ_RISING
+        self._pin = pin
+        self._irq_ready = False
+        pin.irq(handler=self._on_irq, trigger=trigger)
+
+
+    ## @brief   Stop using the interrupt.
+    def detach(self):
+
+        if self._pin is not None:
+            self._pin.irq(handler=None)
+            self._pin = None
+        self._irq_ready = False
+
+
+    ## Interrupt handler; it must not allocate.
+    def _on_irq(self, pin):
+
+        self._irq_time = time.ticks_ms()
+        self._irq_ready = True
+
+
+    ## @brief   Tell whether the status register is worth reading now.
+    #  @param   now The ticks_ms() time, default now
+    #  @returns @c True to poll, @c False if the data can't be ready yet
+    def due(self, now=None):
+
+        if now is None:
+            now = time.ticks_ms()
+        if self.expected is None or self._irq_ready:
+            return True
+        wait = time.ticks_diff(self.expected, now)
+        if self._pin is not None:
+            # a missed edge is caught a period later
+            due = wait < -self.period_ms
+        elif wait > self.guard_ms:
+            due = False
+        else:
+            due = (self._last_poll is None
+                   or time.ticks_diff(now, self._last_poll) >= self.fine_ms)
+        if not due:
+            self.skipped += 1
+        return due
+
+
+    ## @brief   Tell how long until due() may first say to poll.
+    #  @param   now The ticks_ms() time, default now
+    #  @returns A delay in ms, 0 if a poll is due
+    def wait_ms(self, now=None):
+
+        if now is None:
+            now = time.ticks_ms()
+        if self.expected is None or self._irq_ready:
+            return 0
+        if self._pin is not None:
+            wait = time.ticks_diff(self.expected, now) + self.period_ms
+        else:
+            wait = time.ticks_diff(self.expected, now) - self.guard_ms
+            if self._last_poll is not None:
+                wait = max(wait, self.fine_ms
+                           - time.ticks_diff(now, self._last_poll))
+        return max(wait, 0)
+
+
+    ## @brief   Record the result of reading the status register.
+    #  @param   ready Whether data was available
+    #  @param   now The ticks_ms() time of the poll, default now
+    def polled(self, ready, now=None):
+
+        if now is None:
+            now = time.ticks_ms()
+        self.polls += 1
+        if not ready:
+            self.wasted += 1
+            self._misses += 1
+            self._last_poll = now
+            return
+
+        # Estimate when the data arrived: the interrupt's time, or the
+        # expected time unless the last empty poll shows it came later. The
+        # camera overwrites its data every period, so an estimate more than
+        # a period old, say after a spell without polls, means the time is
+        # unknown; the prediction starts again from this poll
+        expected = self.expected
+        if self._irq_ready:
+            arrival = self._irq_time
+        elif expected is None or time.ticks_diff(expected, now) > 0:
+            arrival = now
+        elif (self._misses and self._last_poll is not None
+              and time.ticks_diff(self._last_poll, expected) > 0):
+            arrival = self._last_poll
+        else:
+            arrival = expected
+        self._irq_ready = False
+        known = time.ticks_diff(now, arrival) <= self.period_ms
+        if not known:
+            arrival = now
+
+        # Ready at the first poll of the window means it may have come
+        # earlier than the guard allowed for; polls wasted waiting for it
+        # mean the guard can be tighter
+        if expected is not None and self._pin is None and known:
+            if not self._misses:
+                self.guard_ms = min(2*self.guard_ms, self.period_ms//2)
+            elif self._misses > 2:
+                self.guard_ms = max(self.guard_ms - self.fine_ms,
+                                    self._min_guard_ms)
+
+        latency = time.ticks_diff(now, arrival)
+        self.latency_ms = latency
+        if known:
+            self.latency_max_ms = max(self.latency_max_ms, latency)
+            self.latency_total_ms += latency
+            self.arrivals += 1
+        self.expected = time.ticks_add(arrival, self.period_ms)
+        self._last_poll = now
+        self._misses = 0
 
 
 ## @brief   Class which wraps an MLX90640 thermal infrared camera driver to
@@ -44,8 +286,26 @@ class MLX_Cam:
     #           the pixels at a time (default ChessPattern)
     #  @param   width The width of the image in pixels; leave it at default
     #  @param   height The height of the image in pixels; leave it at default
+    #  @param   calibrated Compensate each subpage as it arrives so that real
+    #           temperatures are available, at the cost of about 8 kB more
+    #           memory (default False, giving raw data only)
+    #  @param   frames How many raw frame buffers to keep for capture() and
+    #           lease_frame(), each 1.5 kB; 2 or more lets
+    #           one frame be acquired while another is being analyzed
+    #  @param   full_every While a region of interest is set, every this
+    #           many frames is still read whole so new targets are seen
+    #  @param   predict Skip reading the camera's status until shortly
+    #           before a subpage is expected, see DataReadyPredictor
+    #           (default True)
+    #  @param   hold Have the camera hold each subpage in RAM until it has
+    #           been read, so a slow read can't be overwritten halfway
+    #           (default False); see MLX90640.data_hold
+    #  @param   watch_every Every this many whole frames is also searched
+    #           for pixels which have gone bad, see BadPixelMap.observe();
+    #           0 (default) only patches the pixels flagged in the EEPROM
     def __init__(self, i2c, address=0x33, pattern=ChessPattern,
-                 width=NUM_COLS, height=NUM_ROWS):
+                 width=NUM_COLS, height=NUM_ROWS, calibrated=False, frames=1,
+                 full_every=4, predict=True, hold=False, watch_every=0):
 
         ## The I2C bus to which the camera is attached
         self._i2c = i2c
@@ -59,17 +319,118 @@ class MLX_Cam:
         self._height = height
         ## Tracks whether an image is currently being retrieved
         self._getting_image = False
-        ## Which subpage (checkerboard half) of the image is being retrieved
-        self._subpage = 0
+        ## Bit (1 << subpage id) set for each half of the image retrieved
+        self._halves = 0
+        ## FRAME_TORN and FRAME_STALE bits of the last image from
+        #  get_image() or get_image_nonblocking()
+        self.frame_flags = 0
+        ## Id and ticks_ms() time of the last subpage read, for checking
+        #  that the halves of a frame were measured one after the other
+        self._last_sp = None
+        self._last_sp_ms = 0
+        ## Frames completed, and how many of them were torn or stale
+        self.frames_read = 0
+        self.frames_torn = 0
+        self.frames_stale = 0
+        ## Whether images are compensated into temperature-ready data
+        self._calibrated = calibrated
+
+        ## Ring of frame buffers for capture() and lease_frame(), if any
+        self._ring = FrameRing(frames) if frames > 1 else None
+        ## Sequence number of the last frame leased
+        self._last_seq = 0
+        ## Region of interest which capture() and stream() read, or None
+        self._roi = None
+        ## Every this many frames is read whole even with a region of interest
+        self._full_every = full_every
+        ## Frames begun by capture() and stream(), for the full refreshes
+        self._frames_begun = 0
+        ## The region the frame being read uses, without a frame ring
+        self._frame_roi = None
 
         # The MLX90640 object that does the work
         self._camera = MLX90640(i2c, address)
         self._camera.set_pattern(pattern)
-        self._camera.setup()
+        # the camera's own image is only read into without a frame ring, or
+        # by get_image(), so reads never land in a frame which is leased
+        self._camera.setup(
+            raw=RawImage(scratch=self._ring.scratch) if self._ring else None,
+            calibrated=calibrated)
+        if hold:
+            self._camera.data_hold = True
 
         ## A local reference to the image object within the camera driver
         self._image = self._camera.raw
 
+        ## The BadPixelMap patched into every frame completed
+        self.bad_pixels = self._camera.bad_pixels
+        ## Every this many whole frames is searched for new bad pixels
+        self._watch_every = watch_every
+        ## Whole frames completed, for watch_every
+        self._frames_whole = 0
+
+        ## The CameraProfile last set, or None if the settings are otherwise
+        self.profile = None
+
+        ## Time between subpages, ms
+        self._period_ms = int(1000 / self._camera.refresh_rate)
+        ## Predicts when the next subpage is ready, or None to always poll
+        self.data_ready = None
+        if predict:
+            self.data_ready = DataReadyPredictor(self._period_ms)
+
+
+    ## @brief   Switch the camera to a CameraProfile.
+    #  @details The settings are written in one batch, only the registers
+    #           which change, and nothing is written if the profile is
+    #           already in use. Subpages measured during the switch may
+    #           mix the old and new settings, so callers wanting clean data
+    #           should use frames started after it.
+    #  @param   profile The profile, such as @c IDLE, @c TRACKING or
+    #           @c CONFIRM
+    #  @returns @c True if the camera's settings were changed
+    def set_profile(self, profile):
+
+        if profile is self.profile:
+            return False
+        self._camera.configure(refresh_rate=profile.refresh_rate,
+                               adc_resolution=profile.adc_resolution,
+                               fmplus=profile.fmplus)
+        self.profile = profile
+        self._period_ms = int(1000 / profile.refresh_rate)
+        if self.data_ready is not None:
+            self.data_ready.set_period(self._period_ms)
+        return True
+
+
+    ## The camera's refresh rate in Hz, subpages per second.
+    @property
+    def refresh_rate(self):
+        return self._camera.refresh_rate
+
+    @refresh_rate.setter
+    def refresh_rate(self, freq):
+        self._camera.refresh_rate = freq
+        self.profile = None
+        self._period_ms = int(1000 / self._camera.refresh_rate)
+        if self.data_ready is not None:
+            self.data_ready.set_period(self._period_ms)
+
+
+    ## @brief   Read the camera's status, unless the data ready predictor
+    #           says no subpage can be ready yet.
+    #  @returns The status snapshot if data is available, else @c None
+    def _poll(self):
+
+        ready = self.data_ready
+        if ready is not None and not ready.due():
+            return None
+        status = self._camera.read_status()
+        available = status['data_available']
+        if ready is not None:
+            ready.polled(available)
+        return status if available else None
+
 
     ## @brief   Show low-resolution camera data as shaded pixels on a text
     #           screen.
@@ -174,14 +535,114 @@ class MLX_Cam:
     #           combination is sketchy and not fully tested). It is assumed
     #           that the camera is in the ChessPattern (default) mode as it
     #           probably should be.
-    #  @returns A reference to the image object we've just filled with data
+    #  @returns A reference to the image object we've just filled with data;
+    #           in calibrated mode this is the processed image
     def get_image(self):
 
-        for subpage in (0, 1):
-            while not self._camera.has_data:
-                time.sleep_ms(50)
-            image = self._camera.read_image(subpage)
+        self._halves = 0
+        self._getting_image = False
+        image = None
+        while image is None:
+            status = self._poll()
+            while status is None:
+                if self.data_ready is not None:
+                    # sleep until the next poll is due
+                    time.sleep_ms(max(self.data_ready.wait_ms(), 1))
+                else:
+                    time.sleep_ms(50)
+                status = self._poll()
+            image = self._read_half(status)
+
+        return image
+
+
+    ## @brief   Read the half of the image the camera has ready, for
+    #           get_image() and get_image_nonblocking().
+    #  @details The halves are read in the order the camera measures them.
+    #           If the same half comes twice, the other was missed and the
+    #           image starts again from the newer one.
+    #  @returns The image once both halves have been read, else @c None
+    def _read_half(self, status):
+
+        sp_id = status['last_subpage']
+        flags = self._sequence(sp_id)
+        if self._halves & (1 << sp_id):
+            self._halves = 0
+        if self._halves:
+            self.frame_flags |= flags
+        else:
+            self.frame_flags = flags & FRAME_STALE
+        image = self._read_subpage(sp_id, status)
+        self._halves |= 1 << sp_id
+        if self._halves != 0x3:
+            return None
+        self._halves = 0
+        self._count_frame(self.frame_flags)
+        self._finish_frame(image, True)
+        return image
+
 
+    ## @brief   Follow the sequence of subpages read.
+    #  @details A subpage follows on from the one read before it if its id
+    #           differs and it was read within two refresh periods: an odd
+    #           number of missed subpages repeats the id, and an even number
+    #           takes more than two periods.
+    #  @param   sp_id The id of the subpage being read
+    #  @returns FRAME_TORN if it doesn't follow on from the last subpage
+    #           read, and FRAME_STALE if it waited longer than a refresh
+    #           period to be read (known only with the data ready predictor)
+    def _sequence(self, sp_id):
+
+        now = time.ticks_ms()
+        flags = 0
+        if (self._last_sp is not None
+                and (sp_id == self._last_sp or time.ticks_diff(
+                    now, self._last_sp_ms) >= 2*self._period_ms)):
+            flags |= FRAME_TORN
+        ready = self.data_ready
+        if ready is not None and ready.latency_ms > ready.period_ms:
+            flags |= FRAME_STALE
+        self._last_sp = sp_id
+        self._last_sp_ms = now
+        return flags
+
+
+    ## @brief   Count a completed frame by its flags.
+    def _count_frame(self, flags):
+
+        self.frames_read += 1
+        if flags & FRAME_TORN:
+            self.frames_torn += 1
+        if flags & FRAME_STALE:
+            self.frames_stale += 1
+
+
+    ## @brief   Patch the bad pixels of a completed image.
+    #  @details Every @c watch_every whole frames, the raw counts are first
+    #           searched for pixels which have gone bad. Frames read with a
+    #           region of interest aren't searched, as most of their pixels
+    #           are left over from older frames and would look stuck.
+    #  @param   image A raw image or Frame, or in calibrated mode the
+    #           processed image
+    #  @param   whole Whether every pixel of the image was just read
+    def _finish_frame(self, image, whole):
+
+        if whole and self._watch_every:
+            self._frames_whole += 1
+            if self._frames_whole % self._watch_every == 0:
+                raw = image if isinstance(image, RawImage) else self._camera.last_raw
+                self.bad_pixels.observe(raw.pix)
+        if isinstance(image, RawImage):
+            self.bad_pixels.patch(image.pix)
+        else:
+            image.interpolate_bad_pixels(self.bad_pixels)
+
+
+    ## @brief   Read one subpage, and compensate it in calibrated mode.
+    def _read_subpage(self, subpage, status, raw=None, roi=None):
+        image = self._camera.read_image(subpage, status, raw, roi)
+        if self._calibrated:
+            image = self._camera.process_image()
         return image
 
 
@@ -203,24 +664,192 @@ class MLX_Cam:
 
         # If this is the first recent call, begin the process
         if not self._getting_image:
-            self._subpage = 0
+            self._halves = 0
             self._getting_image = True
         
-        # Read whichever subpage needs to be read, or wait until data is ready
-        if not self._camera.has_data:
+        # Read whichever subpage the camera has ready, or wait until data is
+        # ready; one status read serves both the check and the read, and none
+        # is made while the next subpage can't be ready yet
+        status = self._poll()
+        if status is None:
             return None
         
-        image = self._camera.read_image(self._subpage)
-        
-        # If we just got subpage zero, we need to come back and get subpage 1;
-        # if we just got subpage 1, we're done
-        if self._subpage == 0:
-            self._subpage = 1
-            return None
-        else:
+        # Once both halves are in, we're done
+        image = self._read_half(status)
+        if image is not None:
             self._getting_image = False
+        return image
+
+
+    ## @brief   Advance the acquisition of frames into the frame ring.
+    #  @details This is called repeatedly, for example every time a task
+    #           runs, and reads a subpage whenever the camera has one ready.
+    #           Meanwhile frames already acquired can be leased and analyzed.
+    #           The frames hold raw data; in calibrated mode only the
+    #           camera's single processed image is compensated. Needs
+    #           @c frames=2 or more.
+    #  @returns The Frame just completed, or @c None
+    def capture(self):
+
+        frame = self._read_next()
+        if frame is not None and frame.seq:
+            return frame
+        return None
+
+
+    ## @brief   Stream subpages as soon as each one is read.
+    #  @details Each step of the generator checks the camera once. A step
+    #           gives @c None if no subpage was ready, otherwise a tuple
+    #           <tt>(subpage, image)</tt> of the Subpage just read and the
+    #           image holding it. Subpages come in the order the camera
+    #           measures them, so a half-resolution image is available one
+    #           refresh period before the whole frame; see
+    #           RawImage.interpolate(). With a frame ring the image is the
+    #           Frame being filled, which is complete once its @c seq is set
+    #           and can then be leased as usual.
+    #
+    #      @b Example:
+    #      @code
+    #      for item in camera.stream():
+    #          if item:
+    #              (subpage, image) = item
+    #              ...
+    #          yield
+    #      @endcode
+    def stream(self):
+
+        while True:
+            image = self._read_next()
+            if image is None:
+                yield None
+            else:
+                yield (self._camera.last_read, image)
+
+
+    ## @brief   Read the subpage the camera has ready, if any, into the frame
+    #           ring's frame being filled or the camera's raw image.
+    #  @returns The image read into, or @c None
+    def _read_next(self):
+
+        if self._ring is not None:
+            image = self._ring.writer()
+            if image is None:
+                # every slot is leased; the camera holds its data for us
+                return None
+        else:
+            image = self._camera.raw
+
+        status = self._poll()
+        if status is None:
+            return None
+
+        sp_id = status['last_subpage']
+        flags = self._sequence(sp_id)
+        if self._ring is None:
+            if self._halves & (1 << sp_id):
+                # the other half was missed; start the frame again from this one
+                self._halves = 0
+            if self._halves:
+                self.frame_flags |= flags
+            else:
+                self.frame_flags = flags & FRAME_STALE
+                self._frame_roi = self._begin_frame()
+            read = self._read_subpage(sp_id, status, None, self._frame_roi)
+            self._halves |= 1 << sp_id
+            if self._halves == 0x3:
+                self._halves = 0
+                self._count_frame(self.frame_flags)
+                self._finish_frame(read, self._frame_roi is None)
             return image
 
+        # only now, with data to read, is the slot's old frame given up
+        self._ring.begin()
+        if image.halves & (1 << sp_id):
+            # the other half was missed; start the frame again from this one
+            image.halves = 0
+            image.started = time.ticks_ms()
+        elif not image.halves:
+            image.started = time.ticks_ms()
+            image.roi = self._begin_frame()
+        if image.halves:
+            image.flags |= flags
+        else:
+            image.flags = flags & FRAME_STALE
+        self._read_subpage(sp_id, status, image, image.roi)
+        image.halves |= 1 << sp_id
+        if image.halves == 0x3:
+            self._count_frame(image.flags)
+            self._finish_frame(image, image.roi is None)
+            self._ring.publish(time.ticks_ms())
+        return image
+
+
+    ## @brief   Pick the region to read a new frame with.
+    #  @returns The region of interest, or @c None when the frame is due to
+    #           be read whole
+    def _begin_frame(self):
+
+        self._frames_begun += 1
+        if self._roi is None or self._frames_begun % self._full_every == 0:
+            return None
+        return self._roi
+
+
+    ## @brief   Read only a window of the image in capture() and stream().
+    #  @details Only the RAM words covering the window are read, in one burst
+    #           per row for narrow windows. Every @c full_every frames the
+    #           whole image is still read. A frame's @c roi tells which
+    #           region it was read with; its pixels outside it are left over
+    #           from an older frame. The window can be moved or resized at
+    #           any time and takes effect from the next frame.
+    #  @param   row The first row of the window
+    #  @param   col The first column of the window, counted as in get_csv(),
+    #           which mirrors the image left to right
+    #  @param   rows The height of the window in rows
+    #  @param   cols The width of the window in columns
+    def set_roi(self, row, col, rows, cols):
+
+        roi = Roi(row, self._width - col - cols, rows, cols)
+        if not (roi.rows and roi.cols):
+            self._roi = None
+        elif roi != self._roi:
+            # a new Roi builds its pixel tables again
+            self._roi = roi
+
+
+    ## @brief   Go back to reading the whole image in every frame.
+    def clear_roi(self):
+
+        self._roi = None
+
+
+    ## @brief   Lease the newest frame acquired by capture() which hasn't
+    #           been leased before.
+    #  @details The frame isn't overwritten until it is handed back with
+    #           release_frame().
+    #  @param   since A @c ticks_ms() time; frames whose acquisition started
+    #           before it are ignored, for example ones taken while the
+    #           turret was still moving
+    #  @returns A Frame, with @c seq, @c started, @c timestamp and
+    #           @c flags (FRAME_TORN, FRAME_STALE), or @c None if there's no
+    #           new frame yet
+    def lease_frame(self, since=None):
+
+        frame = self._ring.lease(self._last_seq)
+        if frame is None:
+            return None
+        if since is not None and time.ticks_diff(frame.started, since) < 0:
+            self._ring.release(frame)
+            return None
+        self._last_seq = frame.seq
+        return frame
+
+
+    ## @brief   Hand back a frame from lease_frame() so it can be reused.
+    def release_frame(self, frame):
+
+        self._ring.release(frame)
+
 
 ## This test function sets up the sensor, then grabs and shows an image in a
 #  terminal every few seconds. By default it shows ASCII art, but it can be
@@ -253,9 +882,9 @@ def test_MLX_cam():
 
     # Create the camera object and set it up in default mode
     camera = MLX_Cam(i2c_bus)
-    print(f"Current refresh rate: {camera._camera.refresh_rate}")
-    camera._camera.refresh_rate = 10.0
-    print(f"Refresh rate is now:  {camera._camera.refresh_rate}")
+    print(f"Current refresh rate: {camera.refresh_rate}")
+    camera.refresh_rate = 10.0
+    print(f"Refresh rate is now:  {camera.refresh_rate}")
 
     while True:
         try:
@@ -288,6 +917,16 @@ def test_MLX_cam():
                 camera.ascii_art(image)
             gc.collect()
             print(f"Memory: {gc.mem_free()} B free")
+            regs = camera._camera.registers
+            saved = sum(regs.hits.values())
+            print(f"Register reads: {sum(regs.misses.values())} on the bus, "
+                  f"{saved} served from cache")
+            ready = camera.data_ready
+            print(f"Status polls: {ready.polls}, {ready.wasted} wasted, "
+                  f"{ready.skipped} skipped; latency {ready.latency_ms} ms, "
+                  f"max {ready.latency_max_ms} ms")
+            print(f"Frames: {camera.frames_read}, {camera.frames_torn} torn, "
+                  f"{camera.frames_stale} stale")
             #time.sleep_ms(3141)
             arrayImage = []
             hOffset = const(-10)
@@ -331,8 +970,95 @@ def test_MLX_cam():
     print ("Done.")
 
 
+## Check DataReadyPredictor against a simulated camera whose subpages come
+#  every 125 ms, polled every 10 ms as task4 runs.
+def test_data_ready_predictor():
+
+    ready = DataReadyPredictor(125)
+    read = -1
+    for now in range(0, 2000, 10):
+        # the subpage measured most recently, by now
+        latest = (now - 37) // 125
+        if ready.due(now):
+            data = latest > read
+            ready.polled(data, now)
+            if data:
+                read = latest
+    assert ready.arrivals >= 15, ready.arrivals
+    assert ready.latency_max_ms <= 10 + FINE_MS, ready.latency_max_ms
+    # without prediction every one of the 200 calls would read the bus
+    assert ready.polls < 80 and ready.skipped > 120, (ready.polls, ready.skipped)
+
+    # after three seconds without a poll the expected time is long past:
+    # the data is fresh, not stale, and the guard isn't widened for it
+    guard = ready.guard_ms
+    ready.polled(True, 5000)
+    assert ready.latency_ms <= ready.period_ms, ready.latency_ms
+    assert ready.guard_ms == guard, ready.guard_ms
+    assert ready.latency_max_ms <= 10 + FINE_MS, ready.latency_max_ms
+    assert ready.expected == 5000 + 125, ready.expected
+    print(f"DataReadyPredictor OK: {ready.polls} polls, {ready.wasted} wasted")
+
+
+## Check that stream() without a frame ring counts the frames it completes,
+#  and that a frame read after a spell without polling isn't taken as stale.
+def test_stream():
+    from mlx90640.fakebus import FakeCameraBus
+
+    bus = FakeCameraBus()
+    camera = MLX_Cam(bus)
+    ready = camera.data_ready
+    subpages = camera.stream()
+    for value in range(8):
+        bus.measure(value)
+        # the subpage is due now
+        time.sleep_ms(ready.fine_ms)
+        ready.expected = time.ticks_ms()
+        assert next(subpages) is not None
+    assert camera.frames_read == 4 and not camera.frames_stale, camera.frames_read
+    assert camera._camera.raw.pix[0] == 6 and camera._camera.raw.pix[1] == 7
+
+    # the camera carries on measuring while nobody polls it
+    ready.expected = time.ticks_add(time.ticks_ms(), -3000)
+    for value in range(2):
+        bus.measure(value)
+        time.sleep_ms(ready.fine_ms)
+        assert next(subpages) is not None
+        ready.expected = time.ticks_ms()
+    assert camera.frames_read == 5, camera.frames_read
+    assert not camera.frames_stale and not camera.frame_flags & FRAME_STALE
+    print("stream OK")
+
+
+def test_leased_frame():
+    from mlx90640.fakebus import FakeCameraBus
+
+    bus = FakeCameraBus()
+    camera = MLX_Cam(bus, frames=2, predict=False)
+    frame = None
+    for value in (1, 2):
+        bus.measure(value)
+        frame = camera.capture() or frame
+    frame = camera.lease_frame()
+    assert frame is not None and frame.pix[0] == 1 and frame.pix[1] == 2
+
+    # reading outside the ring leaves the leased frame alone
+    image = None
+    for value in (3, 4):
+        bus.measure(value)
+        image = camera.get_image_nonblocking()
+    assert image is not None and image is not frame
+    assert image.pix[0] == 3 and image.pix[1] == 4, image.pix[:2]
+    assert frame.pix[0] == 1 and frame.pix[1] == 2, frame.pix[:2]
+    camera.release_frame(frame)
+    print("leased frame OK")
+
+
 if __name__ == "__main__":
 
+    test_data_ready_predictor()
+    test_stream()
+    test_leased_frame()
     test_MLX_cam()
 
 
@@ -0,0 +1,189 @@
+"""!
+@file motion_profile.py
+Generates smooth setpoints for the Controller, moving to a target under velocity, acceleration and jerk limits
+"""
+import math
+import utime
+
+## A call to update() more than this many microseconds after the last one
+#  only advances the profile this far, as it wasn't being followed meanwhile
+MAX_DT_US = const(100000)
+
+## The profile is advanced in steps of at most this many microseconds, so that
+#  it can brake in time however seldom update() is called
+STEP_US = const(2000)
+
+## Within this distance of the target, at rest, the profile finishes on it
+FINISH_DISTANCE = 0.5
+
+
+def stopDistance(velocity, accel, maxAccel, maxJerk):
+    """!
+    Finds how far a move goes before it can stop, braking as hard as the limits allow: the deceleration ramps up at
+    the jerk limit to at most maxAccel, is held, and ramps back to zero just as the velocity does
+    @param velocity The velocity towards the target, which must not be negative
+    @param accel The acceleration towards the target
+    @param maxAccel The acceleration limit
+    @param maxJerk The jerk limit
+    @returns The distance travelled before stopping
+    """
+    peak = min(maxAccel, math.sqrt(max(maxJerk*velocity + accel*accel/2, 0)))
+    peak = max(peak, -accel)
+    # ramp the deceleration up to its peak
+    t1 = (accel + peak)/maxJerk
+    x1 = velocity*t1 + accel*t1*t1/2 - maxJerk*t1*t1*t1/6
+    v1 = velocity + (accel*accel - peak*peak)/(2*maxJerk)
+    # hold it
+    t2 = max(v1 - peak*peak/(2*maxJerk), 0)/peak if peak else 0
+    x2 = v1*t2 - peak*t2*t2/2
+    v2 = v1 - peak*t2
+    # and ramp it back down to zero
+    t3 = peak/maxJerk
+    x3 = v2*t3 - peak*t3*t3/2 + maxJerk*t3*t3*t3/6
+    return x1 + x2 + x3
+
+
+class MotionProfile:
+    """!
+    This class turns a target position into a setpoint which moves to it in time, as fast as velocity, acceleration
+    and jerk limits allow. The trajectory is worked out a step at a time, so the target can be changed at any time,
+    even mid-move, and the setpoint carries on smoothly from where it is
+    """
+    def __init__(self, maxVelocity, maxAccel, maxJerk):
+        """!
+        Create a motion profile which starts at rest at position 0
+        @param maxVelocity The velocity limit, in position units (such as encoder ticks) per second
+        @param maxAccel The acceleration limit, in units per second squared
+        @param maxJerk The jerk limit, in units per second cubed
+        @returns MotionProfile
+        """
+        self.maxVelocity = abs(maxVelocity)
+        self.maxAccel = abs(maxAccel)
+        self.maxJerk = abs(maxJerk)
+        self.reset(0)
+
+    def reset(self, position, velocity=0):
+        """!
+        Starts the profile again from a position, for example the encoder's reading when a move begins
+        @param position The position to start from, which also becomes the target
+        @param velocity The velocity to start with
+        @returns None
+        """
+        self.position = position
+        self.velocity = velocity
+        self.accel = 0
+        self.target = position
+        self.lastTime = None
+
+    def set_target(self, target):
+        """!
+        Sets the position to move to, which can be changed while moving
+        @param target The target position
+        @returns None
+        """
+        self.target = target
+
+    def done(self):
+        """!
+        Checks whether the profile has reached its target and stopped there
+        @returns bool
+        """
+        return self.position == self.target and self.velocity == 0
+
+    def update(self, now=None):
+        """!
+        Advances the profile to the present time, to be called every time the controller runs
+        @param now The time from utime.ticks_us(), read here if not given
+        @returns The setpoint position; its velocity, for feedforward, is in the velocity attribute
+        """
+        if now is None:
+            now = utime.ticks_us()
+        if self.lastTime is None:
+            dt = 0
+        else:
+            dt = min(utime.ticks_diff(now, self.lastTime), MAX_DT_US)
+        self.lastTime = now
+        while dt > 0:
+            step = min(dt, STEP_US)
+            self._step(step/1000000)
+            dt -= step
+        return self.position
+
+    def _step(self, dt):
+        """!
+        Advances the profile by one step, choosing the jerk which accelerates towards the target, cruises, or brakes
+        to stop on it
+        @param dt The length of the step, in seconds
+        @returns None
+        """
+        maxAccel = self.maxAccel
+        maxJerk = self.maxJerk
+        # work with the target in the positive direction
+        distance = self.target - self.position
+        sign = 1 if distance >= 0 else -1
+        distance *= sign
+        velocity = self.velocity*sign
+        accel = self.accel*sign
+
+        if (distance < FINISH_DISTANCE and abs(velocity) < maxJerk*dt*dt
+                and abs(accel) <= maxJerk*dt):
+            self.position = self.target
+            self.velocity = 0
+            self.accel = 0
+            return
+
+        # brake if one more step of speeding up would leave too little room to stop
+        nextAccel = min(accel + maxJerk*dt, maxAccel)
+        nextVelocity = velocity + (accel + nextAccel)/2*dt
+        nextDistance = distance - (velocity*dt + accel*dt*dt/2 + maxJerk*dt*dt*dt/6)
+        if nextVelocity >= 0 and stopDistance(nextVelocity, nextAccel, maxAccel, maxJerk) >= nextDistance:
+            wanted = -min(maxAccel, math.sqrt(max(maxJerk*max(velocity, 0) + accel*accel/2, 0)))
+        elif velocity + accel*abs(accel)/(2*maxJerk) >= self.maxVelocity:
+            # the velocity reaches its limit as the acceleration ramps down to zero
+            wanted = 0
+        else:
+            wanted = maxAccel
+
+        change = max(-maxJerk*dt, min(maxJerk*dt, wanted - accel))
+        newAccel = accel + change
+        self.position += sign*(velocity*dt + accel*dt*dt/2 + change*dt*dt/6)
+        self.velocity = sign*(velocity + (accel + newAccel)/2*dt)
+        self.accel = sign*newAccel
+
+
+def test_motion_profile():
+    """!
+    Checks that profiled moves, short and long, reach their targets without overshooting or breaking the limits, and
+    that a move reversed partway stops and comes back
+    @returns None
+    """
+    (maxVelocity, maxAccel, maxJerk) = (50000, 500000, 10000000)
+    for distance in (20, 700, 12800, -3000):
+        profile = MotionProfile(maxVelocity, maxAccel, maxJerk)
+        profile.set_target(distance)
+        now = 0
+        furthest = 0
+        while not profile.done():
+            position = profile.update(now)
+            assert abs(profile.velocity) <= maxVelocity*1.001
+            assert abs(profile.accel) <= maxAccel*1.001
+            furthest = max(furthest, position*(1 if distance > 0 else -1))
+            now += 10000
+            assert now < 2000000, f"move of {distance} didn't finish"
+        assert furthest <= abs(distance), f"move of {distance} overshot to {furthest}"
+
+    profile = MotionProfile(maxVelocity, maxAccel, maxJerk)
+    profile.set_target(12800)
+    for now in range(0, 200000, 10000):
+        profile.update(now)
+    profile.set_target(0)
+    while not profile.done():
+        profile.update(now)
+        now += 10000
+        assert now < 3000000, "reversed move didn't finish"
+    assert profile.position == 0
+    print("MotionProfile OK")
+
+
+if __name__ == "__main__":
+    test_motion_profile()
@@ -0,0 +1,347 @@
+"""!
+@file targeting.py
+Finds targets in camera images in place, without converting them to text
+"""
+
+from array import array
+from mlx90640.calibration import NUM_ROWS, NUM_COLS, IMAGE_SIZE
+
+## Rows at the top of the image which are ignored when looking for targets
+EXCLUDE_ROWS = const(4)
+
+## Label given to blobs found after the label buffer's 254 numbers run out
+UNTRACKED = const(255)
+
+
+class Hotspot:
+    def __init__(self):
+        """!
+        Holds the location and value of the hottest pixel in an image. Rows
+        and columns are as printed by MLX_Cam.get_csv(), which mirrors the
+        columns of the camera's image left to right
+        """
+        self.row = 0
+        self.col = 0
+        self.value = 0
+
+    def __repr__(self):
+        return f"Hotspot(row={self.row}, col={self.col}, value={self.value})"
+
+
+def find_hotspot(raw, roi=None, exclude_rows=EXCLUDE_ROWS, out=None):
+    """!
+    Finds the hottest pixel in an image by scanning its pixel array in place.
+    Pixels are compared in the same order as the rows of MLX_Cam.get_csv(),
+    so ties go to the same pixel as they would when searching the CSV text
+    @param raw A RawImage, or any other image with a @c pix array or an array
+           of NUM_ROWS*NUM_COLS pixels itself
+    @param roi Region to search, as (first row, first col, rows, cols) in CSV
+           coordinates; default the whole image
+    @param exclude_rows Rows before this one are never searched
+    @param out A Hotspot to fill in, so that repeated searches don't allocate
+    @returns The filled in Hotspot, or None if the region holds no pixels
+    """
+    pix = getattr(raw, 'pix', raw)
+    if roi is None:
+        row_0, col_0, row_1, col_1 = 0, 0, NUM_ROWS, NUM_COLS
+    else:
+        row_0, col_0 = roi[0], roi[1]
+        row_1, col_1 = row_0 + roi[2], col_0 + roi[3]
+    row_0 = max(row_0, exclude_rows, 0)
+    row_1 = min(row_1, NUM_ROWS)
+    col_0 = max(col_0, 0)
+    col_1 = min(col_1, NUM_COLS)
+    if row_0 >= row_1 or col_0 >= col_1:
+        return None
+
+    # CSV column c is image column NUM_COLS - 1 - c
+    best_idx = row_0*NUM_COLS + NUM_COLS - 1 - col_0
+    best = pix[best_idx]
+    for row in range(row_0, row_1):
+        end = row*NUM_COLS + NUM_COLS - 1
+        for idx in range(end - col_0, end - col_1, -1):
+            if pix[idx] > best:
+                best = pix[idx]
+                best_idx = idx
+
+    out = out or Hotspot()
+    out.row = best_idx // NUM_COLS
+    out.col = NUM_COLS - 1 - best_idx % NUM_COLS
+    out.value = best
+    return out
+
+
+class Blob:
+    def __init__(self):
+        """!
+        Holds one connected group of hot pixels. Rows and columns are in the
+        same mirrored coordinates as Hotspot, and the centroid is weighted by
+        how far each pixel is above the detection threshold
+        """
+        self.row = 0.0
+        self.col = 0.0
+        self.area = 0
+        self.weight = 0.0
+        self.peak = 0
+        self.min_row = 0
+        self.min_col = 0
+        self.max_row = 0
+        self.max_col = 0
+
+    def __repr__(self):
+        return (f"Blob(row={self.row:.2f}, col={self.col:.2f}, "
+                f"area={self.area}, weight={self.weight:.1f})")
+
+
+class BlobDetector:
+    def __init__(self, max_blobs=3, spread=0.5, min_area=1,
+                 exclude_rows=EXCLUDE_ROWS):
+        """!
+        Finds the hottest blobs in an image. Pixels above a threshold set
+        from the image's own statistics are grouped into 8-connected blobs,
+        and the blobs with the most total heat above the threshold are kept.
+        All buffers are allocated here, about 2.3 kB, and reused every image
+        @param max_blobs How many of the hottest blobs to keep
+        @param spread Where the threshold sits between the mean (0) and
+               the maximum (1) of the searched pixels
+        @param min_area Blobs with fewer pixels than this are ignored, so a
+               lone hot pixel can't become the target
+        @param exclude_rows Rows before this one are never searched
+        """
+        self.spread = spread
+        self.min_area = min_area
+        self.exclude_rows = exclude_rows
+        ## Blob label of each pixel from the last search, 0 for none
+        self.labels = bytearray(IMAGE_SIZE)
+        self._stack = array('H', bytes(2*IMAGE_SIZE))
+        ## The hottest blobs found, hottest first; only @c count are valid
+        self.blobs = [Blob() for _ in range(max_blobs)]
+        self.count = 0
+        self.threshold = 0.0
+        # (first row, end row, first col, end col) of the search
+        self._bounds = (exclude_rows, NUM_ROWS, 0, NUM_COLS)
+
+    def detect(self, raw, roi=None):
+        """!
+        Searches a whole image in one go
+        @param raw A RawImage, or any image find_hotspot() accepts
+        @param roi Region to search, as for find_hotspot()
+        @returns The number of blobs found, which are in @c blobs
+        """
+        for _ in self.steps(raw, roi):
+            pass
+        return self.count
+
+    def steps(self, raw, roi=None):
+        """!
+        Searches an image a row at a time, so a task can yield between rows:
+        @code
+        for _ in detector.steps(image):
+            yield
+        @endcode
+        @param raw A RawImage, or any image find_hotspot() accepts
+        @param roi Region to search, as (first row, first col, rows, cols) in
+               CSV coordinates, such as a frame read with a region of
+               interest; default the whole image
+        @returns A generator; once it is exhausted @c blobs and @c count
+                 hold the result
+        """
+        pix = getattr(raw, 'pix', raw)
+        labels = self.labels
+        self.count = 0
+        # bounds of the search in the image's own columns
+        if roi is None:
+            row_0, row_1, col_0, col_1 = 0, NUM_ROWS, 0, NUM_COLS
+        else:
+            row_0, row_1 = roi[0], roi[0] + roi[2]
+            col_0, col_1 = NUM_COLS - roi[1] - roi[3], NUM_COLS - roi[1]
+        row_0 = max(row_0, self.exclude_rows)
+        self._bounds = (row_0, min(row_1, NUM_ROWS), max(col_0, 0), min(col_1, NUM_COLS))
+        (row_0, row_1, col_0, col_1) = self._bounds
+        if row_0 >= row_1 or col_0 >= col_1:
+            return
+
+        for idx in range(IMAGE_SIZE):
+            labels[idx] = 0
+        total = 0
+        top = pix[row_0*NUM_COLS + col_0]
+        for row in range(row_0, row_1):
+            for idx in range(row*NUM_COLS + col_0, row*NUM_COLS + col_1):
+                value = pix[idx]
+                total += value
+                if value > top:
+                    top = value
+        mean = total/((row_1 - row_0)*(col_1 - col_0))
+        threshold = mean + self.spread*(top - mean)
+        self.threshold = threshold
+        yield
+
+        label = 0
+        for row in range(row_0, row_1):
+            for idx in range(row*NUM_COLS + col_0, row*NUM_COLS + col_1):
+                if labels[idx] or pix[idx] <= threshold:
+                    continue
+                if label < UNTRACKED - 1:
+                    label += 1
+                    self._fill(pix, idx, label, threshold)
+                else:
+                    self._fill(pix, idx, UNTRACKED, threshold)
+            yield
+
+    def _fill(self, pix, seed, label, threshold):
+        """!
+        Labels the blob containing a pixel and offers it to @c blobs
+        """
+        labels = self.labels
+        stack = self._stack
+        (row_0, row_1, col_0, col_1) = self._bounds
+        labels[seed] = label
+        stack[0] = seed
+        depth = 1
+
+        area = 0
+        weight = 0.0
+        sum_row = 0.0
+        sum_col = 0.0
+        peak = pix[seed]
+        min_row = max_row = seed // NUM_COLS
+        min_col = max_col = seed % NUM_COLS
+        while depth:
+            depth -= 1
+            idx = stack[depth]
+            row = idx // NUM_COLS
+            col = idx - row*NUM_COLS
+            value = pix[idx]
+            excess = value - threshold
+            area += 1
+            weight += excess
+            sum_row += excess*row
+            sum_col += excess*col
+            if value > peak:
+                peak = value
+            if row < min_row:
+                min_row = row
+            elif row > max_row:
+                max_row = row
+            if col < min_col:
+                min_col = col
+            elif col > max_col:
+                max_col = col
+
+            for n_row in range(max(row - 1, row_0), min(row + 2, row_1)):
+                for n_col in range(max(col - 1, col_0), min(col + 2, col_1)):
+                    n_idx = n_row*NUM_COLS + n_col
+                    if not labels[n_idx] and pix[n_idx] > threshold:
+                        labels[n_idx] = label
+                        stack[depth] = n_idx
+                        depth += 1
+
+        if area < self.min_area:
+            return
+        self._offer(weight, area, peak, sum_row/weight, sum_col/weight,
+                    min_row, min_col, max_row, max_col)
+
+    def _offer(self, weight, area, peak, row, col,
+               min_row, min_col, max_row, max_col):
+        """!
+        Keeps a blob if it is among the hottest found so far
+        """
+        blobs = self.blobs
+        if self.count < len(blobs):
+            pos = self.count
+            self.count += 1
+        elif weight > blobs[-1].weight:
+            pos = len(blobs) - 1
+        else:
+            return
+
+        blob = blobs[pos]
+        blob.weight = weight
+        blob.area = area
+        blob.peak = peak
+        blob.row = row
+        # mirror the columns as get_csv() does
+        blob.col = NUM_COLS - 1 - col
+        blob.min_row = min_row
+        blob.max_row = max_row
+        blob.min_col = NUM_COLS - 1 - max_col
+        blob.max_col = NUM_COLS - 1 - min_col
+        while pos and blobs[pos - 1].weight < weight:
+            blobs[pos - 1], blobs[pos] = blobs[pos], blobs[pos - 1]
+            pos -= 1
+
+
+def test_find_hotspot():
+    """!
+    Checks find_hotspot() against a search of the CSV text, as main.py used
+    to do it, on a made up image
+    @returns None
+    """
+    from array import array
+
+    pix = array('h', ((idx*7919) % 1000 - 500 for idx in range(NUM_ROWS*NUM_COLS)))
+    pix[2*NUM_COLS + 5] = 2000
+    lines = []
+    for row in range(NUM_ROWS):
+        lines.append([str(pix[row*NUM_COLS + NUM_COLS - 1 - col]) for col in range(NUM_COLS)])
+
+    h_max = 0
+    v_max = 0
+    for (h_idx, line) in enumerate(lines):
+        if h_idx < EXCLUDE_ROWS:
+            continue
+        for (v_idx, pixel) in enumerate(line):
+            if float(pixel) > float(lines[h_max][v_max]):
+                v_max = v_idx
+                h_max = h_idx
+
+    spot = find_hotspot(pix)
+    assert (spot.row, spot.col) == (h_max, v_max), f"{spot} != ({h_max}, {v_max})"
+    assert spot.value == int(lines[h_max][v_max])
+
+    spot = find_hotspot(pix, roi=(10, 3, 4, 6), out=spot)
+    assert 10 <= spot.row < 14 and 3 <= spot.col < 9
+    print("find_hotspot OK")
+
+
+def test_blob_detector():
+    """!
+    Checks BlobDetector on a made up image with two warm blobs and a lone
+    hot pixel
+    @returns None
+    """
+    from array import array
+
+    pix = array('h', bytes(2*IMAGE_SIZE))
+    # a 3x3 blob, hotter on its right in image columns, and a fainter 2x2
+    for row, col, value in ((10, 20, 100), (10, 21, 100), (10, 22, 300),
+                            (11, 20, 100), (11, 21, 100), (11, 22, 300),
+                            (12, 20, 100), (12, 21, 100), (12, 22, 300),
+                            (18, 3, 120), (18, 4, 120),
+                            (19, 3, 120), (19, 4, 120),
+                            (6, 10, 400)):
+        pix[row*NUM_COLS + col] = value
+
+    detector = BlobDetector(max_blobs=2, spread=0.1, min_area=2)
+    assert detector.detect(pix) == 2
+    big, small = detector.blobs
+    assert big.area == 9 and small.area == 4
+    assert abs(big.row - 11.0) < 1e-6
+    # columns 20 and 21 are (100 - threshold) above the threshold, 22 is
+    # (300 - threshold) above it
+    low = 100 - detector.threshold
+    high = 300 - detector.threshold
+    expected = (low*20 + low*21 + high*22)/(2*low + high)
+    assert abs(big.col - (NUM_COLS - 1 - expected)) < 1e-3, big
+    assert (big.min_col, big.max_col) == (NUM_COLS - 1 - 22, NUM_COLS - 1 - 20)
+    assert abs(small.row - 18.5) < 1e-6 and abs(small.col - (NUM_COLS - 1 - 3.5)) < 1e-6
+
+    # a region around the small blob only finds that one
+    assert detector.detect(pix, roi=(16, NUM_COLS - 8, 6, 8)) == 1
+    assert detector.blobs[0].area == 4
+    print("BlobDetector OK")
+
+
+if __name__ == "__main__":
+    test_find_hotspot()
+    test_blob_detector()
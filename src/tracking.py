@@ -0,0 +1,322 @@
+"""!
+@file tracking.py
+Tracks a moving target across camera frames so the turret can aim where
+the target will be when the gun fires, not where it was in the last image
+"""
+
+from utime import ticks_diff
+
+## Measurements further than this from the prediction, in degrees, are taken
+#  to be a new target and restart the track
+GATE = 20.0
+
+## A track which hasn't been updated for this long, in ms, is restarted
+MAX_GAP_MS = const(3000)
+
+
+class TargetTrack:
+    def __init__(self, alpha=0.6, beta=0.2, gate=GATE, max_gap_ms=MAX_GAP_MS,
+                 max_rate=90.0):
+        """!
+        Follows one target's pan and tilt angles with an alpha-beta filter,
+        which estimates an angle and an angular rate per axis from noisy
+        measurements at irregular times
+        @param alpha How much of each measurement's error corrects the angle
+        @param beta How much of each measurement's error corrects the rate
+        @param gate Measurements further than this from the prediction, in
+               degrees, restart the track
+        @param max_gap_ms A track not updated for this long is restarted
+        @param max_rate The largest angular rate believed, in degrees/s
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.gate = gate
+        self.max_gap_ms = max_gap_ms
+        self.max_rate = max_rate
+        self.reset()
+
+    def reset(self):
+        """!
+        Forgets the target
+        @returns None
+        """
+        ## Estimated pan angle at time @c t, degrees
+        self.pan = 0.0
+        ## Estimated tilt angle at time @c t, degrees
+        self.tilt = 0.0
+        ## Estimated pan rate, degrees/s
+        self.pan_rate = 0.0
+        ## Estimated tilt rate, degrees/s
+        self.tilt_rate = 0.0
+        ## ticks_ms() time of the last update
+        self.t = 0
+        ## Number of measurements in the track since it last restarted
+        self.updates = 0
+        ## Average time between measurements, ms, or 0 before there are two
+        self.interval = 0
+        ## Size of the target in its last image, pixels
+        self.area = 0
+        ## Images in a row the target has been missing from
+        self.misses = 0
+
+    def update(self, pan, tilt, t):
+        """!
+        Corrects the track with a measurement of the target
+        @param pan The target's measured pan angle, degrees
+        @param tilt The target's measured tilt angle, degrees
+        @param t The utime.ticks_ms() time the image was captured
+        @returns None
+        """
+        dt_ms = ticks_diff(t, self.t)
+        if self.updates and 0 < dt_ms <= self.max_gap_ms:
+            dt = dt_ms/1000
+            pred_pan = self.pan + self.pan_rate*dt
+            pred_tilt = self.tilt + self.tilt_rate*dt
+            err_pan = pan - pred_pan
+            err_tilt = tilt - pred_tilt
+            if abs(err_pan) <= self.gate and abs(err_tilt) <= self.gate:
+                if self.updates == 1:
+                    # two points give the first estimate of the rates
+                    self.pan_rate = self._clamp((pan - self.pan)/dt)
+                    self.tilt_rate = self._clamp((tilt - self.tilt)/dt)
+                    self.pan = pan
+                    self.tilt = tilt
+                    self.interval = dt_ms
+                else:
+                    self.pan = pred_pan + self.alpha*err_pan
+                    self.tilt = pred_tilt + self.alpha*err_tilt
+                    self.pan_rate = self._clamp(self.pan_rate + self.beta*err_pan/dt)
+                    self.tilt_rate = self._clamp(self.tilt_rate + self.beta*err_tilt/dt)
+                    self.interval += (dt_ms - self.interval)//4
+                self.t = t
+                self.updates += 1
+                return
+
+        # first measurement, or one which doesn't fit the track
+        self.pan = pan
+        self.tilt = tilt
+        self.pan_rate = 0.0
+        self.tilt_rate = 0.0
+        self.t = t
+        self.updates = 1
+        self.interval = 0
+
+    def _clamp(self, rate):
+        return max(-self.max_rate, min(rate, self.max_rate))
+
+    def predict(self, t):
+        """!
+        Predicts where the target will be at a given time
+        @param t A utime.ticks_ms() time
+        @returns (pan, tilt) in degrees
+        """
+        dt = ticks_diff(t, self.t)/1000
+        return (self.pan + self.pan_rate*dt, self.tilt + self.tilt_rate*dt)
+
+    def lead(self, latency_ms):
+        """!
+        Predicts where the target will be a delay after its last image, such
+        as the time from capturing an image to the gun firing
+        @param latency_ms The delay in ms
+        @returns (pan, tilt) in degrees
+        """
+        return (self.pan + self.pan_rate*latency_ms/1000,
+                self.tilt + self.tilt_rate*latency_ms/1000)
+
+
+class MultiTargetTracker:
+    def __init__(self, capacity=4, max_misses=2, gate=GATE,
+                 size_weight=1.0, confidence_weight=2.0, slew_weight=0.5,
+                 switch_margin=5.0):
+        """!
+        Keeps a fixed table of TargetTracks for several targets in view,
+        matches each image's detections to them, and picks which target to
+        engage
+        @param capacity How many targets can be tracked at once
+        @param max_misses Tracks missing from more images in a row than this
+               are dropped
+        @param gate Detections further than this from a track's prediction,
+               in degrees, can't be matched to it
+        @param size_weight Priority per pixel of a target's area
+        @param confidence_weight Priority per image a target has been seen
+               in, up to five
+        @param slew_weight Priority lost per degree the turret must turn
+        @param switch_margin Priority another target needs over the current
+               one before the turret switches to it
+        """
+        self.tracks = [TargetTrack(gate=gate) for _ in range(capacity)]
+        self.max_misses = max_misses
+        self.gate = gate
+        self.size_weight = size_weight
+        self.confidence_weight = confidence_weight
+        self.slew_weight = slew_weight
+        self.switch_margin = switch_margin
+        ## The track being engaged, or None
+        self.target = None
+
+    def reset(self):
+        """!
+        Forgets all targets
+        @returns None
+        """
+        for track in self.tracks:
+            track.reset()
+        self.target = None
+
+    def update(self, detections, t, pan_range=None):
+        """!
+        Matches an image's detections to the tracks, nearest pairs first,
+        then starts tracks for unmatched detections and drops tracks which
+        have been missing for too long
+        @param detections A sequence of (pan, tilt, area) tuples, one per
+               target found in the image
+        @param t The utime.ticks_ms() time the image was captured
+        @param pan_range The (lowest, highest) pan angles the image covered,
+               for an image of only part of the view; unmatched tracks
+               predicted outside it aren't counted as missing
+        @returns None
+        """
+        tracks = self.tracks
+        gate = self.gate
+        # bit i set once track/detection i has been matched
+        used_tracks = 0
+        used_dets = 0
+        while True:
+            best = None
+            best_dist = 0.0
+            for (ti, track) in enumerate(tracks):
+                if not track.updates or used_tracks & (1 << ti):
+                    continue
+                (pan, tilt) = track.predict(t)
+                for (di, det) in enumerate(detections):
+                    if used_dets & (1 << di):
+                        continue
+                    d_pan = det[0] - pan
+                    d_tilt = det[1] - tilt
+                    if abs(d_pan) > gate or abs(d_tilt) > gate:
+                        continue
+                    dist = d_pan*d_pan + d_tilt*d_tilt
+                    if best is None or dist < best_dist:
+                        best = (ti, di)
+                        best_dist = dist
+            if best is None:
+                break
+            (ti, di) = best
+            used_tracks |= 1 << ti
+            used_dets |= 1 << di
+            self._assign(tracks[ti], detections[di], t)
+
+        for (ti, track) in enumerate(tracks):
+            if track.updates and not used_tracks & (1 << ti):
+                if pan_range is not None and not pan_range[0] <= track.predict(t)[0] <= pan_range[1]:
+                    continue
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    track.reset()
+                    if track is self.target:
+                        self.target = None
+
+        for (di, det) in enumerate(detections):
+            if used_dets & (1 << di):
+                continue
+            for track in tracks:
+                if not track.updates:
+                    self._assign(track, det, t)
+                    break
+
+    def _assign(self, track, det, t):
+        (pan, tilt, area) = det
+        track.update(pan, tilt, t)
+        track.area = area
+        track.misses = 0
+
+    def select(self, pan, tilt):
+        """!
+        Picks the target to engage: big targets which have been seen in
+        several images and need little turning come first, and the current
+        target is kept unless another is clearly better
+        @param pan The turret's current pan angle, degrees
+        @param tilt The turret's current tilt angle, degrees
+        @returns The TargetTrack to engage, also kept as @c target, or None
+        """
+        best = None
+        best_score = 0.0
+        for track in self.tracks:
+            if not track.updates or track.misses:
+                continue
+            score = (self.size_weight*track.area
+                     + self.confidence_weight*min(track.updates, 5)
+                     - self.slew_weight*(abs(track.pan - pan) + abs(track.tilt - tilt)))
+            if track is self.target:
+                score += self.switch_margin
+            if best is None or score > best_score:
+                best = track
+                best_score = score
+        self.target = best
+        return best
+
+
+def test_target_track():
+    """!
+    Checks that a track of a target moving at constant rate converges to its
+    rate and predicts its position
+    @returns None
+    """
+    track = TargetTrack()
+    t = 0
+    for step in range(20):
+        track.update(10 + 15*t/1000, 50 - 3*t/1000, t)
+        t += 250
+    assert abs(track.pan_rate - 15) < 0.1 and abs(track.tilt_rate + 3) < 0.1
+    pan, tilt = track.lead(500)
+    assert abs(pan - (10 + 15*5.25)) < 0.1 and abs(tilt - (50 - 3*5.25)) < 0.1
+    assert track.interval == 250
+
+    # a jump beyond the gate starts a new track
+    track.update(-60, 50, t)
+    assert track.updates == 1 and track.pan_rate == 0
+    print("TargetTrack OK")
+
+
+def test_multi_target_tracker():
+    """!
+    Checks that two moving targets keep their own tracks
+    and that the engaged target doesn't flip between them
+    @returns None
+    """
+    tracker = MultiTargetTracker(capacity=3)
+    t = 0
+    for step in range(8):
+        left = (-30 + 2*step, 50, 6)
+        right = (30 - step, 55, 5 + step % 2)
+        # the detection order changes from image to image
+        tracker.update((left, right) if step % 2 else (right, left), t)
+        target = tracker.select(0, 50)
+        if step == 0:
+            first = target
+        assert target is first, "engaged target changed"
+        t += 500
+    live = [track for track in tracker.tracks if track.updates]
+    assert len(live) == 2 and all(track.updates == 8 for track in live)
+    rates = sorted(track.pan_rate for track in live)
+    assert abs(rates[0] + 2) < 0.1 and abs(rates[1] - 4) < 0.1
+
+    # a target which disappears is dropped after max_misses images
+    for step in range(3):
+        tracker.update(((30 - 8 - step, 55, 5),), t)
+        t += 500
+    live = [track for track in tracker.tracks if track.updates]
+    assert len(live) == 1
+
+    # but not while it is outside the part of the view being imaged
+    tracker.update(((-40, 50, 5), (30 - 8 - 3, 55, 5)), t)
+    for step in range(4, 8):
+        t += 500
+        tracker.update(((30 - 8 - step, 55, 5),), t, pan_range=(0, 40))
+    assert len([track for track in tracker.tracks if track.updates]) == 2
+    print("MultiTargetTracker OK")
+
+
+if __name__ == "__main__":
+    test_target_track()
+    test_multi_target_tracker()
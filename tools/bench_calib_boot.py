@@ -0,0 +1,54 @@
+## @file bench_calib_boot.py
+#  Benchmark of the time and memory needed to get an MLX90640 calibration at
+#  boot, building it from the EEPROM and then loading it from the on-flash
+#  cache. Also saves the camera's EEPROM as @c /eeprom.bin, which
+#  @c tools/build_calib_cache.py can turn into a cache on a PC.
+#
+#  Copy this file to the MicroPython board next to the @c mlx90640 directory
+#  and run it with the camera attached to I2C bus 1.
+
+import gc
+import os
+import utime as time
+from machine import I2C
+from mlx90640 import MLX90640, CALIB_CACHE_PATH
+from mlx90640.regmap import read_eeprom
+
+DUMP_PATH = '/eeprom.bin'
+
+
+## Time one call of MLX90640.load_calibration().
+#  @returns A tuple (milliseconds, bytes of heap still in use afterwards)
+def time_load(camera, cache_path):
+    camera.calib = None
+    gc.collect()
+    before = gc.mem_alloc()
+    begin = time.ticks_ms()
+    camera.load_calibration(cache_path)
+    elapsed = time.ticks_diff(time.ticks_ms(), begin)
+    gc.collect()
+    return elapsed, gc.mem_alloc() - before
+
+
+def main():
+    camera = MLX90640(I2C(1), 0x33)
+
+    with open(DUMP_PATH, 'wb') as f:
+        f.write(camera.eeprom_data or read_eeprom(camera.iface))
+    print(f"EEPROM saved to {DUMP_PATH}")
+
+    try:
+        os.remove(CALIB_CACHE_PATH)
+    except OSError:
+        pass
+
+    ms, heap = time_load(camera, None)
+    print(f"Built from EEPROM:  {ms} ms, {heap} B")
+    ms, heap = time_load(camera, CALIB_CACHE_PATH)
+    print(f"Built, cache saved: {ms} ms, {heap} B")
+    ms, heap = time_load(camera, CALIB_CACHE_PATH)
+    print(f"Loaded from cache:  {ms} ms, {heap} B")
+
+
+if __name__ == "__main__":
+    main()
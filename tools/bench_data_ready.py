@@ -0,0 +1,51 @@
+## @file bench_data_ready.py
+#  Benchmark of waiting for images as task4 does, calling
+#  MLX_Cam.get_image_nonblocking() every 10 ms, with and without the data
+#  ready predictor: status reads over the bus per image, how many of them
+#  found no data, and the time taken per image.
+#
+#  Copy this file to the MicroPython board next to @c mlx_cam.py and the
+#  @c mlx90640 directory, and run it with the camera attached to I2C bus 1.
+
+import utime as time
+from machine import I2C
+from mlx_cam import MLX_Cam
+from bench_raw_read import CountingI2C
+
+IMAGES = const(10)
+TASK_PERIOD_MS = const(10)
+REFRESH_RATE = 8.0
+
+
+def wait_images(camera, bus):
+    bus.reset()
+    begin = time.ticks_ms()
+    for _ in range(IMAGES):
+        image = None
+        while not image:
+            image = camera.get_image_nonblocking()
+            time.sleep_ms(TASK_PERIOD_MS)
+    return bus.transactions, time.ticks_diff(time.ticks_ms(), begin)
+
+
+def main():
+    bus = CountingI2C(I2C(1))
+    for predict in (False, True):
+        camera = MLX_Cam(bus, predict=predict)
+        camera.refresh_rate = REFRESH_RATE
+        # line up with the camera before counting
+        while not camera.get_image_nonblocking():
+            time.sleep_ms(TASK_PERIOD_MS)
+        transactions, elapsed = wait_images(camera, bus)
+        print(f"predict={predict}: {transactions/IMAGES:6.1f} transactions, "
+              f"{elapsed/IMAGES:6.1f} ms per image")
+        ready = camera.data_ready
+        if ready:
+            print(f"  {ready.polls} polls, {ready.wasted} wasted, "
+                  f"{ready.skipped} skipped; latency mean "
+                  f"{ready.latency_total_ms/max(ready.arrivals, 1):.1f} ms, "
+                  f"max {ready.latency_max_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
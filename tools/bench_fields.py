@@ -0,0 +1,53 @@
+## @file bench_fields.py
+#  Benchmark of getting register fields: reading a field of a cached
+#  register, reading one from a Struct, building the per-pixel calibration
+#  from the EEPROM words, and building the whole calibration from the EEPROM (no
+#  cache).
+#
+#  Copy this file to the MicroPython board next to the @c mlx90640 directory
+#  and run it with the camera attached to I2C bus 1.
+
+import utime as time
+from machine import I2C
+from mlx90640 import MLX90640
+from mlx90640.calibration import (CameraCalibration, PIX_CALIB_PROTO,
+                                  eeprom_words, build_pixels)
+from mlx90640.utils import Struct
+
+READS = const(1000)
+BUILDS = const(3)
+
+
+def per_call_us(begin, count):
+    return time.ticks_diff(time.ticks_us(), begin)/count
+
+
+def main():
+    camera = MLX90640(I2C(1), 0x33)
+    registers = camera.registers
+    registers['refresh_rate']
+
+    begin = time.ticks_us()
+    for _ in range(READS):
+        registers['refresh_rate']
+    print(f"Cached register field: {per_call_us(begin, READS):7.1f} us")
+
+    struct = Struct(bytearray(b'\x12\x34'), PIX_CALIB_PROTO)
+    begin = time.ticks_us()
+    for _ in range(READS):
+        struct['offset']
+    print(f"Struct field:          {per_call_us(begin, READS):7.1f} us")
+
+    words = eeprom_words(camera.eeprom_iface)
+    begin = time.ticks_us()
+    build_pixels(words, camera.eeprom)
+    print(f"Pixels built:          {per_call_us(begin, 1)/1000:7.1f} ms")
+
+    begin = time.ticks_us()
+    for _ in range(BUILDS):
+        CameraCalibration(camera.eeprom_iface, camera.eeprom)
+    print(f"Calibration built:     {per_call_us(begin, BUILDS)/1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
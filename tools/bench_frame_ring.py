@@ -0,0 +1,58 @@
+## @file bench_frame_ring.py
+#  Benchmark of the capture-plus-detect loop, in frames per second, with a
+#  single frame buffer (acquire, then search, then acquire again) and with a
+#  frame ring (the next frame is acquired between the steps of searching the
+#  last one).
+#
+#  Copy this file to the MicroPython board next to @c mlx_cam.py,
+#  @c targeting.py and the @c mlx90640 directory, and run it with the camera
+#  attached to I2C bus 1.
+
+import utime as time
+from machine import I2C
+from mlx_cam import MLX_Cam
+from targeting import BlobDetector
+
+FRAMES = const(20)
+REFRESH_RATE = 8.0
+
+
+def serial_loop(camera, detector):
+    begin = time.ticks_ms()
+    for _ in range(FRAMES):
+        image = None
+        while not image:
+            image = camera.get_image_nonblocking()
+        detector.detect(image)
+    return time.ticks_diff(time.ticks_ms(), begin)
+
+
+def pipelined_loop(camera, detector):
+    begin = time.ticks_ms()
+    done = 0
+    while done < FRAMES:
+        camera.capture()
+        frame = camera.lease_frame()
+        if frame is None:
+            continue
+        for _ in detector.steps(frame):
+            camera.capture()
+        camera.release_frame(frame)
+        done += 1
+    return time.ticks_diff(time.ticks_ms(), begin)
+
+
+def main():
+    camera = MLX_Cam(I2C(1), frames=2)
+    camera.refresh_rate = REFRESH_RATE
+    detector = BlobDetector()
+
+    for (name, loop) in (("single buffer", serial_loop),
+                         ("frame ring", pipelined_loop)):
+        elapsed = loop(camera, detector)
+        print(f"{name:14s} {FRAMES*1000/elapsed:5.2f} frames/s "
+              f"({elapsed//FRAMES} ms per frame)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+## @file bench_hotspot.py
+#  Benchmark comparing the hotspot search main.py used to do, through the CSV
+#  text of an image, with targeting.find_hotspot() scanning the pixels in
+#  place: time per search and heap allocated per search.
+#
+#  No camera is needed; a made up RawImage is searched. Copy this file to the
+#  MicroPython board next to @c mlx_cam.py, @c targeting.py and the
+#  @c mlx90640 directory, or run it with the MicroPython Unix port from
+#  @c src.
+
+import gc
+import utime as time
+from mlx_cam import MLX_Cam
+from mlx90640.image import RawImage
+from mlx90640.calibration import IMAGE_SIZE
+from targeting import find_hotspot, Hotspot, EXCLUDE_ROWS
+
+RUNS = 5
+
+
+## The search task4 in main.py used to do.
+def csv_hotspot(camera, image):
+    lines = []
+    for line in camera.get_csv(image):
+        lines.append(line.split(","))
+    h_max = 0
+    v_max = 0
+    for (h_idx, line) in enumerate(lines):
+        if h_idx < EXCLUDE_ROWS:
+            continue
+        for (v_idx, pixel) in enumerate(line):
+            if float(pixel) > float(lines[h_max][v_max]):
+                v_max = v_idx
+                h_max = h_idx
+    return h_max, v_max
+
+
+## Time a search and measure the heap it allocates.
+#  @returns (microseconds, bytes allocated, result) of the last run
+def measure(search):
+    total_us = 0
+    for _ in range(RUNS):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        begin = time.ticks_us()
+        result = search()
+        total_us += time.ticks_diff(time.ticks_us(), begin)
+        allocated = gc.mem_alloc() - before
+        gc.enable()
+    return total_us // RUNS, allocated, result
+
+
+def main():
+    # get_csv() doesn't touch the bus, so the camera object needs no I2C
+    camera = object.__new__(MLX_Cam)
+    camera._width = 32
+    camera._height = 24
+
+    image = RawImage()
+    for idx in range(IMAGE_SIZE):
+        image.pix[idx] = (idx*7919) % 1000 - 500
+    image.pix[300] = 1200
+
+    hotspot = Hotspot()
+    csv_us, csv_mem, csv_pos = measure(lambda: csv_hotspot(camera, image))
+    scan_us, scan_mem, _ = measure(lambda: find_hotspot(image, out=hotspot))
+
+    print(f"CSV path:     {csv_us:8d} us {csv_mem:8d} B  -> {csv_pos}")
+    print(f"find_hotspot: {scan_us:8d} us {scan_mem:8d} B  -> "
+          f"{(hotspot.row, hotspot.col)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+## @file bench_processing.py
+#  Benchmark of the calibrated processing pipeline: time to compensate one
+#  subpage, the memory the calibrated mode holds on to, and the heap the
+#  processing allocates while it runs.
+#
+#  Copy this file to the MicroPython board next to the @c mlx90640 directory
+#  and run it with the camera attached to I2C bus 1.
+
+import gc
+import utime as time
+from machine import I2C
+from mlx90640 import MLX90640
+from mlx90640.image import ChessPattern
+
+SUBPAGES = 10
+
+
+def main():
+    camera = MLX90640(I2C(1), 0x33)
+    camera.set_pattern(ChessPattern)
+
+    gc.collect()
+    base = gc.mem_alloc()
+    camera.setup()
+    gc.collect()
+    raw_mem = gc.mem_alloc() - base
+    camera.setup(calibrated=True)
+    gc.collect()
+    calib_mem = gc.mem_alloc() - base
+    print(f"Held: raw {raw_mem} B, calibrated {calib_mem} B")
+
+    total_us = 0
+    state_us = 0
+    peak = 0
+    for _ in range(SUBPAGES):
+        status = camera.read_status()
+        while not status['data_available']:
+            time.sleep_ms(5)
+            status = camera.read_status()
+        camera.read_image(None, status)
+
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        begin = time.ticks_us()
+        state = camera.read_state()
+        middle = time.ticks_us()
+        camera.process_image(state=state)
+        end = time.ticks_us()
+        peak = max(peak, gc.mem_alloc() - before)
+        gc.enable()
+
+        state_us += time.ticks_diff(middle, begin)
+        total_us += time.ticks_diff(end, begin)
+
+    print(f"Per subpage: {total_us // SUBPAGES} us "
+          f"({state_us // SUBPAGES} us reading state)")
+    print(f"Peak heap: {calib_mem + peak} B "
+          f"({peak} B allocated while processing)")
+
+    centre = 12 * 32 + 16
+    print(f"Centre pixel: {camera.image.calc_temperature(centre, state):.2f} C")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+## @file bench_profiles.py
+#  Benchmark of the MLX_Cam camera profiles: time per whole image, and the
+#  temporal noise of the raw pixels, from the differences between
+#  consecutive images of a still scene. The noise is scaled to 18 bit ADC
+#  counts (the camera's default resolution) so the profiles compare.
+#
+#  Point the camera at a still scene, copy this file to the MicroPython
+#  board next to @c mlx_cam.py and the @c mlx90640 directory, and run it
+#  with the camera attached to I2C bus 1.
+
+import math
+import utime as time
+from array import array
+from machine import I2C
+from mlx_cam import MLX_Cam, IDLE, TRACKING, CONFIRM
+from mlx90640.calibration import IMAGE_SIZE
+
+IMAGES = const(8)
+
+
+## Time whole images and measure their noise with one profile.
+#  @returns (ms per image, noise in 18 bit counts)
+def measure(camera, profile):
+    camera.set_profile(profile)
+    # the first image may mix the old and new settings
+    camera.get_image()
+    last = array('h', camera.get_image().pix)
+
+    begin = time.ticks_ms()
+    total = 0
+    for _ in range(IMAGES):
+        pix = camera.get_image().pix
+        for i in range(IMAGE_SIZE):
+            diff = pix[i] - last[i]
+            total += diff*diff
+            last[i] = pix[i]
+    elapsed = time.ticks_diff(time.ticks_ms(), begin)
+
+    # the difference of two images has twice the variance of one
+    noise = math.sqrt(total/(2*IMAGES*IMAGE_SIZE))
+    return elapsed/IMAGES, noise*2**(18 - profile.adc_resolution)
+
+
+def main():
+    camera = MLX_Cam(I2C(1))
+    print("profile    rate   bits   ms/image   noise")
+    for profile in (IDLE, TRACKING, CONFIRM):
+        ms, noise = measure(camera, profile)
+        print(f"{profile.name:9s} {profile.refresh_rate:5.1f} "
+              f"{profile.adc_resolution:6d} {ms:10.0f} {noise:7.2f}")
+    camera.set_profile(IDLE)
+
+
+if __name__ == "__main__":
+    main()
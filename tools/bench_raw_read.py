@@ -0,0 +1,77 @@
+## @file bench_raw_read.py
+#  Benchmark which counts the I2C transactions and bytes needed to read one
+#  full frame (both subpages) from an MLX90640, first one word per pixel and
+#  then in burst mode.
+#
+#  Copy this file to the MicroPython board next to the @c mlx90640 directory
+#  and run it with the camera attached to I2C bus 1.
+
+import utime as time
+from machine import I2C
+from mlx90640 import MLX90640
+from mlx90640.image import RawImage, ChessPattern
+
+
+## Wrapper around an I2C bus which counts the traffic passing through it.
+class CountingI2C:
+
+    def __init__(self, i2c):
+        self._i2c = i2c
+        self.reset()
+
+    def reset(self):
+        self.transactions = 0
+        self.bytes = 0
+
+    def scan(self):
+        return self._i2c.scan()
+
+    def readfrom_mem(self, addr, mem_addr, nbytes, **kwargs):
+        self.transactions += 1
+        self.bytes += nbytes
+        return self._i2c.readfrom_mem(addr, mem_addr, nbytes, **kwargs)
+
+    def readfrom_mem_into(self, addr, mem_addr, buf, **kwargs):
+        self.transactions += 1
+        self.bytes += len(buf)
+        self._i2c.readfrom_mem_into(addr, mem_addr, buf, **kwargs)
+
+    def writeto_mem(self, addr, mem_addr, buf, **kwargs):
+        self.transactions += 1
+        self.bytes += len(buf)
+        self._i2c.writeto_mem(addr, mem_addr, buf, **kwargs)
+
+
+## Read both subpages of one frame, counting only the traffic of the reads
+#  themselves (not the polling while waiting for data).
+#  @returns A tuple (transactions, bytes, milliseconds)
+def measure_frame(camera, bus):
+    transactions = 0
+    nbytes = 0
+    elapsed = 0
+    for subpage in (0, 1):
+        while not camera.has_data:
+            time.sleep_ms(10)
+        bus.reset()
+        begin = time.ticks_us()
+        camera.read_image(subpage)
+        elapsed += time.ticks_diff(time.ticks_us(), begin)
+        transactions += bus.transactions
+        nbytes += bus.bytes
+    return transactions, nbytes, elapsed // 1000
+
+
+def main():
+    bus = CountingI2C(I2C(1))
+    camera = MLX90640(bus, 0x33)
+    camera.set_pattern(ChessPattern)
+
+    for burst in (False, True):
+        camera.setup(raw=RawImage(burst=burst))
+        transactions, nbytes, ms = measure_frame(camera, bus)
+        mode = "burst" if burst else "per-word"
+        print(f"{mode:>8}: {transactions} transactions, {nbytes} B, {ms} ms")
+
+
+if __name__ == "__main__":
+    main()
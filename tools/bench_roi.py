@@ -0,0 +1,67 @@
+## @file bench_roi.py
+#  Benchmark of the I2C traffic and time needed to read one frame (both
+#  subpages) with regions of interest of several sizes, against reading the
+#  whole frame.
+#
+#  Copy this file and @c bench_raw_read.py to the MicroPython board next to
+#  the @c mlx90640 directory and run it with the camera attached to I2C
+#  bus 1.
+
+import utime as time
+from machine import I2C
+from mlx90640 import MLX90640
+from mlx90640.image import ChessPattern, Roi
+from bench_raw_read import CountingI2C
+
+## (name, region) pairs; regions are (row, col, rows, cols)
+REGIONS = (
+    ("whole frame", None),
+    ("12 rows", (6, 0, 12, 32)),
+    ("7 rows", (8, 0, 7, 32)),
+    ("3 rows", (10, 0, 3, 32)),
+    ("8 x 8", (8, 12, 8, 8)),
+    ("4 x 4", (10, 14, 4, 4)),
+)
+
+FRAMES = const(5)
+
+
+## Read frames with a region of interest, counting only the traffic of the
+#  reads themselves (not the polling while waiting for data).
+#  @returns A tuple (transactions, bytes, microseconds) per frame
+def measure_roi(camera, bus, roi):
+    transactions = 0
+    nbytes = 0
+    elapsed = 0
+    for _ in range(FRAMES):
+        for subpage in (0, 1):
+            while not camera.has_data:
+                time.sleep_ms(10)
+            bus.reset()
+            begin = time.ticks_us()
+            camera.read_image(subpage, roi=roi)
+            elapsed += time.ticks_diff(time.ticks_us(), begin)
+            transactions += bus.transactions
+            nbytes += bus.bytes
+    return transactions // FRAMES, nbytes // FRAMES, elapsed // FRAMES
+
+
+def main():
+    bus = CountingI2C(I2C(1))
+    camera = MLX90640(bus, 0x33)
+    camera.set_pattern(ChessPattern)
+    camera.setup()
+
+    for (name, region) in REGIONS:
+        roi = Roi(*region) if region else None
+        if roi:
+            # build the tables outside the timing
+            for subpage in (0, 1):
+                roi.sp_spans(ChessPattern, subpage)
+        transactions, nbytes, us = measure_roi(camera, bus, roi)
+        print(f"{name:>12}: {transactions:3d} transactions, {nbytes:5d} B, "
+              f"{us:6d} us per frame")
+
+
+if __name__ == "__main__":
+    main()
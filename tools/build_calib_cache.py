@@ -0,0 +1,64 @@
+## @file build_calib_cache.py
+#  Host-side tool which builds an MLX90640 calibration cache file from a raw
+#  EEPROM dump, so the board can load its calibration without computing it.
+#
+#  Run it on a PC with the MicroPython Unix port or CPython, from the
+#  repository root:
+#  @code
+#  micropython tools/build_calib_cache.py eeprom.bin mlx_calib.bin
+#  python3 tools/build_calib_cache.py cam1.bin cam1_calib.bin cam2.bin cam2_calib.bin
+#  @endcode
+#  then copy the cache, renamed @c mlx_calib.bin, to the root of the board's
+#  filesystem. Each dump is the EEPROM's 0x340 big-endian words exactly as
+#  read from the camera; @c tools/bench_calib_boot.py saves one as
+#  @c /eeprom.bin on the board. On CPython with NumPy installed the
+#  per-pixel coefficients are built with calibration_np, which is quicker
+#  for many dumps and gives the same caches.
+
+import sys
+sys.path.append(__file__.rsplit('/', 1)[0] + '/../src')
+
+from mlx90640.regmap import (
+    EEPROM_MAP,
+    EEPROM_SIZE,
+    REG_SIZE,
+    RegisterMap,
+    MemoryInterface,
+)
+from mlx90640.calibration import CameraCalibration, build_pixels
+from mlx90640.calib_cache import eeprom_checksum, save_cache
+
+try:
+    from mlx90640.calibration_np import build_pixels
+except ImportError:
+    pass
+
+
+def main(argv):
+    use_tgc = '--tgc' in argv
+    paths = [arg for arg in argv[1:] if arg != '--tgc']
+    if not paths or len(paths) % 2:
+        print("usage: build_calib_cache.py EEPROM_DUMP CACHE_FILE "
+              "[EEPROM_DUMP CACHE_FILE ...] [--tgc]")
+        return 1
+
+    for pos in range(0, len(paths), 2):
+        (dump, cache) = paths[pos:pos + 2]
+        iface = MemoryInterface.from_file(dump)
+        if len(iface.buf) != EEPROM_SIZE * REG_SIZE:
+            print(f"{dump}: EEPROM dump must be {EEPROM_SIZE * REG_SIZE} bytes")
+            return 1
+
+        eeprom = RegisterMap(iface, EEPROM_MAP, readonly=True)
+        calib = CameraCalibration(iface, eeprom, use_tgc=use_tgc,
+                                  pixel_builder=build_pixels)
+
+        key = eeprom_checksum(iface.buf)
+        save_cache(calib, cache, key)
+        print(f"Wrote {cache} for EEPROM checksum {key:#010x}: "
+              f"{len(calib.outliers)} outliers, {len(calib.failed)} failed pixels")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,117 @@
+## @file sim_gain_schedule.py
+#  Simulation of profiled pan moves with a gain schedule on the Controller,
+#  against one fixed set of gains. For each move it reports the time taken
+#  to settle, the steady-state error over the last part of the run, and the
+#  mean step in duty cycle that switching between scheduled gains causes:
+#  the output with the old gains less that with the new ones, on the step
+#  of the switch, which shows whether switching is bumpless. The motor model is
+#  the one in sim_pid.py.
+#
+#  Run it on a PC with the MicroPython Unix port from the @c src directory:
+#  @code
+#  micropython ../tools/sim_gain_schedule.py
+#  @endcode
+
+import sys
+sys.path.append(__file__.rsplit('/', 1)[0])
+
+import random
+from controller import Controller
+from motion_profile import MotionProfile
+from controller import DUTY_LIMIT
+from sim_pid import (SimMotor, SimEncoder, PERIOD_US, JITTER_US,
+                     TICKS_PER_DEG, SETTLED_DEG)
+from sim_motion_profile import MAX_VELOCITY, MAX_ACCEL, MAX_JERK, schedule
+
+## Moves simulated per distance and controller
+RUNS = const(20)
+## Length of each run, s, and of the part at its end over which the
+#  steady-state error is measured
+RUN_TIME = 1.5
+STEADY_TIME = 0.3
+
+## One set of gains for the whole move: the schedule's move gains, with
+#  the integral it needs to finish the move
+FIXED_GAINS = dict(kp=0.2, ki=0.5, kd=0.0015, kf=0.0007)
+
+
+## A Controller which records the step in its output each switch of gains
+#  causes, worked out on the step of the switch
+class ProbedController(Controller):
+
+    def __init__(self, *args, **kwargs):
+        self.jumps = []
+        super().__init__(*args, **kwargs)
+
+    def _output(self, error, eSum):
+        duty = (self.kp*error + self.kd*self.dFiltered + self.kf*self.velocity
+                + self.bump + self.ki*eSum)
+        return max(-DUTY_LIMIT, min(DUTY_LIMIT, duty))
+
+    def _schedule(self, error, eSum):
+        index = self.gainIndex
+        before = self._output(error, eSum)
+        eSum = super()._schedule(error, eSum)
+        if index is not None and self.gainIndex != index:
+            self.jumps.append(abs(before - self._output(error, eSum)))
+        return eSum
+
+
+## The controllers compared: (name, Controller keyword arguments)
+CONTROLLERS = (
+    ("fixed", FIXED_GAINS),
+    ("schedule", dict(kp=0, ki=0, kd=0, schedule=schedule())),
+    ("no bumpless", dict(kp=0, ki=0, kd=0, schedule=schedule(),
+                         bumpTau=0)),
+)
+
+
+## Make a profiled move of @c degrees with a Controller made with @c gains
+#  and return (settling time, s, or @c None; mean steady-state error,
+#  degrees; duty cycle steps at switches of gains, percent).
+def move(degrees, gains):
+    motor = SimMotor()
+    encoder = SimEncoder()
+    ctrl = ProbedController(encoder, motor, 0, gearRatio=96/30, timed=True, **gains)
+    profile = MotionProfile(MAX_VELOCITY*TICKS_PER_DEG,
+                            MAX_ACCEL*TICKS_PER_DEG, MAX_JERK*TICKS_PER_DEG)
+    profile.set_target(degrees*TICKS_PER_DEG)
+
+    now = 0
+    settled_at = None
+    steady = []
+    while now < RUN_TIME*1000000:
+        ctrl.set_setpoint(profile.update(now), profile.velocity)
+        ctrl.run(now)
+        dt = PERIOD_US + random.randrange(JITTER_US) if random.random() < 0.3 else PERIOD_US
+        encoder.step(motor.duty, dt/1000000)
+        now += dt
+
+        error = abs(encoder.position/TICKS_PER_DEG - degrees)
+        if now >= (RUN_TIME - STEADY_TIME)*1000000:
+            steady.append(error)
+        if error <= SETTLED_DEG:
+            if settled_at is None:
+                settled_at = now
+        else:
+            settled_at = None
+    return (settled_at and settled_at/1000000, sum(steady)/len(steady), ctrl.jumps)
+
+
+def main():
+    print(" move  controller   settled  time, ms  steady err, deg  duty step, %")
+    for degrees in (1.0, 3.0, 10.0, 90.0):
+        for (name, gains) in CONTROLLERS:
+            random.seed(int(degrees))
+            results = [move(degrees, gains) for _ in range(RUNS)]
+            done = [t for (t, _, _) in results if t is not None]
+            mean = sum(done)/len(done)*1000 if done else 0
+            steady = sum(e for (_, e, _) in results)/RUNS
+            jumps = [j for (_, _, js) in results for j in js]
+            jump = sum(jumps)/len(jumps) if jumps else 0
+            print(f"{degrees:5.0f}  {name:>11}  {len(done):3}/{RUNS}  {mean:8.0f}"
+                  f"  {steady:15.3f}  {jump:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
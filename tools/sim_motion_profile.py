@@ -0,0 +1,122 @@
+## @file sim_motion_profile.py
+#  Simulation of pan moves, comparing a setpoint which jumps straight to the
+#  target with one which follows a MotionProfile, fed forward into the
+#  Controller. It reports the time each move takes to settle and how far it
+#  overshoots, for typical pan distances, and for moves whose target is
+#  changed partway as the tracker updates it; a reversed move overshoots by
+#  however far the old move needs to stop. The motor model is the one in
+#  sim_pid.py, and a profiled move uses main.py's gain schedule. It fails if
+#  any profiled move overshoots by more than MAX_OVERSHOOT.
+#
+#  Run it on a PC with the MicroPython Unix port from the @c src directory:
+#  @code
+#  micropython ../tools/sim_motion_profile.py
+#  @endcode
+
+import sys
+sys.path.append(__file__.rsplit('/', 1)[0])
+
+import random
+from controller import Controller, GainSet
+from motion_profile import MotionProfile
+from sim_pid import (SimMotor, SimEncoder, PERIOD_US, JITTER_US,
+                     TICKS_PER_DEG, SETTLED_DEG)
+
+## Moves simulated per distance and method
+RUNS = const(20)
+## A move which hasn't settled after this long, s, counts as failed
+TIMEOUT = 3.0
+
+## Most a profiled move may overshoot its target, degrees
+MAX_OVERSHOOT = 0.25
+
+## The coarse gains task1 used for big moves before profiles
+STEP_GAINS = dict(kp=0.06, ki=0, kd=0.000002)
+## Profile limits, in degrees of the pan axis, as in main.py
+MAX_VELOCITY = 540
+MAX_ACCEL = 1000
+MAX_JERK = 5000
+
+
+## The gain schedule of main.py, with limits in degrees and degrees/s
+def schedule(hold_kp=0.1, hold_ki=1.0, close_kp=0.075, close_ki=0.5):
+    return (
+        # holding on target
+        GainSet(kp=hold_kp, ki=hold_ki, kd=0.0015, kf=0.0007,
+                maxError=0.5*TICKS_PER_DEG, maxVelocity=5*TICKS_PER_DEG),
+        # closing in
+        GainSet(kp=close_kp, ki=close_ki, kd=0.0015, kf=0.0007,
+                maxError=5*TICKS_PER_DEG),
+        # on the move; no integral to wind up
+        GainSet(kp=0.2, ki=0, kd=0.0015, kf=0.0007),
+    )
+
+
+## Make a pan move of @c degrees, changed to @c retarget degrees after
+#  @c retarget_ms if given, and return (settling time, s, or @c None if it
+#  didn't settle; overshoot past the final target, degrees).
+def move(degrees, profiled, retarget=None, retarget_ms=0):
+    motor = SimMotor()
+    encoder = SimEncoder()
+    gains = (dict(kp=0, ki=0, kd=0, schedule=schedule()) if profiled
+             else STEP_GAINS)
+    ctrl = Controller(encoder, motor, 0, gearRatio=96/30, timed=True, **gains)
+    profile = MotionProfile(MAX_VELOCITY*TICKS_PER_DEG,
+                            MAX_ACCEL*TICKS_PER_DEG, MAX_JERK*TICKS_PER_DEG)
+    target = degrees
+    profile.set_target(target*TICKS_PER_DEG)
+    ctrl.set_setpoint(target*TICKS_PER_DEG)
+
+    now = 0
+    settled_at = None
+    overshoot = 0.0
+    while now < TIMEOUT*1000000:
+        if retarget is not None and now >= retarget_ms*1000:
+            target = retarget
+            retarget = None
+            profile.set_target(target*TICKS_PER_DEG)
+            ctrl.set_setpoint(target*TICKS_PER_DEG)
+        if profiled:
+            ctrl.set_setpoint(profile.update(now), profile.velocity)
+        ctrl.run(now)
+        dt = PERIOD_US + random.randrange(JITTER_US) if random.random() < 0.3 else PERIOD_US
+        encoder.step(motor.duty, dt/1000000)
+        now += dt
+
+        angle = encoder.position/TICKS_PER_DEG
+        past = (angle - target) if target > 0 else (target - angle)
+        overshoot = max(overshoot, past)
+        if abs(angle - target) <= SETTLED_DEG:
+            if settled_at is None:
+                settled_at = now
+        else:
+            settled_at = None
+    return (settled_at and settled_at/1000000, overshoot)
+
+
+## Print how the moves made with @c args settle with and without a profile,
+#  and return the worst overshoot with one, degrees.
+def report(label, *args):
+    for profiled in (False, True):
+        random.seed(1)
+        results = [move(*args, profiled) if len(args) == 1 else
+                   move(args[0], profiled, *args[1:]) for _ in range(RUNS)]
+        done = [t for (t, _) in results if t is not None]
+        mean = sum(done)/len(done)*1000 if done else 0
+        worst = max(o for (_, o) in results)
+        print(f"{label:>14}  {'profile' if profiled else 'step':>8}"
+              f"  {len(done):3}/{RUNS}  {mean:8.0f}  {worst:9.2f}")
+    return worst
+
+
+def main():
+    print("          move    setpoint  settled  time, ms  overshoot, deg")
+    worst = max(report(f"{degrees:.0f}", degrees)
+                for degrees in (2.0, 10.0, 45.0, 90.0, 180.0))
+    worst = max(worst, report("90 then 100", 90.0, 100.0, 150),
+                report("90 then -30", 90.0, -30.0, 100))
+    assert worst < MAX_OVERSHOOT, f"profiled moves overshoot {worst:.2f} deg"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+## @file sim_pid.py
+#  Simulation of the pan axis making small corrections, comparing
+#  Controller's per-step gains with its timed mode as the task period
+#  jitters. The motor is modelled as a first-order lag with Coulomb
+#  friction, so a small duty cycle doesn't move it at all; that deadband is
+#  what leaves the per-step controller short of small setpoints.
+#
+#  Run it on a PC with the MicroPython Unix port from the @c src directory:
+#  @code
+#  micropython ../tools/sim_pid.py
+#  @endcode
+
+import random
+from controller import Controller
+from encoder_reader import Encoder
+
+## Corrections simulated per size and controller
+RUNS = const(50)
+## Nominal task period and the most a step may be late, us
+PERIOD_US = const(10000)
+JITTER_US = const(15000)
+## Motor speed at full duty, encoder ticks/s, and its time constant, s
+FULL_SPEED = 160000.0
+MOTOR_TAU = 0.05
+## Duty cycle, percent, needed just to overcome friction
+FRICTION_DUTY = 8.0
+## Encoder ticks per degree of the pan axis
+TICKS_PER_DEG = 8000*96/30/360
+## A correction is settled once within this many degrees, and staying there
+SETTLED_DEG = 0.1
+## A correction which hasn't settled after this long, s, counts as failed
+TIMEOUT = 2.0
+
+## The controllers compared: task1's fine pointing gains, per step and timed
+CONTROLLERS = (
+    ("per step", dict(kp=0.2, ki=0, kd=0.01)),
+    ("timed", dict(kp=0.2, ki=2.0, kd=0.001, timed=True)),
+)
+
+
+class SimMotor:
+    def __init__(self):
+        self.duty = 0
+
+    def set_duty_cycle(self, level):
+        self.duty = max(-100, min(100, level))
+
+
+## Stands in for the encoder's timer; 32 bits wide, so its count never wraps
+class SimTimer:
+    ENC_AB = 3
+
+    def __init__(self):
+        self.count = 0
+
+    def channel(self, *args, **kwargs):
+        return None
+
+    def period(self):
+        return 0x3FFFFFFF
+
+    def counter(self, value=None):
+        if value is None:
+            return self.count
+        self.count = value
+
+
+## The motor and its encoder, whose velocity and acceleration are estimated
+#  from its counts as Encoder does on the board, on the simulation's clock
+class SimEncoder(Encoder):
+    def __init__(self):
+        super().__init__(None, None, SimTimer())
+        self.position = 0.0
+        self.motor_speed = 0.0
+        self.now = 0
+
+    def read(self):
+        self.value = int(self.position)
+        self.timer.count = self.origin + self.value
+        self._sample(self.now, self.value)
+        return self.value
+
+    def step(self, duty, dt):
+        drive = 0.0
+        if abs(duty) > FRICTION_DUTY:
+            drive = duty - FRICTION_DUTY if duty > 0 else duty + FRICTION_DUTY
+        target = FULL_SPEED*drive/100
+        if drive == 0 and abs(self.motor_speed) < FULL_SPEED*FRICTION_DUTY/100:
+            # stiction holds a slow motor still
+            self.motor_speed = 0.0
+        self.motor_speed += (target - self.motor_speed)*min(dt/MOTOR_TAU, 1)
+        self.position += self.motor_speed*dt
+        self.now += round(dt*1000000)
+
+
+## Make a correction of @c degrees with a Controller made with @c gains
+#  and return the time it took to settle,
+#  in seconds, or @c None if it didn't.
+def correct(degrees, gains):
+    motor = SimMotor()
+    encoder = SimEncoder()
+    ctrl = Controller(encoder, motor, 0, gearRatio=96/30, **gains)
+    ctrl.set_setpoint(degrees*TICKS_PER_DEG)
+    now = 0
+    settled_at = None
+    while now < TIMEOUT*1000000:
+        ctrl.run(now)
+        dt = PERIOD_US + random.randrange(JITTER_US) if random.random() < 0.3 else PERIOD_US
+        encoder.step(motor.duty, dt/1000000)
+        now += dt
+        if abs(encoder.position/TICKS_PER_DEG - degrees) <= SETTLED_DEG:
+            if settled_at is None:
+                settled_at = now
+        else:
+            settled_at = None
+    if settled_at is None:
+        return None
+    return settled_at/1000000
+
+
+def main():
+    print("correction  controller  settled  mean time, ms")
+    for degrees in (1.0, 2.0, 5.0, 20.0):
+        for (name, gains) in CONTROLLERS:
+            random.seed(int(degrees*10))
+            times = [correct(degrees, gains) for _ in range(RUNS)]
+            done = [t for t in times if t is not None]
+            mean = sum(done)/len(done)*1000 if done else 0
+            print(f"{degrees:7.1f}    {name:>10}"
+                  f"  {len(done):3}/{RUNS}  {mean:8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+## @file sim_settling.py
+#  Simulation of when task1 tells the camera the turret is ready. The old
+#  rule waits for the pan axis to be within 3 degrees, runs three more
+#  control steps and stops the motor. The Controller's settling detector
+#  waits for the error and velocity to stay in their bands for a dwell time,
+#  or gives up after a timeout within 3 degrees, and imaging starts once its
+#  predicted time to settle is within the lead; it stops again if the turret
+#  leaves the bands first.
+#  For each pan distance it reports when imaging may start, how far the
+#  turret still moves after that (which blurs the image), the error it ends
+#  with, and when the detector declared it settled. The motor model is the
+#  one in sim_pid.py and the gains are main.py's schedule. On small moves
+#  the detector is ready later than the old rule, which starts imaging
+#  before the turret has reached its target; that is the trade it makes.
+#
+#  Run it on a PC with the MicroPython Unix port from the @c src directory:
+#  @code
+#  micropython ../tools/sim_settling.py
+#  @endcode
+
+import sys
+sys.path.append(__file__.rsplit('/', 1)[0])
+
+import random
+from controller import Controller
+from motion_profile import MotionProfile
+from sim_pid import SimMotor, SimEncoder, PERIOD_US, JITTER_US, TICKS_PER_DEG
+from sim_motion_profile import MAX_VELOCITY, MAX_ACCEL, MAX_JERK
+from sim_gain_schedule import schedule
+
+## Moves simulated per distance and rule
+RUNS = const(20)
+## Length of each run, s
+RUN_TIME = 1.5
+## The old rule's band, degrees
+CLOSE_ENOUGH = 3.0
+## The detector's bands, degrees and degrees/s, its dwell and the imaging
+#  lead, us, as in main.py
+SETTLE_DEG = 0.25
+SETTLE_DEG_S = 2.0
+SETTLE_DWELL_US = const(30000)
+IMAGE_LEAD_US = const(20000)
+SETTLE_TIMEOUT_US = const(500000)
+
+
+## Make a pan move of @c degrees, signalling readiness by the old rule or by
+#  the settling detector, and return (time imaging may start, us; degrees
+#  moved after that; final error, degrees; time the detector settled, us).
+def move(degrees, detector):
+    motor = SimMotor()
+    encoder = SimEncoder()
+    ctrl = Controller(encoder, motor, 0, kp=0, ki=0, kd=0, gearRatio=96/30,
+                      timed=True, schedule=schedule())
+    ctrl.set_settling(SETTLE_DEG*TICKS_PER_DEG, SETTLE_DEG_S*TICKS_PER_DEG,
+                      SETTLE_DWELL_US)
+    profile = MotionProfile(MAX_VELOCITY*TICKS_PER_DEG,
+                            MAX_ACCEL*TICKS_PER_DEG, MAX_JERK*TICKS_PER_DEG)
+    profile.set_target(degrees*TICKS_PER_DEG)
+
+    now = 0
+    ready = None
+    ready_at = None
+    moved = 0.0
+    steps = 0
+    stopped = False
+    near_since = None
+    while now < RUN_TIME*1000000:
+        if not stopped:
+            ctrl.set_setpoint(profile.update(now), profile.velocity)
+            ctrl.run(now)
+        angle = encoder.position/TICKS_PER_DEG
+        if detector and not stopped:
+            if not profile.done() or abs(angle - degrees) > CLOSE_ENOUGH:
+                near_since = None
+            elif near_since is None:
+                near_since = now
+            if ctrl.settled or (near_since is not None
+                                and now - near_since >= SETTLE_TIMEOUT_US):
+                motor.set_duty_cycle(0)
+                stopped = True
+                if ready is None:
+                    (ready, ready_at) = (now, angle)
+            elif profile.done():
+                left = ctrl.timeToSettle()
+                if (ctrl.bandSince is not None and left is not None
+                        and left <= IMAGE_LEAD_US):
+                    if ready is None:
+                        (ready, ready_at) = (now, angle)
+                else:
+                    # knocked out of the bands; the image is withdrawn
+                    (ready, ready_at, moved) = (None, None, 0.0)
+        elif not stopped and profile.done() and abs(angle - degrees) <= CLOSE_ENOUGH:
+            steps += 1
+            if steps > 3:
+                motor.set_duty_cycle(0)
+                stopped = True
+                (ready, ready_at) = (now, angle)
+        if ready_at is not None:
+            moved = max(moved, abs(angle - ready_at))
+        dt = PERIOD_US + random.randrange(JITTER_US) if random.random() < 0.3 else PERIOD_US
+        encoder.step(motor.duty, dt/1000000)
+        now += dt
+    error = abs(encoder.position/TICKS_PER_DEG - degrees)
+    return (ready, moved, error, ctrl.settleUs)
+
+
+def main():
+    print("  move      rule  ready, ms  moved, deg  error, deg  settled, ms")
+    for degrees in (1.0, 3.0, 10.0, 45.0, 90.0, 180.0):
+        for detector in (False, True):
+            random.seed(int(degrees))
+            results = [move(degrees, detector) for _ in range(RUNS)]
+
+            def mean(pos):
+                values = [r[pos] for r in results if r[pos] is not None]
+                return sum(values)/len(values) if values else 0
+            settled = f"{mean(3)/1000:11.0f}" if detector else " "*11
+            print(f"{degrees:6.0f}  {'detector' if detector else 'old':>8}"
+                  f"  {mean(0)/1000:9.0f}  {mean(1):10.2f}  {mean(2):10.2f}"
+                  f"  {settled}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+## @file sim_tracking.py
+#  Simulation of the turret engaging moving targets. The first table
+#  compares the old aiming (point at where the target was in the last image)
+#  with aiming led by a tracking.TargetTrack. The second puts two people in
+#  view and compares one track fed the biggest blob of each image with a
+#  tracking.MultiTargetTracker, by hit rate and images taken to fire.
+#
+#  Run it on a PC with the MicroPython Unix port from the @c src directory:
+#  @code
+#  micropython ../tools/sim_tracking.py
+#  @endcode
+
+import random
+from tracking import TargetTrack, MultiTargetTracker
+
+## Engagements simulated per target speed
+RUNS = const(200)
+## Frames the turret may take before the engagement counts as a miss
+MAX_FRAMES = const(12)
+
+## Time to capture both subpages of an image, ms
+FRAME_MS = const(500)
+## Time to find the target in an image, ms
+PROCESS_MS = const(120)
+## Time from deciding to fire to the shot, ms
+TRIGGER_MS = const(250)
+## Pan speed of the turret, degrees/s, and settling time after a move, ms
+PAN_SPEED = 120.0
+SETTLE_MS = const(150)
+## Pan angle noise of a measurement, degrees
+NOISE = 0.7
+## Blob area of a person, and its noise from image to image, pixels
+AREA = 6
+AREA_NOISE = 2
+## A shot within this many degrees of the target hits
+HIT_RADIUS = 2.5
+
+
+## A target walking across the field of view, and turning now and then.
+class Target:
+    def __init__(self, speed):
+        self.start = random.uniform(-40, 40)
+        self.speed = speed if random.random() < 0.5 else -speed
+        self.turn = random.uniform(2000, 8000)
+
+    def pan(self, t):
+        # bounce back and forth with period 2*turn ms
+        phase = (t % (2*self.turn))/self.turn
+        ramp = phase if phase < 1 else 2 - phase
+        return self.start + self.speed*self.turn/1000*(ramp - 0.5)
+
+
+## Decide what to do with a track, as task4 does.
+#  @returns (fire, aim): whether to fire now, and where to turn otherwise
+def decide(track, pointing, elapsed):
+    # fire if the target will be in the sights when the shot lands,
+    # otherwise aim where it will be at the next chance to fire
+    fire = (track.updates > 1 and
+            abs(track.lead(elapsed + TRIGGER_MS)[0] - pointing) <= 1)
+    aim = int(track.lead(elapsed + track.interval + TRIGGER_MS)[0])
+    return fire, aim
+
+
+## Run one engagement.
+#  @param   targets The targets in view
+#  @param   tracker A TargetTrack to lead the biggest target with, a
+#           MultiTargetTracker, or None for the old aiming at the biggest
+#           target where it was
+#  @returns The number of images taken before a hit, or 0 for a miss
+def engage(targets, tracker):
+    t = random.randrange(0, 10000)
+    pointing = 0.0
+    if tracker:
+        tracker.reset()
+    for frame in range(1, MAX_FRAMES + 1):
+        t += FRAME_MS
+        captured = t
+        detections = [
+            (target.pan(captured) + random.uniform(-NOISE, NOISE), 0.0,
+             AREA + random.randint(-AREA_NOISE, AREA_NOISE))
+            for target in targets
+        ]
+        biggest = max(detections, key=lambda det: det[2])
+        t += PROCESS_MS
+
+        if tracker is None:
+            aim = int(biggest[0])
+            fire = abs(aim - pointing) <= 1
+        elif isinstance(tracker, MultiTargetTracker):
+            tracker.update(detections, captured)
+            track = tracker.select(pointing, 0.0)
+            if track is None:
+                continue
+            fire, aim = decide(track, pointing, t - captured)
+        else:
+            tracker.update(biggest[0], 0.0, captured)
+            fire, aim = decide(tracker, pointing, t - captured)
+
+        if fire:
+            t += TRIGGER_MS
+            for target in targets:
+                if abs(target.pan(t) - pointing) <= HIT_RADIUS:
+                    return frame
+            return 0
+
+        t += int(abs(aim - pointing)/PAN_SPEED*1000) + SETTLE_MS
+        pointing = aim
+    return 0
+
+
+def main():
+    random.seed(405)
+    track = TargetTrack()
+    print("One target")
+    print("speed deg/s   old hit rate   tracked hit rate")
+    for speed in (0, 2, 5, 10, 15, 20):
+        hits_old = 0
+        hits_new = 0
+        for _ in range(RUNS):
+            target = Target(speed)
+            hits_old += bool(engage((target,), None))
+            hits_new += bool(engage((target,), track))
+        print(f"{speed:11d}   {100*hits_old/RUNS:11.1f}%   {100*hits_new/RUNS:15.1f}%")
+
+    multi = MultiTargetTracker()
+    print()
+    print("Two targets: hit rate, mean images to a hit")
+    print("speed deg/s   one track         multi-target")
+    for speed in (0, 2, 5, 10):
+        results = [[0, 0], [0, 0]]
+        for _ in range(RUNS):
+            targets = (Target(speed), Target(speed))
+            for (result, tracker) in zip(results, (track, multi)):
+                frames = engage(targets, tracker)
+                if frames:
+                    result[0] += 1
+                    result[1] += frames
+        line = f"{speed:11d}"
+        for (hits, frames) in results:
+            mean = frames/hits if hits else 0
+            line += f"   {100*hits/RUNS:5.1f}% {mean:5.2f}    "
+        print(line)
+
+
+if __name__ == "__main__":
+    main()